@@ -14,8 +14,11 @@ from django.urls import path
 
 # NEW: Import your custom JWTAuthMiddleware
 from chat.middleware import JWTAuthMiddleware 
+from chat.lifespan import LifespanApp
 
 from chatbox import consumers 
+from chatbox import archive, persistence, presence, room_log
+from chatbox.redis_pool import close_redis
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
@@ -26,4 +29,8 @@ application = ProtocolTypeRouter({
             path("ws/presence/", consumers.PresenceConsumer.as_asgi()),
         ])
     ),
+    "lifespan": LifespanApp(
+        on_startup=[persistence.start, room_log.start, presence.start, archive.start],
+        on_shutdown=[persistence.shutdown, room_log.shutdown, presence.shutdown, archive.shutdown, close_redis],
+    ),
 })
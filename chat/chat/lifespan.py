@@ -0,0 +1,36 @@
+# chat/lifespan.py
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LifespanApp:
+    """
+    Handles the ASGI 'lifespan' protocol so per-process resources (Redis pools,
+    background tasks) can be started and cleanly shut down with the worker.
+    Servers that don't speak lifespan (e.g. daphne) simply never call this.
+    """
+    def __init__(self, on_startup=None, on_shutdown=None):
+        self.on_startup = list(on_startup or [])
+        self.on_shutdown = list(on_shutdown or [])
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    for hook in self.on_startup:
+                        await hook()
+                except Exception as e:
+                    logger.error(f"Lifespan startup failed: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for hook in self.on_shutdown:
+                    try:
+                        await hook()
+                    except Exception as e:
+                        logger.error(f"Lifespan shutdown hook {hook.__name__} failed: {e}")
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -1,31 +1,108 @@
 # chat/middleware.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
 from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
 from urllib.parse import parse_qs
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """
+    Bounded LRU of user id -> User with a TTL, so a reconnect storm after a
+    deploy resolves identities from memory instead of queueing one DB query per
+    handshake. Entries are dropped when the user is saved or deleted in this
+    process; the TTL bounds staleness for changes made by other processes.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return user
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+user_cache = UserCache(
+    max_size=getattr(settings, 'WS_AUTH_USER_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'WS_AUTH_USER_CACHE_TTL', 60),
+)
+
+
+def _invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+
+
+post_save.connect(_invalidate_cached_user, sender=User, dispatch_uid='ws_auth_user_cache_save')
+post_delete.connect(_invalidate_cached_user, sender=User, dispatch_uid='ws_auth_user_cache_delete')
+
 
 @database_sync_to_async
-def get_user_from_token(token_key):
+def _load_user(user_id):
+    return User.objects.filter(id=user_id, is_active=True).first()
+
+
+async def get_user_from_token(token_key):
     """
-    Attempts to retrieve a user from a JWT token.
+    Attempts to retrieve a user from a JWT token. The signature is checked in
+    the event loop; the user itself normally comes from the cache.
     """
     try:
         # Validate the token using simplejwt's AccessToken
         access_token = AccessToken(token_key)
-        user_id = access_token['user_id'] # Get user_id from token payload
-        user = User.objects.get(id=user_id)
-        return user
-    except User.DoesNotExist:
-        print("JWTAuthMiddleware: User not found for ID in token.")
-        return AnonymousUser()
-    except TokenError as e:
-        print(f"JWTAuthMiddleware: Token validation failed: {e}")
+        user_id = int(access_token['user_id']) # Get user_id from token payload
+    except (TokenError, KeyError, ValueError) as e:
+        logger.info(f"JWTAuthMiddleware: Token validation failed: {e}")
         return AnonymousUser()
 
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    if getattr(settings, 'WS_AUTH_TRUST_TOKEN_CLAIMS', False) and access_token.get('username'):
+        # Claims-only identity: no DB call at all, at the cost of honouring a
+        # deactivated user's token until it expires.
+        user = User(id=user_id, username=access_token['username'])
+    else:
+        user = await _load_user(user_id)
+        if user is None:
+            logger.info("JWTAuthMiddleware: User not found for ID in token.")
+            return AnonymousUser()
+
+    user_cache.set(user_id, user)
+    return user
+
 class JWTAuthMiddleware:
     """
     Custom middleware to authenticate WebSocket connections using JWT from query string.
@@ -34,7 +111,7 @@ class JWTAuthMiddleware:
         self.app = app
 
     async def __call__(self, scope, receive, send):
-       
+
         query_string = scope['query_string'].decode()
         query_params = parse_qs(query_string)
         token = query_params.get('token')
@@ -42,9 +119,8 @@ class JWTAuthMiddleware:
         if token:
             # Get the user asynchronously using the token
             scope['user'] = await get_user_from_token(token[0])
-            print(f"JWTAuthMiddleware: Authenticated user for WS: {scope['user'].username if scope['user'].is_authenticated else 'Anonymous'}")
         else:
             scope['user'] = AnonymousUser()
-            print("JWTAuthMiddleware: No token found in WS query string.")
+            logger.debug("JWTAuthMiddleware: No token found in WS query string.")
 
         return await self.app(scope, receive, send)
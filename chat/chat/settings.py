@@ -35,6 +35,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware', 
+    'chatbox.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -73,13 +74,57 @@ WSGI_APPLICATION = 'chat.wsgi.application'
 ASGI_APPLICATION = 'chat.asgi.application'
 
 # Database
+# Threads the consumers run their queries on (chatbox.async_db); 0 keeps them
+# on the single thread shared with database_sync_to_async
+CONSUMER_DB_THREADS = int(os.environ.get('CONSUMER_DB_THREADS', 8))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep each DB thread's connection open between queries
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # WAL lets reads run while a write is in progress; synchronous=NORMAL
+            # is durable enough under WAL (a power cut can lose the last commits,
+            # never corrupt the file)
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-16000;'  # 16 MB page cache per connection
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=134217728;'
+            ),
+            # Take the write lock at BEGIN, so a transaction never fails upgrading from a read
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,  # seconds to wait for the write lock before "database is locked"
+        },
     }
 }
 
+# SQLite production mode: message writes go through one writer thread per
+# process, which commits up to SQLITE_WRITER_MAX_BATCH of them per transaction
+# (chatbox.sqlite_writer). Ignored on other databases.
+SQLITE_SINGLE_WRITER = True
+SQLITE_WRITER_MAX_BATCH = 200
+
+if os.environ.get('POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['POSTGRES_DB'],
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # psycopg connection pool shared by the DB threads (requires psycopg[pool]);
+        # Django needs CONN_MAX_AGE = 0 with it
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'pool': {'min_size': 2, 'max_size': CONSUMER_DB_THREADS + 4},
+        },
+    }
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     { 'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator', },
@@ -196,12 +241,92 @@ CSRF_TRUSTED_ORIGINS = [
     "http://192.168.68.105:3000"
 ]
 
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')
+# Extra Redis nodes, comma-separated. Rooms (their groups, presence set, typing
+# state, history cache and resume log) are spread over them by consistent
+# hashing; global keys stay on REDIS_URL. Empty: everything on REDIS_URL.
+REDIS_SHARD_URLS = [url.strip() for url in os.environ.get('REDIS_SHARD_URLS', '').split(',') if url.strip()]
+REDIS_SHARD_VNODES = 160  # ring points per node; more points, more even spread
+
 # Channels settings (for WebSockets)
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chatbox.sharding.ShardedRedisChannelLayer",
         "CONFIG": {
-             "hosts": [os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')],
+             "hosts": REDIS_SHARD_URLS or [REDIS_URL],
         },
     },
 }
+
+# Shared async Redis pool used by the consumers (one pool per worker process)
+REDIS_POOL_MAX_CONNECTIONS = int(os.environ.get('REDIS_POOL_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = 5  # seconds to wait for a free connection before erroring
+REDIS_HEALTH_CHECK_INTERVAL = 30  # idle connections are PINGed at most this often
+
+# Presence changes are coalesced and published as one delta per tick (seconds)
+PRESENCE_TICK = 0.25
+# Clients heartbeat every PRESENCE_HEARTBEAT_INTERVAL seconds; a connection that
+# has been silent for PRESENCE_TTL is counted out by the sweeper, which runs
+# every PRESENCE_SWEEP_INTERVAL in each worker
+PRESENCE_HEARTBEAT_INTERVAL = 20
+PRESENCE_TTL = 90  # above the once-a-minute timers of throttled background tabs
+PRESENCE_SWEEP_INTERVAL = 15
+
+# Per-socket outbound queues (chatbox.outbound): typing and presence frames are
+# coalesced or dropped past the soft limit; a client with more than
+# OUTBOUND_QUEUE_HIGH_WATER frames waiting is disconnected
+OUTBOUND_QUEUE_SOFT_LIMIT = 64
+OUTBOUND_QUEUE_HIGH_WATER = 1000
+
+# First-page history cache (chat_history:{conversation} in Redis)
+HISTORY_CACHE_SIZE = 50  # newest messages kept per conversation
+HISTORY_CACHE_TTL = 60 * 60 * 24  # idle conversations drop out of the cache after a day
+
+# Content-addressed image store (chatbox.blobs)
+BLOB_STORAGE_ROOT = BASE_DIR / 'blobs'
+IMAGE_MAX_UPLOAD_SIZE = 5 * 1024 * 1024
+IMAGE_THUMBNAIL_SIZE = 320  # longest side of server-generated thumbnails, in pixels
+
+# Cold storage (chatbox.archive): messages older than ARCHIVE_AFTER_DAYS move into
+# gzipped NDJSON segments, one per conversation per month, under ARCHIVE_ROOT.
+# 0 turns the background job off; `manage.py archive_messages --days N` still works.
+ARCHIVE_ROOT = BASE_DIR / 'archive'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+ARCHIVE_INTERVAL = 60 * 60  # seconds between background runs
+ARCHIVE_BATCH_SIZE = 1000  # messages moved per transaction
+ARCHIVE_SEGMENT_CACHE_SIZE = 16  # decoded segments kept per process for history reads
+
+# How WebSocket chat messages are persisted: 'sync' inserts each message before
+# broadcasting it; 'write_behind' broadcasts first and batches inserts per worker
+# (journaled in Redis until written, see chatbox.persistence); 'stream' appends
+# every message to its room's Redis stream and a consumer group batches them into
+# the database (see chatbox.room_log).
+CHAT_PERSISTENCE_MODE = os.environ.get('CHAT_PERSISTENCE_MODE', 'sync')
+WRITE_BEHIND_MAX_BATCH = 200  # flush as soon as this many messages are waiting
+WRITE_BEHIND_MAX_DELAY = 0.5  # ...or after this many seconds
+ROOM_LOG_SIZE = 1000  # approximate length each room stream is trimmed to
+ROOM_LOG_TTL = 60 * 60 * 24  # seconds an idle room's stream is kept
+ROOM_LOG_CLAIM_IDLE = 30  # seconds before another worker takes over an unacknowledged batch
+
+# WebSocket handshakes resolve users through an in-process LRU (chat.middleware)
+WS_AUTH_USER_CACHE_SIZE = 10000
+WS_AUTH_USER_CACHE_TTL = 60  # seconds; also bounds staleness of edits made in other processes
+# Build the user from the token's id/username claims instead of the database on a
+# cache miss. Saves the query, but a deactivated user stays connected until the token expires.
+WS_AUTH_TRUST_TOKEN_CLAIMS = False
+
+# Typing indicators (chatbox.typing_state)
+TYPING_TTL = 6  # seconds a start_typing counts for unless refreshed
+TYPING_TICK = 0.3  # typing changes in a room are published at most once per tick
+TYPING_MIN_INTERVAL = 1  # refreshes from one connection faster than this are dropped
+
+# Read receipts: one connection writes its read watermark at most once per interval (seconds)
+READ_RECEIPT_INTERVAL = 2
+
+# Bearer token required by /api/metrics/; the endpoint is closed while it is unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Reconnect catch-up (chatbox.resume_log)
+RESUME_LOG_SIZE = 500  # newest messages per conversation kept in Redis for replay
+RESUME_LOG_TTL = 60 * 60 * 24  # seconds an idle conversation's log is kept
+RESUME_MAX_REPLAY = 500  # a client that missed more than this reloads history instead
@@ -0,0 +1,361 @@
+# chatbox/archive.py
+"""
+Compressed cold storage for old messages.
+
+Messages older than ARCHIVE_AFTER_DAYS are moved out of the ChatMessage table
+into append-only segments, one per conversation per month (UTC), stored at
+ARCHIVE_ROOT/<aa>/<sha256 of the conversation>/<YYYY-MM>.ndjson.gz. A segment
+is a series of gzip members, one per archiving batch, each holding a JSON line
+per message in the message_rows() shape. ArchiveSegment rows index them: the
+time range each covers and how many bytes of its file are committed, and a
+`chat_archive:{conversation}` key in Redis marks the conversations that have any.
+
+Each batch is appended and fsynced first; the index update and the delete of
+the archived rows then commit in one transaction. An append starts by
+truncating the file to its committed size, so a batch whose transaction never
+committed is dropped rather than archived twice, and readers never read past
+the committed size. This relies on a single archiver, which a Redis lock
+ensures.
+
+The history endpoint falls through to read_before() / read_after() when a page
+reaches past the oldest message left in the table, including a newest page
+when the table holds less than a page. Archived messages no longer
+appear in search, legacy ?page= history or resumes. ARCHIVE_ROOT has to be
+shared by every host that serves history, like the blob store.
+
+The ArchiveJob archives every ARCHIVE_INTERVAL seconds in each worker (the
+lock lets one through at a time); `manage.py archive_messages` runs it by hand.
+"""
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import metrics, sqlite_writer
+from .async_db import db_sync_to_async
+from .models import ArchiveSegment, ChatMessage, Conversation
+from .redis_pool import get_sync_redis
+from .serializers import message_rows
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'chat_archive:lock'  # on the primary node
+LOCK_TTL = 10 * 60  # seconds; refreshed after every batch
+
+# KEYS: lock  ARGV: token, ttl
+# Extends the lock only if this archiver still holds it.
+REFRESH_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lock  ARGV: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_root():
+    return Path(getattr(settings, 'ARCHIVE_ROOT', settings.BASE_DIR / 'archive'))
+
+
+def segment_path(conversation, month):
+    """Where a segment lives, relative to ARCHIVE_ROOT. Hashed, as room names can contain anything."""
+    digest = hashlib.sha256(conversation.encode('utf8')).hexdigest()
+    return Path(digest[:2]) / digest / f'{month}.ndjson.gz'
+
+
+def archived_key(conversation):
+    """Marks a conversation with archived messages, on its shard, so history reads only look it up then."""
+    return f'chat_archive:{conversation}'
+
+
+def _mark_archived(conversations):
+    conversations = list(conversations)
+    pipes = {}
+    for conversation in conversations:
+        redis_conn = get_sync_redis(conversation)
+        pipe = pipes.setdefault(id(redis_conn), redis_conn.pipeline(transaction=False))
+        pipe.set(archived_key(conversation), 1)
+    for pipe in pipes.values():
+        pipe.execute()
+    for conversation in conversations:
+        _remember_archived(conversation, True)
+
+
+def _month(timestamp):
+    return timestamp.strftime('%Y-%m')
+
+
+def _key(row):
+    return row['timestamp'], row['id']
+
+
+def _encode_rows(rows):
+    lines = (json.dumps({**row, 'timestamp': row['timestamp'].isoformat()}, separators=(',', ':')) for row in rows)
+    return gzip.compress(''.join(f'{line}\n' for line in lines).encode('utf8'))
+
+
+def _append(segment, data):
+    """Writes `data` right after the committed part of the segment's file. Returns the new committed size."""
+    path = archive_root() / segment.path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    on_disk = path.stat().st_size if path.exists() else 0
+    if on_disk < segment.size:
+        raise ArchiveError(f"{path} has {on_disk} bytes, {segment.size} were committed.")
+    with open(path, 'ab') as f:
+        f.truncate(segment.size)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return segment.size + len(data)
+
+
+def _archive_rows(conversation, month, rows):
+    """Moves one conversation's rows from one month (oldest first) into their segment."""
+    segment = ArchiveSegment.objects.filter(conversation=conversation, month=month).first()
+    if segment is None:
+        segment = ArchiveSegment(
+            conversation=conversation, month=month, path=str(segment_path(conversation, month)),
+            first_timestamp=rows[0]['timestamp'], last_timestamp=rows[-1]['timestamp'],
+        )
+    size = _append(segment, _encode_rows(rows))
+
+    def commit():
+        with transaction.atomic():
+            segment.size = size
+            segment.message_count += len(rows)
+            segment.first_timestamp = min(segment.first_timestamp, rows[0]['timestamp'])
+            segment.last_timestamp = max(segment.last_timestamp, rows[-1]['timestamp'])
+            segment.save()
+            # The search index drops them too (triggers of migration 0009).
+            ChatMessage.objects.filter(id__in=[row['id'] for row in rows]).delete()
+
+    # On SQLite the index update and delete go through the single writer.
+    sqlite_writer.run(commit)
+    metrics.ARCHIVED_MESSAGES.inc(len(rows))
+    _mark_archived([conversation])
+
+
+def archive_messages(cutoff, batch_size=None, keep_lock=None):
+    """
+    Moves every message older than `cutoff` into the archive, at most
+    `batch_size` per transaction. Returns how many were moved. `keep_lock` is
+    called between batches.
+    """
+    batch_size = batch_size or getattr(settings, 'ARCHIVE_BATCH_SIZE', 1000)
+    moved = 0
+    for conversation in list(Conversation.objects.order_by('key').values_list('key', flat=True)):
+        while True:
+            rows = list(message_rows(
+                ChatMessage.objects.filter(conversation=conversation, timestamp__lt=cutoff).order_by('timestamp', 'id')
+            )[:batch_size])
+            for month, group in itertools.groupby(rows, key=lambda row: _month(row['timestamp'])):
+                group = list(group)
+                _archive_rows(conversation, month, group)
+                moved += len(group)
+            if keep_lock is not None and rows:
+                keep_lock()
+            if len(rows) < batch_size:
+                break
+    return moved
+
+
+def archive_old_messages(days=None, batch_size=None):
+    """
+    Archives messages older than `days` (default ARCHIVE_AFTER_DAYS) under the
+    archiver lock. Returns how many were moved, or None if another archiver is
+    running.
+    """
+    days = days if days is not None else getattr(settings, 'ARCHIVE_AFTER_DAYS', 0)
+    redis_conn = get_sync_redis()
+    token = uuid.uuid4().hex
+    if not redis_conn.set(LOCK_KEY, token, nx=True, ex=LOCK_TTL):
+        return None
+    refresh = redis_conn.register_script(REFRESH_LOCK_SCRIPT)
+
+    def keep_lock():
+        if not refresh(keys=[LOCK_KEY], args=[token, LOCK_TTL]):
+            raise ArchiveError("Lost the archiver lock.")
+
+    try:
+        # Restores the markers in case Redis lost them.
+        _mark_archived(ArchiveSegment.objects.values_list('conversation', flat=True).distinct())
+        moved = archive_messages(timezone.now() - timedelta(days=days), batch_size, keep_lock)
+    finally:
+        redis_conn.register_script(RELEASE_LOCK_SCRIPT)(keys=[LOCK_KEY], args=[token])
+    if moved:
+        logger.info(f"Archived {moved} messages older than {days} days.")
+    return moved
+
+
+_segments = OrderedDict()  # (path, committed size) -> (keys, rows), oldest first
+_segments_lock = threading.Lock()
+
+
+def _load_segment(segment):
+    """A segment's rows sorted by (timestamp, id), and their keys. The last few segments read stay decoded."""
+    cache_key = (segment.path, segment.size)
+    with _segments_lock:
+        cached = _segments.get(cache_key)
+        if cached is not None:
+            _segments.move_to_end(cache_key)
+            metrics.ARCHIVE_SEGMENT_READS.labels('cached').inc()
+            return cached
+
+    with open(archive_root() / segment.path, 'rb') as f:
+        data = f.read(segment.size)
+    rows = []
+    for line in gzip.decompress(data).decode('utf8').splitlines():
+        row = json.loads(line)
+        row['timestamp'] = parse_datetime(row['timestamp'])
+        rows.append(row)
+    rows.sort(key=_key)
+    loaded = [_key(row) for row in rows], rows
+    metrics.ARCHIVE_SEGMENT_READS.labels('loaded').inc()
+
+    with _segments_lock:
+        _segments[cache_key] = loaded
+        while len(_segments) > getattr(settings, 'ARCHIVE_SEGMENT_CACHE_SIZE', 16):
+            _segments.popitem(last=False)
+    return loaded
+
+
+_archived = OrderedDict()  # conversation -> (has archived messages, monotonic time checked), oldest first
+_archived_lock = threading.Lock()
+# A conversation stays archived once it is, so only a "no" needs looking up again.
+NOT_ARCHIVED_TTL = 60  # seconds
+
+
+def has_archived(conversation):
+    """
+    Checked in Redis, so history pages of conversations without an archive cost
+    no extra query, and remembered in the process.
+    """
+    now = time.monotonic()
+    with _archived_lock:
+        cached = _archived.get(conversation)
+        if cached is not None and (cached[0] or now - cached[1] < NOT_ARCHIVED_TTL):
+            _archived.move_to_end(conversation)
+            return cached[0]
+    try:
+        found = bool(get_sync_redis(conversation).exists(archived_key(conversation)))
+    except Exception as e:
+        logger.error(f"Error reading archive marker for {conversation}: {e}")
+        found = ArchiveSegment.objects.filter(conversation=conversation).exists()
+    _remember_archived(conversation, found, now)
+    return found
+
+
+def _remember_archived(conversation, found, now=None):
+    with _archived_lock:
+        _archived[conversation] = found, time.monotonic() if now is None else now
+        _archived.move_to_end(conversation)
+        while len(_archived) > getattr(settings, 'ARCHIVE_MARKER_CACHE_SIZE', 10000):
+            _archived.popitem(last=False)
+
+
+def read_before(conversation, before=None, limit=20):
+    """Up to `limit` archived rows older than the (timestamp, id) `before`, newest first."""
+    segments = ArchiveSegment.objects.filter(conversation=conversation)
+    if before is not None:
+        segments = segments.filter(first_timestamp__lte=before[0])
+    found = []
+    for segment in segments.order_by('-month'):
+        keys, rows = _load_segment(segment)
+        end = bisect_left(keys, before) if before is not None else len(rows)
+        found.extend(reversed(rows[max(0, end - (limit - len(found))):end]))
+        if len(found) >= limit:
+            break
+    return found
+
+
+def read_after(conversation, after, limit=20):
+    """Up to `limit` archived rows newer than the (timestamp, id) `after`, oldest first."""
+    segments = ArchiveSegment.objects.filter(conversation=conversation, last_timestamp__gte=after[0])
+    found = []
+    for segment in segments.order_by('month'):
+        keys, rows = _load_segment(segment)
+        start = bisect_right(keys, after)
+        found.extend(rows[start:start + limit - len(found)])
+        if len(found) >= limit:
+            break
+    return found
+
+
+class ArchiveJob:
+    """Archives old messages every ARCHIVE_INTERVAL seconds while ARCHIVE_AFTER_DAYS is set."""
+
+    def __init__(self):
+        self._task = None
+        self._running = False
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._running = True
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        self._running = False
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        while self._running:
+            await asyncio.sleep(getattr(settings, 'ARCHIVE_INTERVAL', 60 * 60))
+            if not getattr(settings, 'ARCHIVE_AFTER_DAYS', 0):
+                continue
+            try:
+                await db_sync_to_async(archive_old_messages)()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Message archiving error: {e}")
+
+
+_jobs = weakref.WeakKeyDictionary()
+
+
+async def start():
+    """ASGI lifespan startup hook."""
+    if getattr(settings, 'ARCHIVE_AFTER_DAYS', 0):
+        loop = asyncio.get_running_loop()
+        if loop not in _jobs:
+            _jobs[loop] = ArchiveJob()
+            _jobs[loop].start()
+
+
+async def shutdown():
+    job = _jobs.get(asyncio.get_running_loop())
+    if job is not None:
+        await job.stop()
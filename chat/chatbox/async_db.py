@@ -0,0 +1,60 @@
+# chatbox/async_db.py
+"""
+Database access for the consumers' hot paths.
+
+channels' database_sync_to_async (and Django's own async ORM methods, which
+are built on the same thread-sensitive sync_to_async) runs every query on one
+shared thread, so the DB work of every socket in a worker waits in a single
+line. db_sync_to_async is a drop-in replacement that runs the call on a pool
+of CONSUMER_DB_THREADS threads instead. Each thread keeps its own connection
+open for CONN_MAX_AGE (or borrows one from the psycopg pool on PostgreSQL),
+and stale connections are closed before and after each call, as
+database_sync_to_async does.
+
+CONSUMER_DB_THREADS = 0, or an in-memory SQLite database (the test
+database), keeps everything on the shared thread.
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync, database_sync_to_async
+from django.conf import settings
+from django.db import connection
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def db_threads():
+    return getattr(settings, 'CONSUMER_DB_THREADS', 8)
+
+
+def _pooled():
+    if db_threads() <= 0:
+        return False
+    # Other threads can't see an in-memory SQLite database's open transactions.
+    return not (connection.vendor == 'sqlite' and connection.is_in_memory_db())
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != db_threads():
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=db_threads(), thread_name_prefix='chat-db')
+        return _executor
+
+
+def db_sync_to_async(func):
+    """
+    database_sync_to_async, but on the DB thread pool: works as a decorator
+    and as db_sync_to_async(func)(*args).
+    """
+    @functools.wraps(func)
+    async def call(*args, **kwargs):
+        if not _pooled():
+            return await database_sync_to_async(func)(*args, **kwargs)
+        return await DatabaseSyncToAsync(func, thread_sensitive=False, executor=get_executor())(*args, **kwargs)
+    return call
@@ -0,0 +1,175 @@
+# chatbox/blobs.py
+"""
+Content-addressed image store on local disk.
+
+Images are stored once under BLOB_STORAGE_ROOT/<aa>/<bb>/<sha256>, next to a
+server-generated '<sha256>.thumb' WEBP thumbnail, and described by an
+ImageBlob row. Messages only reference the blob, so the bytes never travel
+through the database rows, the history cache or the channel layer.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from PIL import Image, UnidentifiedImageError
+
+from .models import ImageBlob
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_FORMATS = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+THUMBNAIL_CONTENT_TYPE = 'image/webp'
+CHUNK_SIZE = 64 * 1024
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def storage_root():
+    return Path(getattr(settings, 'BLOB_STORAGE_ROOT', settings.BASE_DIR / 'blobs'))
+
+
+def blob_path(sha256, thumbnail=False):
+    name = f'{sha256}.thumb' if thumbnail else sha256
+    return storage_root() / sha256[:2] / sha256[2:4] / name
+
+
+def image_reference(blob):
+    """What a message carries instead of the image bytes."""
+    if blob is None:
+        return None
+    return image_reference_from_fields(blob.sha256, blob.width, blob.height)
+
+
+def image_reference_from_fields(sha256, width, height):
+    """image_reference() for a blob read as plain values."""
+    return {
+        'id': sha256,
+        'url': f'/api/images/{sha256}/',
+        'thumbnail_url': f'/api/images/{sha256}/thumbnail/',
+        'width': width,
+        'height': height,
+    }
+
+
+def _iter_chunks(data):
+    if isinstance(data, (bytes, bytearray)):
+        for start in range(0, len(data), CHUNK_SIZE):
+            yield data[start:start + CHUNK_SIZE]
+    elif hasattr(data, 'chunks'):
+        yield from data.chunks(CHUNK_SIZE)
+    else:
+        yield from iter(lambda: data.read(CHUNK_SIZE), b'')
+
+
+def _write_thumbnail(image, sha256):
+    size = getattr(settings, 'IMAGE_THUMBNAIL_SIZE', 320)
+    thumb = image.copy()
+    thumb.thumbnail((size, size))
+    if thumb.mode not in ('RGB', 'RGBA'):
+        thumb = thumb.convert('RGBA')
+    path = blob_path(sha256, thumbnail=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+        thumb.save(tmp, format='WEBP', quality=80)
+    os.replace(tmp.name, path)
+    return thumb.size
+
+
+def store_image(data, uploaded_by=None):
+    """
+    Stores image bytes (bytes, a file object or an UploadedFile) and returns its
+    ImageBlob. Identical images are stored once. Raises InvalidImage for
+    anything that isn't a supported image within IMAGE_MAX_UPLOAD_SIZE.
+    """
+    max_size = getattr(settings, 'IMAGE_MAX_UPLOAD_SIZE', 5 * 1024 * 1024)
+    root = storage_root()
+    root.mkdir(parents=True, exist_ok=True)
+
+    # Stream to a temp file while hashing, so large uploads never sit in memory twice.
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=root, delete=False) as tmp:
+        try:
+            for chunk in _iter_chunks(data):
+                size += len(chunk)
+                if size > max_size:
+                    raise InvalidImage(f"Image exceeds {max_size} bytes.")
+                digest.update(chunk)
+                tmp.write(chunk)
+        except InvalidImage:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    sha256 = digest.hexdigest()
+
+    existing = ImageBlob.objects.filter(sha256=sha256).first()
+    if existing is not None and blob_path(sha256).exists():
+        os.unlink(tmp.name)
+        return existing
+
+    try:
+        with Image.open(tmp.name) as image:
+            image.verify()
+        with Image.open(tmp.name) as image:
+            image_format = image.format
+            if image_format not in ALLOWED_FORMATS:
+                raise InvalidImage(f"Unsupported image format: {image_format}")
+            width, height = image.size
+            path = blob_path(sha256)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            thumbnail_width, thumbnail_height = _write_thumbnail(image, sha256)
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError) as e:
+        os.unlink(tmp.name)
+        logger.debug(f"Rejected upload that Pillow could not read: {e}")
+        raise InvalidImage("Not a valid image.")
+    except InvalidImage:
+        os.unlink(tmp.name)
+        raise
+    os.replace(tmp.name, path)
+
+    blob, _ = ImageBlob.objects.get_or_create(sha256=sha256, defaults={
+        'content_type': ALLOWED_FORMATS[image_format],
+        'size': size,
+        'width': width,
+        'height': height,
+        'thumbnail_width': thumbnail_width,
+        'thumbnail_height': thumbnail_height,
+        'uploaded_by': uploaded_by,
+    })
+    logger.info(f"Stored image {sha256} ({size} bytes, {width}x{height}).")
+    return blob
+
+
+def decode_data_url(value):
+    """Decodes a base64 image, with or without a 'data:image/...;base64,' prefix."""
+    if ',' in value and value.startswith('data:'):
+        value = value.split(',', 1)[1]
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidImage("Image is not valid base64.")
+
+
+def image_from_payload(payload, user):
+    """
+    Resolves the image of an incoming message: an 'image_id' of a previously
+    uploaded blob, or (for older clients) inline base64 'image_content', which
+    is moved into the store. Returns None for messages without an image.
+    """
+    image_id = payload.get('image_id')
+    if image_id:
+        blob = ImageBlob.objects.filter(sha256=str(image_id)).first()
+        if blob is None:
+            raise InvalidImage(f"Unknown image {image_id}.")
+        return blob
+
+    image_content = payload.get('image_content')
+    if image_content:
+        return store_image(decode_data_url(image_content), uploaded_by=user)
+    return None
@@ -1,66 +1,38 @@
 # chatbox/consumers.py
-print("!!!!!!!!!! FIXED CONSUMER - STABLE WEBSOCKET HANDLING !!!!!!!!!!")
+import asyncio
 import json
-import redis.asyncio as async_redis
-from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
-from django.utils import timezone
-from .models import ChatMessage
+from django.db import transaction
+from .async_db import db_sync_to_async
+from .models import ChatMessage, dm_conversation_key
 from .serializers import ChatMessageSerializer
+from .encoding import encode_frame, frame_event
+from . import (
+    blobs, conversations, history_cache, metrics, outbound, persistence, presence, read_state, resume_log, room_log,
+    sqlite_writer, typing_state,
+)
 import logging
-import asyncio
+import time
+import uuid
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
-class RedisConnectionManager:
-    """Manages Redis connections to prevent connection leaks and ensure stability."""
-    
-    def __init__(self):
-        self._connection = None
-        self._lock = asyncio.Lock()
-    
-    async def get_connection(self):
-        async with self._lock:
-            if self._connection is None or not await self._connection.ping():
-                try:
-                    redis_url = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
-                    self._connection = await async_redis.from_url(
-                        redis_url, 
-                        decode_responses=True,
-                        socket_connect_timeout=5,
-                        socket_keepalive=True,
-                        retry_on_timeout=True,
-                        health_check_interval=30
-                    )
-                    logger.info("Successfully established new Redis connection.")
-                except Exception as e:
-                    logger.error(f"Failed to create Redis connection: {e}")
-                    raise
-            return self._connection
-    
-    async def close(self):
-        async with self._lock:
-            if self._connection:
-                try:
-                    await self._connection.close()
-                    logger.info("Redis connection closed.")
-                except Exception as e:
-                    logger.error(f"Error closing Redis connection: {e}")
-                finally:
-                    self._connection = None
-
-
 class PresenceConsumer(AsyncWebsocketConsumer):
-    # This consumer class appears to be well-structured. No changes are needed here.
-    # ... (Your existing PresenceConsumer code)
+    """
+    Presence protocol: a full 'presence_snapshot' is sent on connect (and when the
+    client asks for one with a 'presence_sync' frame after spotting a gap in the
+    sequence numbers); afterwards only numbered 'presence_delta' frames follow.
+    The client keeps its connection counted with 'heartbeat' frames.
+    """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.redis_manager = RedisConnectionManager()
         self.user = None
+        self.accepted = False
+        self.connection_id = uuid.uuid4().hex
+        self.outbound = outbound.OutboundQueue(self, 'presence')
 
     async def connect(self):
         try:
@@ -70,13 +42,13 @@ class PresenceConsumer(AsyncWebsocketConsumer):
                 return
 
             await self.accept()
+            self.accepted = True
+            metrics.WS_ACTIVE_SOCKETS.labels('presence').inc()
             
-            # Get Redis connection through manager
-            redis_conn = await self.redis_manager.get_connection()
-            await redis_conn.sadd('online_users', self.user.username)
-            
-            await self.channel_layer.group_add("presence_group", self.channel_name)
-            await self.send_presence_updates()
+            # Join the group before reading the snapshot so no delta can be missed.
+            await self.channel_layer.group_add(presence.PRESENCE_GROUP, self.channel_name)
+            await presence.user_online(self.user, self.connection_id)
+            await self.send_presence_snapshot()
             logger.info(f"Presence: User {self.user.username} connected.")
             
         except Exception as e:
@@ -84,26 +56,35 @@ class PresenceConsumer(AsyncWebsocketConsumer):
             await self.close()
 
     async def receive(self, text_data):
-        """Safely handle any unexpected messages to prevent crashes."""
+        """Answers snapshot requests and heartbeats; anything else is ignored."""
         try:
-            logger.debug(f"PresenceConsumer received unexpected message from {self.user.username if self.user else 'unknown'}. Ignoring.")
+            try:
+                event_type = json.loads(text_data).get('type')
+            except (json.JSONDecodeError, AttributeError):
+                event_type = None
+
+            if event_type == 'heartbeat':
+                await presence.user_online(self.user, self.connection_id)
+            elif event_type == 'presence_sync':
+                await self.send_presence_snapshot()
+            else:
+                logger.debug(f"PresenceConsumer received unexpected message from {self.user.username if self.user else 'unknown'}. Ignoring.")
         except Exception as e:
             logger.error(f"Error in PresenceConsumer receive: {e}")
 
     async def disconnect(self, close_code):
+        self.outbound.close()
+        if self.accepted:
+            metrics.WS_ACTIVE_SOCKETS.labels('presence').dec()
         try:
             if self.user and self.user.is_authenticated:
-                redis_conn = await self.redis_manager.get_connection()
-                await redis_conn.srem('online_users', self.user.username)
-                await self.channel_layer.group_discard("presence_group", self.channel_name)
-                await self.send_presence_updates()
+                await self.channel_layer.group_discard(presence.PRESENCE_GROUP, self.channel_name)
+                await presence.user_offline(self.user, self.connection_id)
                 logger.info(f"Presence: User {self.user.username} disconnected.")
         except Exception as e:
             logger.error(f"Error in PresenceConsumer disconnect: {e}")
-        finally:
-            await self.redis_manager.close()
 
-    @database_sync_to_async
+    @db_sync_to_async
     def _get_users_by_username(self, usernames):
         """Helper to fetch users from DB in a single query."""
         try:
@@ -113,80 +94,57 @@ class PresenceConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error fetching users: {e}")
             return []
 
-    async def send_presence_updates(self):
+    async def send_presence_snapshot(self):
+        """Sends the full user and room lists to this client only."""
         try:
-            redis_conn = await self.redis_manager.get_connection()
-            online_usernames = list(await redis_conn.smembers('online_users'))
-            users_with_ids = await self._get_users_by_username(online_usernames) if online_usernames else []
-            
-            available_rooms_list = await redis_conn.smembers('available_public_rooms')
-            detailed_rooms = []
-            
-            for room_name in sorted(list(available_rooms_list)):
-                try:
-                    user_count = await redis_conn.scard(f'room:{room_name}:active_users')
-                    detailed_rooms.append({'name': room_name, 'online_count': user_count})
-                except Exception as e:
-                    logger.error(f"Error getting room count for {room_name}: {e}")
-                    detailed_rooms.append({'name': room_name, 'online_count': 0})
-            
-            await self.channel_layer.group_send("presence_group", {
-                'type': 'presence.broadcast',
-                'users': sorted(users_with_ids, key=lambda u: u['username']),
-                'detailed_rooms': detailed_rooms,
-            })
-        except Exception as e:
-            logger.error(f"Error in send_presence_updates: {e}")
-    
-    async def room_activity_update(self, event_data):
-        try:
-            room_name = event_data['room_name']
-            username = event_data['username']
-            action = event_data['action']
-            
-            redis_conn = await self.redis_manager.get_connection()
-            room_key = f'room:{room_name}:active_users'
-            
-            await redis_conn.sadd('available_public_rooms', room_name)
-            
-            if action == 'joined':
-                await redis_conn.sadd(room_key, username)
-            elif action == 'left':
-                await redis_conn.srem(room_key, username)
-            
-            await self.send_presence_updates()
-        except Exception as e:
-            logger.error(f"Error in room_activity_update: {e}")
+            seq, online_usernames, rooms = await presence.read_snapshot_state()
+            users_with_ids = await self._get_users_by_username(list(online_usernames)) if online_usernames else []
 
-    async def presence_broadcast(self, event_data):
-        try:
-            await self.send(text_data=json.dumps({
-                'type': 'user_list', 
-                'users': event_data['users']
-            }))
-            await self.send(text_data=json.dumps({
-                'type': 'detailed_room_list', 
-                'rooms': event_data['detailed_rooms']
+            self.outbound.put(encode_frame({
+                'type': 'presence_snapshot',
+                'seq': seq,
+                'users': sorted(users_with_ids, key=lambda u: u['username']),
+                'rooms': [{'name': name, 'online_count': count} for name, count in rooms],
             }))
         except Exception as e:
-            logger.error(f"Error in presence_broadcast: {e}")
+            logger.error(f"Error in send_presence_snapshot: {e}")
+
+    async def presence_delta(self, event_data):
+        # Droppable: the client notices the gap in sequence numbers and resyncs.
+        self.outbound.put(event_data['frame'], outbound.DROP)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Frame types a client may send; anything else is counted as dropped.
+    EVENT_TYPES = (
+        'start_typing', 'stop_typing', 'mark_read', 'mark_read_batch', 'chat_message', 'resume', 'heartbeat',
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.redis_manager = RedisConnectionManager()
         self.user = None
         self.actual_room_name = None
         self.room_group_name = None
+        self.is_typing = False
+        self.typing_refreshed_at = 0.0
+        self.accepted = False
+        self.replayed_ids = set()  # sent by resume(); their live copies are skipped
+        self.read_up_to = 0  # how far this connection has moved the watermark
+        self.pending_read_id = None  # a newer receipt waiting for READ_RECEIPT_INTERVAL to pass
+        self.read_written_at = float('-inf')
+        self.read_flush_task = None
+        self.connection_id = uuid.uuid4().hex
+        self.outbound = outbound.OutboundQueue(self, 'chat')
 
     # ... (connect, disconnect, and other helper methods are fine) ...
     def is_dm_room(self, room_name_str):
         return room_name_str.startswith('dm_')
 
-    def generate_cache_key(self, room_name):
-        """Generate consistent cache key matching the API logic."""
-        return f'chat_history:{room_name}'
+    def get_conversation_key(self, receiver=None):
+        """Same key the REST view uses: the room name, or dm_<low>_<high> for DMs."""
+        if receiver is not None:
+            return dm_conversation_key(self.user.id, receiver.id)
+        return self.actual_room_name
 
     async def connect(self):
         try:
@@ -202,20 +160,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name = f'chat_{self.actual_room_name}'
             
             await self.accept()
-            
-            # Initialize Redis connection
-            await self.redis_manager.get_connection()
+            self.accepted = True
+            metrics.WS_ACTIVE_SOCKETS.labels('chat').inc()
             
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
             
             # Update presence for public rooms
             if not self.is_dm_room(self.actual_room_name):
-                await self.channel_layer.group_send("presence_group", {
-                    'type': 'room.activity.update', 
-                    'room_name': self.actual_room_name, 
-                    'username': self.user.username, 
-                    'action': 'joined'
-                })
+                await presence.room_activity_update(
+                    self.actual_room_name, self.user.username, 'joined', self.connection_id)
             
             logger.info(f"User {self.user.username} connected to room {self.actual_room_name}")
             
@@ -224,25 +177,27 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
 
     async def disconnect(self, close_code):
+        self.outbound.close()
+        if self.accepted:
+            metrics.WS_ACTIVE_SOCKETS.labels('chat').dec()
         try:
             if self.user and self.user.is_authenticated:
 
-                await self.handle_typing_status(is_typing=False)
+                if self.is_typing:
+                    await self.handle_typing_status(is_typing=False)
+
+                if self.read_flush_task is not None:
+                    self.read_flush_task.cancel()
+                await self.flush_read_receipt()
 
                 if not self.is_dm_room(self.actual_room_name):
-                    await self.channel_layer.group_send("presence_group", {
-                        'type': 'room.activity.update', 
-                        'room_name': self.actual_room_name, 
-                        'username': self.user.username, 
-                        'action': 'left'
-                    })
+                    await presence.room_activity_update(
+                        self.actual_room_name, self.user.username, 'left', self.connection_id)
                 
                 await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
                 logger.info(f"User {self.user.username} disconnected from room {self.actual_room_name}")
         except Exception as e:
             logger.error(f"Error in ChatConsumer disconnect: {e}")
-        finally:
-            await self.redis_manager.close()
 
     async def receive(self, text_data):
         """Handle incoming WebSocket messages with comprehensive error handling."""
@@ -253,55 +208,143 @@ class ChatConsumer(AsyncWebsocketConsumer):
             try:
                 text_data_json = json.loads(text_data)
             except json.JSONDecodeError as e:
+                metrics.WS_FRAMES_DROPPED.labels('malformed').inc()
                 logger.error(f"Received malformed JSON from {self.user.username}: {e}")
                 return
 
             event_type = text_data_json.get('type')
             if not event_type:
+                metrics.WS_FRAMES_DROPPED.labels('malformed').inc()
                 logger.debug(f"Received message with no type from {self.user.username}. Ignoring.")
                 return
-            
-            # This is now one continuous chain of logic
-            if event_type == "start_typing":
-                await self.handle_typing_status(is_typing=True)
-            
-            elif event_type == "stop_typing":
-                await self.handle_typing_status(is_typing=False)
-            
-            # --- THIS IS THE KEY CHANGE ---
-            # This `if` is now an `elif`, connecting it to the block above
-            elif event_type == "mark_read_batch":
-                message_ids = text_data_json.get('message_ids')
-                if message_ids and isinstance(message_ids, list):
-                    await self.mark_messages_as_read(message_ids)
-
-            elif event_type == "chat_message":
-                await self.save_and_broadcast_message(text_data_json)
-                
-            else:
+
+            if event_type not in self.EVENT_TYPES:
+                metrics.WS_FRAMES_DROPPED.labels('unknown_type').inc()
                 logger.warning(f"Received unknown event type '{event_type}' from {self.user.username}")
+                return
+
+            with metrics.WS_EVENT_SECONDS.labels(event_type).time():
+                await self.dispatch_event(event_type, text_data_json)
 
         except Exception as e:
             logger.error(f"CRITICAL ERROR in receive for user {self.user.username}: {e}")
 
+    async def dispatch_event(self, event_type, text_data_json):
+        if event_type == "start_typing":
+            await self.handle_typing_status(is_typing=True)
+
+        elif event_type == "stop_typing":
+            await self.handle_typing_status(is_typing=False)
+
+        elif event_type == "mark_read":
+            await self.mark_messages_as_read(text_data_json.get('last_read_id'))
+
+        # Older clients list the ids they have seen; only the newest one matters.
+        elif event_type == "mark_read_batch":
+            message_ids = text_data_json.get('message_ids')
+            if message_ids and isinstance(message_ids, list):
+                valid_ids = [int(mid) for mid in message_ids if str(mid).isdigit()]
+                if valid_ids:
+                    await self.mark_messages_as_read(max(valid_ids))
+
+        elif event_type == "chat_message":
+            await self.save_and_broadcast_message(text_data_json)
+
+        elif event_type == "resume":
+            await self.resume(text_data_json.get('last_id'))
+
+        elif event_type == "heartbeat":
+            if not self.is_dm_room(self.actual_room_name):
+                await presence.room_activity_update(
+                    self.actual_room_name, self.user.username, 'heartbeat', self.connection_id)
+
     
     # ... (save_and_broadcast_message and its helpers are fine) ...
-    @database_sync_to_async
-    def _save_message_to_db(self, message_data, is_dm, receiver_instance):
+    async def _save_message_to_db(self, message_data, is_dm, receiver_instance):
         """Save message to database with error handling."""
         try:
+            # Only a reference to the stored image goes into the row and the broadcast.
+            # Decoding and checking an image happens on the DB pool, never on the SQLite writer.
+            image = None
+            if message_data.get('image_id') or message_data.get('image_content'):
+                image = await db_sync_to_async(blobs.image_from_payload)(message_data, self.user)
+            return await sqlite_writer.db_write(self._insert_message)(message_data, is_dm, receiver_instance, image)
+        except blobs.InvalidImage as e:
+            logger.warning(f"Rejected image from {self.user.username}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error saving message to DB: {e}")
+            return None
+
+    def _insert_message(self, message_data, is_dm, receiver_instance, image):
+        with transaction.atomic():
             new_message = ChatMessage.objects.create(
                 sender=self.user,
                 message=message_data.get('message', ''),
-                image_content=message_data.get('image_content'),
+                image=image,
                 message_type=message_data.get('msg_type', 'text'),
                 room_name=self.actual_room_name,
                 is_dm=is_dm,
                 receiver=receiver_instance
             )
+            conversations.record_messages([new_message])
+        return ChatMessageSerializer(new_message).data
+
+    async def _queue_message_for_db(self, message_data, is_dm, receiver_instance):
+        """
+        Write-behind mode: allocates the id, journals the message and hands it to
+        this worker's batch writer, so it can be broadcast before it is inserted.
+        """
+        try:
+            image = None
+            if message_data.get('image_id') or message_data.get('image_content'):
+                image = await db_sync_to_async(blobs.image_from_payload)(message_data, self.user)
+            new_message = ChatMessage(
+                id=await persistence.aallocate_message_id(),
+                sender=self.user,
+                message=message_data.get('message', ''),
+                image=image,
+                message_type=message_data.get('msg_type', 'text'),
+                room_name=self.actual_room_name,
+                is_dm=is_dm,
+                receiver=receiver_instance,
+            )
+            new_message.conversation = new_message.build_conversation_key()
+            await persistence.get_buffer().add(new_message)
             return ChatMessageSerializer(new_message).data
+        except blobs.InvalidImage as e:
+            logger.warning(f"Rejected image from {self.user.username}: {e}")
+            return None
         except Exception as e:
-            logger.error(f"Error saving message to DB: {e}")
+            logger.error(f"Error queueing message for DB: {e}")
+            return None
+
+    async def _append_to_room_log(self, message_data, is_dm, receiver_instance):
+        """
+        Stream mode: appends the message to the room's stream, which allocates
+        its id and queues it for the persist group. Returns (id, frame).
+        """
+        try:
+            image = None
+            if message_data.get('image_id') or message_data.get('image_content'):
+                image = await db_sync_to_async(blobs.image_from_payload)(message_data, self.user)
+            new_message = ChatMessage(
+                sender=self.user,
+                message=message_data.get('message', ''),
+                image=image,
+                message_type=message_data.get('msg_type', 'text'),
+                room_name=self.actual_room_name,
+                is_dm=is_dm,
+                receiver=receiver_instance,
+            )
+            new_message.conversation = new_message.build_conversation_key()
+            frame = await room_log.aappend(new_message)
+            return new_message.id, frame
+        except blobs.InvalidImage as e:
+            logger.warning(f"Rejected image from {self.user.username}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error appending message to room log: {e}")
             return None
 
     async def save_and_broadcast_message(self, message_data):
@@ -317,160 +360,195 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     return
                 
                 try:
-                    receiver_user_instance = await database_sync_to_async(User.objects.get)(username=receiver_username)
+                    receiver_user_instance = await db_sync_to_async(User.objects.get)(username=receiver_username)
                 except User.DoesNotExist:
                     logger.error(f"Receiver user {receiver_username} not found")
                     return
 
-            saved_message = await self._save_message_to_db(message_data, is_dm, receiver_user_instance)
-            if not saved_message:
-                logger.error("Failed to save message to database")
-                return
+            # Encoded once; every member's consumer forwards the same text. Either
+            # way it is logged before the broadcast, so a socket resuming meanwhile
+            # gets it one way or the other.
+            if room_log.enabled():
+                logged = await self._append_to_room_log(message_data, is_dm, receiver_user_instance)
+                if not logged:
+                    return
+                message_id, frame = logged
+            else:
+                if persistence.write_behind_enabled():
+                    saved_message = await self._queue_message_for_db(message_data, is_dm, receiver_user_instance)
+                else:
+                    saved_message = await self._save_message_to_db(message_data, is_dm, receiver_user_instance)
+                if not saved_message:
+                    logger.error("Failed to save message to database")
+                    return
 
-            try:
-                redis_conn = await self.redis_manager.get_connection()
-                cache_key = self.generate_cache_key(self.actual_room_name)
-                
-                await redis_conn.lpush(cache_key, json.dumps(saved_message))
-                await redis_conn.ltrim(cache_key, 0, 49)
-                
-                logger.debug(f"CACHE UPDATED for {cache_key} with new message")
-            except Exception as e:
-                logger.error(f"Error updating cache: {e}")
+                conversation = self.get_conversation_key(receiver_user_instance)
+                try:
+                    await history_cache.apush(conversation, saved_message, pending=persistence.write_behind_enabled())
+                except Exception as e:
+                    logger.error(f"Error updating cache: {e}")
 
-            await self.channel_layer.group_send(self.room_group_name, {
-                'type': 'chat.message.broadcast', 
-                **saved_message
-            })
+                message_id, frame = saved_message['id'], resume_log.message_frame(saved_message)
+                try:
+                    await resume_log.aappend(conversation, message_id, frame)
+                except Exception as e:
+                    logger.error(f"Error appending to resume log: {e}")
+
+            event = {'type': 'chat.message.broadcast', 'frame': frame, 'id': message_id}
+            with metrics.time_group_send(event):
+                await self.channel_layer.group_send(self.room_group_name, event)
 
         except Exception as e:
             logger.error(f"Error in save_and_broadcast_message: {e}")
 
+    async def forward_frame(self, event_data):
+        """Queues a frame the publisher already encoded (see chatbox.encoding), unchanged."""
+        self.outbound.put(event_data['frame'])
+
     async def chat_message_broadcast(self, event_data):
-        """Broadcast chat message to WebSocket."""
-        try:
-            broadcast_data = {k: v for k, v in event_data.items() if k != 'type'}
-            await self.send(text_data=json.dumps({
-                'type': 'chat_message', 
-                **broadcast_data
-            }))
-        except Exception as e:
-            logger.error(f"Error in chat_message_broadcast: {e}")
+        if self.replayed_ids and event_data.get('id') in self.replayed_ids:
+            self.replayed_ids.discard(event_data['id'])
+            return
+        await self.forward_frame(event_data)
+
+    read_receipts_broadcast = forward_frame
 
+    async def typing_users_broadcast(self, event_data):
+        # Each frame carries the room's whole typist list, so only the newest one matters.
+        self.outbound.put(event_data['frame'], outbound.COALESCE, key='typing')
 
 
-    @database_sync_to_async
-    def _update_read_status_in_db(self, message_ids):
+    @db_sync_to_async
+    def _advance_read_watermark(self, last_read_id):
+        """Moves this user's watermark for the room forward; True if it moved."""
+        try:
+            if not read_state.can_read(self.user, self.actual_room_name):
+                logger.warning(f"User {self.user.username} sent a read receipt for {self.actual_room_name}")
+                return False
+            return read_state.advance_watermark(self.user, self.actual_room_name, last_read_id)
+        except Exception as e:
+            logger.error(f"Error updating read watermark in DB: {e}")
+            return False
+
+    async def resume(self, last_id):
         """
-        Efficiently updates read status in the database.
-        Returns a list of message IDs that were successfully updated.
+        Catches a reconnected client up: sends the room's messages newer than
+        last_id, from the resume log (the room stream in stream mode) or else
+        the database (see chatbox.resume_log), then a 'resumed' frame. 'complete' is false when
+        more than RESUME_MAX_REPLAY were missed; the client then reloads
+        history instead.
         """
         try:
-            # Ensure we have a list of integers for the query
-            valid_message_ids = [int(mid) for mid in message_ids if str(mid).isdigit()]
-            if not valid_message_ids:
-                return []
-
-            # Find messages that this user has received and which are still unread.
-            messages_to_update = ChatMessage.objects.filter(
-                id__in=valid_message_ids, 
-                is_read=False, 
-                receiver=self.user
-            )
-            
-            # Get the IDs before updating to know which ones are changing.
-            updated_ids = list(messages_to_update.values_list('id', flat=True))
-            
-            if updated_ids:
-                # Perform the update in a single DB query.
-                messages_to_update.update(is_read=True)
-                logger.info(f"User {self.user.username} marked messages {updated_ids} as read.")
-                return updated_ids
-                
-            return []
+            last_id = int(last_id)
+        except (TypeError, ValueError):
+            metrics.WS_FRAMES_DROPPED.labels('malformed').inc()
+            return
+        conversation = self.actual_room_name
+        if not read_state.can_read(self.user, conversation):
+            logger.warning(f"User {self.user.username} tried to resume {conversation}")
+            return
+
+        limit = resume_log.max_replay()
+        log = room_log if room_log.enabled() else resume_log
+        try:
+            covered, entries = await log.aread_after(conversation, last_id, limit + 1)
         except Exception as e:
-            logger.error(f"Error updating read status in DB: {e}")
-            return []
-
-    async def mark_messages_as_read(self, message_ids):
+            logger.error(f"Error reading resume log for {conversation}: {e}")
+            covered, entries = False, []
+
+        if covered:
+            source = 'log'
+        else:
+            source = 'database'
+            stored = await db_sync_to_async(resume_log.missed_from_db)(conversation, last_id, limit + 1)
+            # In write-behind mode the newest messages may be logged but not inserted yet.
+            newest = max((message_id for message_id, _ in stored), default=last_id)
+            entries = stored + [entry for entry in entries if entry[0] > newest]
+
+        complete = len(entries) <= limit
+        entries = entries[:limit]
+        for message_id, frame in entries:
+            self.outbound.put(frame)
+        self.replayed_ids.update(message_id for message_id, _ in entries)
+        metrics.RESUME_REPLAYS.labels(source if complete else 'truncated').inc()
+
+        self.outbound.put(encode_frame({
+            'type': 'resumed',
+            'room_name': self.actual_room_name,
+            'replayed': len(entries),
+            'complete': complete,
+        }))
+
+    async def mark_messages_as_read(self, last_read_id):
         """
-        Handles a request to mark messages as read, invalidates cache,
-        and broadcasts a single confirmation to the group.
+        Records that this user has read the room up to `last_read_id`. Receipts
+        at or below what this connection already recorded are dropped, and the
+        watermark is written at most once per READ_RECEIPT_INTERVAL: a receipt
+        arriving sooner is held, and only the newest held one is written when
+        the interval is up (or on disconnect).
         """
         try:
-            # Step 1: Update the database and get the list of IDs that were actually changed.
-            updated_ids = await self._update_read_status_in_db(message_ids)
-            
-            if updated_ids:
-                # Step 2: Invalidate the Redis cache for this room so the API serves fresh data.
-                try:
-                    redis_conn = await self.redis_manager.get_connection()
-                    cache_key = self.generate_cache_key(self.actual_room_name)
-                    await redis_conn.delete(cache_key)
-                    logger.debug(f"CACHE INVALIDATED for {cache_key} because of read receipt.")
-                except Exception as e:
-                    logger.error(f"Error invalidating cache after read receipt: {e}")
-
-                # Step 3: Broadcast a single, efficient message to the entire group.
-                await self.channel_layer.group_send(self.room_group_name, {
-                    'type': 'read_receipts_broadcast', 
-                    'room_name': self.actual_room_name, 
-                    'message_ids': updated_ids,
-                    'reader_username': self.user.username,
-                })
+            if not str(last_read_id).isdigit():
+                return
+            last_read_id = int(last_read_id)
+            if last_read_id <= max(self.read_up_to, self.pending_read_id or 0):
+                metrics.WS_FRAMES_DROPPED.labels('read_stale').inc()
+                return
+            self.pending_read_id = last_read_id
+            wait = self.read_written_at + getattr(settings, 'READ_RECEIPT_INTERVAL', 2) - time.monotonic()
+            if wait <= 0:
+                await self.flush_read_receipt()
+            elif self.read_flush_task is None:
+                self.read_flush_task = asyncio.ensure_future(self._flush_read_receipt_after(wait))
         except Exception as e:
             logger.error(f"Error in mark_messages_as_read: {e}")
 
+    async def _flush_read_receipt_after(self, delay):
+        await asyncio.sleep(delay)
+        self.read_flush_task = None
+        try:
+            await self.flush_read_receipt()
+        except Exception as e:
+            logger.error(f"Error in flush_read_receipt: {e}")
 
-# typing status
-    async def   handle_typing_status(self, is_typing):
-        """
-        Handles sending typing status to the channel group.
-        """   
-            # --- ADD THIS LOGGING BLOCK ---
-        status_text = "start" if is_typing else "stop"
-        logger.info(
-        f"Received '{status_text}_typing' event from user '{self.user.username}' in room '{self.actual_room_name}'"
-        )
-        await self.channel_layer.group_send(
-            self.room_group_name,{
-                "type": "typing.status.broadcast",
-                "username": self.user.username,
-                "is_typing": is_typing,
-
-            },
-        )
-    
-    async def typing_status_broadcast(self, event):
+    async def flush_read_receipt(self):
         """
-        Broadcasts typing status to the WebSocket.
+        Writes the held receipt, if any, and if that moved the watermark in a
+        DM, broadcasts it to the other side. Public rooms show no read ticks,
+        so their receipts aren't broadcast.
         """
-        # Don't send the typing status back to the user who is typing
-        if self.user.username != event["username"]:
-            # CORRECTED: The keyword argument is text_data, not test_data
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "typing_status",
-                        "username": event["username"],
-                        "is_typing": event["is_typing"],
-                    }
-                )
-            )
+        last_read_id, self.pending_read_id = self.pending_read_id, None
+        if last_read_id is None:
+            return
+        self.read_written_at = time.monotonic()
+        self.read_up_to = max(self.read_up_to, last_read_id)
+        moved = await self._advance_read_watermark(last_read_id)
+        if moved and self.is_dm_room(self.actual_room_name):
+            event = frame_event('read_receipts_broadcast', {
+                'type': 'messages_marked_as_read',
+                'room_name': self.actual_room_name,
+                'last_read_id': last_read_id,
+                'reader_username': self.user.username,
+            })
+            with metrics.time_group_send(event):
+                await self.channel_layer.group_send(self.room_group_name, event)
 
 
-# read receipt
-    async def read_receipts_broadcast(self, event_data):
+# typing status
+    async def handle_typing_status(self, is_typing):
         """
-        Sends the batch of read receipt data to the client's WebSocket.
+        Records this user's typing state for the room. Repeated stops and
+        refreshes faster than TYPING_MIN_INTERVAL are dropped here; the
+        aggregated 'typing_users' broadcast is left to typing_state.
         """
+        now = time.monotonic()
+        if is_typing == self.is_typing:
+            if not is_typing or now - self.typing_refreshed_at < getattr(settings, 'TYPING_MIN_INTERVAL', 1):
+                metrics.WS_FRAMES_DROPPED.labels('typing_throttled').inc()
+                return
+        self.is_typing = is_typing
+        self.typing_refreshed_at = now
         try:
-            # The client will receive a single event with all the necessary info.
-            await self.send(text_data=json.dumps({
-                'type': 'messages_marked_as_read', # A clear, specific event type for the frontend
-                'room_name': event_data['room_name'],
-                'message_ids': event_data['message_ids'],
-                'reader_username': event_data['reader_username'],
-            }))
+            await typing_state.set_typing(self.actual_room_name, self.user.username, is_typing)
         except Exception as e:
-            logger.error(f"Error broadcasting read receipts: {e}")
\ No newline at end of file
+            logger.error(f"Error updating typing state: {e}")
@@ -0,0 +1,122 @@
+# chatbox/conversations.py
+"""
+Incremental maintenance of the Conversation / Participant summary tables.
+
+record_messages() runs inside the transaction that saves the messages (the
+consumer, the REST view and the write-behind flush), so a conversation's last
+message, activity and message count always match the committed messages.
+Those live on the Conversation row alone: a message in a public room writes
+that row and, for a first-time sender, a Participant row, never the rows of
+the other members. Only DMs keep a per-participant unread counter; a public
+room's unread count is its message_count minus the reader's watermark
+snapshot (read_state.apply_room_unread_counts).
+"""
+from collections import Counter
+
+from django.db.models import BigIntegerField, Case, Count, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import ChatMessage, Conversation, Participant, ReadWatermark, dm_peer_id
+
+PREVIEW_LENGTH = 100
+
+
+def message_preview(message):
+    if message.message:
+        return message.message[:PREVIEW_LENGTH]
+    return '[image]' if message.image_id or message.image_content else ''
+
+
+def _members(key, batch):
+    """{user_id: peer_id} of everyone who takes part in the batch's messages."""
+    is_dm = key.startswith('dm_')
+    members = {}
+    for message in batch:
+        user_ids = [message.sender_id]
+        if is_dm and message.receiver_id:
+            user_ids.append(message.receiver_id)
+        for user_id in user_ids:
+            members[user_id] = dm_peer_id(key, user_id) if is_dm else None
+    return members
+
+
+def record_messages(messages):
+    """
+    Folds newly saved messages into the summaries: the conversation's last
+    message, activity and message count, a Participant row for every sender
+    (and DM receiver), and in DMs +1 unread per message for each participant
+    who didn't send it. In a public room the senders' watermarks move past
+    their own messages instead. Must be called in the transaction that saved
+    the messages, and only once per message.
+    """
+    by_conversation = {}
+    for message in sorted(messages, key=lambda m: m.id):
+        by_conversation.setdefault(message.conversation, []).append(message)
+
+    for key, batch in by_conversation.items():
+        last = batch[-1]
+        summary = {
+            'is_dm': key.startswith('dm_'),
+            'last_message_id': last.id,
+            'last_message_preview': message_preview(last),
+            'last_sender_id': last.sender_id,
+            'last_activity': last.timestamp,
+        }
+        counted = {'message_count': F('message_count') + len(batch)}
+        # Forward-only, so an older batch flushed late can't overwrite a newer last message.
+        if not Conversation.objects.filter(key=key, last_message_id__lt=last.id).update(**summary, **counted):
+            _, created = Conversation.objects.get_or_create(key=key, defaults={**summary, 'message_count': len(batch)})
+            if not created:
+                Conversation.objects.filter(key=key).update(**counted)
+
+        Participant.objects.bulk_create([
+            Participant(conversation_id=key, user_id=user_id, peer_id=peer_id)
+            for user_id, peer_id in _members(key, batch).items()
+        ], ignore_conflicts=True)
+
+        if summary['is_dm']:
+            sent = Counter(message.sender_id for message in batch)
+            Participant.objects.filter(conversation_id=key).update(unread_count=F('unread_count') + Case(
+                *[When(user_id=user_id, then=Value(len(batch) - count)) for user_id, count in sent.items()],
+                default=Value(len(batch)),
+                output_field=IntegerField(),
+            ))
+        else:
+            _mark_own_messages_read(key, batch)
+
+
+def _mark_own_messages_read(room, batch):
+    """
+    Moves each sender's watermark for `room` past their own last message in
+    `batch`, with the room's message count as of that message as its snapshot.
+    """
+    own_last = {message.sender_id: position for position, message in enumerate(batch)}
+    ReadWatermark.objects.bulk_create([
+        ReadWatermark(user_id=user_id, conversation=room, last_read_message_id=batch[position].id)
+        for user_id, position in own_last.items()
+    ], ignore_conflicts=True)
+    room_count = Conversation.objects.filter(key=room).values('message_count')
+    ReadWatermark.objects.filter(conversation=room, user_id__in=own_last).update(
+        last_read_message_id=Greatest(F('last_read_message_id'), Case(
+            *[When(user_id=user_id, then=Value(batch[position].id)) for user_id, position in own_last.items()],
+            output_field=BigIntegerField(),
+        )),
+        # Messages after a sender's own in this batch are still unread to them.
+        read_count=Greatest(F('read_count'), Subquery(room_count) - Case(
+            *[When(user_id=user_id, then=Value(len(batch) - 1 - position)) for user_id, position in own_last.items()],
+            output_field=BigIntegerField(),
+        )),
+    )
+
+
+def refresh_unread_count(user, conversation, last_read_message_id):
+    """Recounts a participant's unread messages after their read watermark moved."""
+    unread = (ChatMessage.objects
+              .filter(conversation=OuterRef('conversation_id'), id__gt=last_read_message_id)
+              .exclude(sender=user)
+              .values('conversation')
+              .annotate(unread=Count('id'))
+              .values('unread'))
+    Participant.objects.filter(user=user, conversation_id=conversation).update(
+        unread_count=Coalesce(Subquery(unread), Value(0)),
+    )
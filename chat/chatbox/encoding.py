@@ -0,0 +1,27 @@
+# chatbox/encoding.py
+"""
+Client frames are encoded once, by whoever publishes them, and travel through
+the channel layer as a ready-made string under 'frame'. Receiving consumers
+forward it with forward_frame() untouched, so a broadcast to a room of N
+members costs one encode instead of N.
+
+orjson is used when it is installed; the stdlib json module otherwise.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+
+def encode_frame(payload):
+    """Encodes a client frame (a dict with a 'type') to the text sent on the socket."""
+    if orjson is not None:
+        return orjson.dumps(payload, default=str).decode()
+    return json.dumps(payload, default=str)
+
+
+def frame_event(handler_type, payload):
+    """A channel layer event carrying `payload` pre-encoded for handler `handler_type`."""
+    return {'type': handler_type, 'frame': encode_frame(payload)}
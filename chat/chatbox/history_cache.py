@@ -0,0 +1,196 @@
+# chatbox/history_cache.py
+"""
+Write-through cache of the newest messages of each conversation.
+
+`chat_history:{conversation}` is a Redis LIST of serialized messages, newest
+first, holding exactly the newest HISTORY_CACHE_SIZE messages (or all of them
+for a shorter conversation). It is only ever filled from the database on a
+miss and then kept current by every write path, so a hit can be served as the
+first history page without touching the database.
+
+Every new message bumps `chat_history:{conversation}:version` after the
+database commit. A refill only lands if the version is unchanged since the
+reader started its database query, so a refill racing a write can't install a
+page that is missing the new message. The other way round, a refill that read
+the new message lands before its push; pushes go in by message id, so it isn't
+listed twice. Write-behind messages are pushed before their insert, so they
+also count in `chat_history:{conversation}:pending` until asettle() runs
+after the commit: no refill lands while any are pending, and settling bumps
+the version again. Read receipts don't touch the cache at
+all: read state is applied from the watermarks when a page is served (see
+chatbox.read_state).
+
+A conversation's keys live on its shard (chatbox.sharding).
+"""
+import json
+import logging
+
+from django.conf import settings
+
+from .redis_pool import get_redis, get_sync_redis, get_sync_shard_clients
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'chat_history:stats'  # hash with 'hits' and 'misses' counters, one per shard
+
+# Seconds a pending count outlives its last write-behind push. If it expires
+# before the flush (a worker died, the database was down), settling drops the
+# window instead, as a refill may have landed without those messages.
+PENDING_TTL = 5 * 60
+
+# KEYS: list, version, pending  ARGV: message json, size, ttl, pending ('1' for write-behind), pending ttl, id
+# A refill that read the database after the insert may already hold the
+# message, so it goes in by id: skipped if present, else placed before the
+# first older one. Normally that is the head, and only one entry is decoded.
+PUSH_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if ARGV[4] == '1' then
+    redis.call('INCR', KEYS[3])
+    redis.call('EXPIRE', KEYS[3], ARGV[5])
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local id = tonumber(ARGV[6])
+local window = redis.call('LRANGE', KEYS[1], 0, -1)
+local older = nil
+for i, raw in ipairs(window) do
+    local entry_id = tonumber(cjson.decode(raw)['id'])
+    if entry_id == id then
+        return 0
+    end
+    if entry_id < id then
+        older = i
+        break
+    end
+end
+if older == 1 then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+elseif older then
+    redis.call('LINSERT', KEYS[1], 'BEFORE', window[older], ARGV[1])
+elseif #window < tonumber(ARGV[2]) then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# KEYS: list, version, stats  ARGV: count
+READ_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+local result = {redis.call('GET', KEYS[2]) or '0', redis.call('LLEN', KEYS[1])}
+if #items > 0 then
+    redis.call('HINCRBY', KEYS[3], 'hits', 1)
+    for _, raw in ipairs(items) do table.insert(result, raw) end
+else
+    redis.call('HINCRBY', KEYS[3], 'misses', 1)
+end
+return result
+"""
+
+# KEYS: list, version, pending  ARGV: expected version, ttl, message json (newest first)...
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] or tonumber(redis.call('GET', KEYS[3]) or '0') > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: list, version, pending  ARGV: committed count, ttl
+SETTLE_SCRIPT = """
+local pending = tonumber(redis.call('GET', KEYS[3]) or '0')
+if pending > tonumber(ARGV[1]) then
+    redis.call('DECRBY', KEYS[3], ARGV[1])
+else
+    redis.call('DEL', KEYS[3])
+    if pending < tonumber(ARGV[1]) then
+        redis.call('DEL', KEYS[1])
+    end
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+"""
+
+
+def cache_size():
+    return getattr(settings, 'HISTORY_CACHE_SIZE', 50)
+
+
+def cache_ttl():
+    return getattr(settings, 'HISTORY_CACHE_TTL', 60 * 60 * 24)
+
+
+def cache_key(conversation):
+    return f'chat_history:{conversation}'
+
+
+def version_key(conversation):
+    return f'chat_history:{conversation}:version'
+
+
+def pending_key(conversation):
+    return f'chat_history:{conversation}:pending'
+
+
+def _keys(conversation):
+    return [cache_key(conversation), version_key(conversation), pending_key(conversation)]
+
+
+# --- blocking API (REST views) ---
+
+def read(conversation, count):
+    """
+    Returns (version, cached length, messages) for the newest `count` cached
+    messages. On a miss messages is empty and version is what must be passed
+    to fill().
+    """
+    script = get_sync_redis(conversation).register_script(READ_SCRIPT)
+    result = script(keys=[cache_key(conversation), version_key(conversation), STATS_KEY], args=[count])
+    return result[0], int(result[1]), [json.loads(raw) for raw in result[2:]]
+
+
+def fill(conversation, version, messages):
+    """Installs `messages` (newest first, at most cache_size()) unless the version moved."""
+    if not messages:
+        return False
+    script = get_sync_redis(conversation).register_script(FILL_SCRIPT)
+    args = [version, cache_ttl()] + [json.dumps(message) for message in messages]
+    return bool(script(keys=_keys(conversation), args=args))
+
+
+def push(conversation, message):
+    script = get_sync_redis(conversation).register_script(PUSH_SCRIPT)
+    script(keys=_keys(conversation),
+           args=[json.dumps(message), cache_size(), cache_ttl(), '0', PENDING_TTL, message['id']])
+
+
+def stats():
+    totals = {'hits': 0, 'misses': 0}
+    for redis_conn in get_sync_shard_clients():
+        counters = redis_conn.hgetall(STATS_KEY)
+        for name in totals:
+            totals[name] += int(counters.get(name, 0))
+    return totals
+
+
+# --- async API (consumers) ---
+
+async def apush(conversation, message, pending=False):
+    """Pushes a new message; pending=True for one that isn't inserted yet (write-behind)."""
+    script = get_redis(conversation).register_script(PUSH_SCRIPT)
+    await script(keys=_keys(conversation),
+                 args=[json.dumps(message), cache_size(), cache_ttl(), '1' if pending else '0', PENDING_TTL,
+                       message['id']])
+
+
+async def asettle(counts):
+    """Marks {conversation: number of messages} pushed as pending as committed."""
+    for conversation, count in counts.items():
+        script = get_redis(conversation).register_script(SETTLE_SCRIPT)
+        await script(keys=_keys(conversation), args=[count, cache_ttl()])
+
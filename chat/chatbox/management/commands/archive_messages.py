@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbox import archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages older than --days (default ARCHIVE_AFTER_DAYS) out of the message table into "
+        "the compressed per-conversation, per-month archive segments under ARCHIVE_ROOT."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'ARCHIVE_AFTER_DAYS', 0))
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'ARCHIVE_BATCH_SIZE', 1000))
+
+    def handle(self, *args, **options):
+        if options['days'] <= 0:
+            raise CommandError("Pass --days N or set ARCHIVE_AFTER_DAYS.")
+        moved = archive.archive_old_messages(options['days'], options['batch_size'])
+        if moved is None:
+            raise CommandError("Another archiver is running.")
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} messages older than {options['days']} days."))
@@ -0,0 +1,310 @@
+import asyncio
+import importlib
+import json
+import os
+import pkgutil
+import platform
+import random
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.utils import timezone
+
+User = get_user_model()
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 1000},
+    },
+}
+
+
+class QueryCounter:
+    """
+    execute_wrapper that counts statements on every connection it is installed
+    on, and the most that were running at the same time.
+    """
+    def __init__(self):
+        self.count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def start_fake_redis():
+    """Starts an in-process fakeredis server on a free port and returns its URL."""
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        raise CommandError("--fake-redis needs the fakeredis package (pip install fakeredis lupa).")
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'redis://127.0.0.1:{port}/0?protocol=2', server
+
+
+def preload_lua_scripts():
+    """SCRIPT LOADs every *_SCRIPT of the chatbox modules on every node so timings don't include the first EVAL."""
+    from chatbox import __path__ as chatbox_path
+    from chatbox.redis_pool import get_sync_redis, get_sync_shard_clients
+
+    redis_conns = [get_sync_redis(), *get_sync_shard_clients()]
+    for module_info in pkgutil.iter_modules(chatbox_path):
+        try:
+            module = importlib.import_module(f'chatbox.{module_info.name}')
+        except ImportError:
+            continue
+        for name in dir(module):
+            if name.endswith('_SCRIPT'):
+                for redis_conn in redis_conns:
+                    redis_conn.script_load(getattr(module, name))
+
+
+class Command(BaseCommand):
+    help = (
+        "In-process WebSocket load test: N users in M rooms exchange chat, typing and read "
+        "receipt frames through chat.asgi.application on the in-memory channel layer. Reports "
+        "throughput, broadcast latency percentiles, DB queries and memory per connection, and "
+        "writes them to a JSON file. Runs against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--messages', type=int, default=10, help="Chat messages sent by each user.")
+        parser.add_argument('--interval', type=float, default=0.05, help="Seconds between a user's messages.")
+        parser.add_argument('--typing-ratio', type=float, default=0.5,
+                            help="Share of messages preceded by a start_typing frame.")
+        parser.add_argument('--receipt-ratio', type=float, default=0.5,
+                            help="Share of messages followed by a mark_read of the newest message seen.")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for all deliveries.")
+        parser.add_argument('--fake-redis', action='store_true',
+                            help="Use an in-process fakeredis server instead of REDIS_URL.")
+        parser.add_argument('--db-threads', type=int, metavar='N',
+                            help="Override CONSUMER_DB_THREADS (0 runs every query on the shared thread).")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Results file (default: chat-benchmark-<timestamp>.json).")
+
+    def handle(self, *args, **options):
+        try:
+            from channels.testing import WebsocketCommunicator  # noqa: F401 (needs daphne)
+        except ImportError as e:
+            raise CommandError(f"channels.testing is unavailable ({e}); install daphne.")
+
+        redis_url, fake_server = settings.REDIS_URL, None
+        if options['fake_redis']:
+            redis_url, fake_server = start_fake_redis()
+
+        db_threads = options['db_threads']
+        if db_threads is None:
+            db_threads = getattr(settings, 'CONSUMER_DB_THREADS', 8)
+        test_db_dir = None
+        if db_threads and connection.vendor == 'sqlite':
+            # The default in-memory SQLite test database keeps chatbox.async_db on
+            # the shared thread; use a file so the DB threads are exercised.
+            test_db_dir = tempfile.TemporaryDirectory()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(test_db_dir.name, 'benchmark.sqlite3')
+
+        # Queries run on the shared sync_to_async thread and on the chatbox.async_db
+        # threads; counting on every connection as it is created sees them all.
+        counter = QueryCounter()
+        for conn in connections.all():
+            counter.install(connection=conn)
+        connection_created.connect(counter.install)
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, REDIS_URL=redis_url,
+                                   REDIS_SHARD_URLS=[] if fake_server else getattr(settings, 'REDIS_SHARD_URLS', []),
+                                   CONSUMER_DB_THREADS=db_threads):
+                preload_lua_scripts()
+                results = async_to_sync(self.run_benchmark)(options, counter)
+        finally:
+            connection_created.disconnect(counter.install)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if test_db_dir is not None:
+                test_db_dir.cleanup()
+            if fake_server is not None:
+                fake_server.shutdown()
+
+        report = {
+            'config': {key: options[key] for key in (
+                'users', 'rooms', 'messages', 'interval', 'typing_ratio', 'receipt_ratio', 'seed')},
+            'db_threads': db_threads,
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'redis': 'fakeredis' if fake_server is not None else redis_url,
+                'persistence_mode': getattr(settings, 'CHAT_PERSISTENCE_MODE', 'sync'),
+                'started_at': results.pop('started_at'),
+            },
+            'results': results,
+        }
+        output = options['output'] or f"chat-benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        latency = results['broadcast_latency_ms']
+        self.stdout.write(
+            f"{results['messages_sent']} messages, {results['deliveries']}/{results['expected_deliveries']} "
+            f"deliveries in {results['duration_s']:.2f}s: {results['messages_per_s']:.1f} msg/s, "
+            f"{results['deliveries_per_s']:.1f} deliveries/s\n"
+            f"latency p50 {latency['p50']} ms, p90 {latency['p90']} ms, p99 {latency['p99']} ms, max {latency['max']} ms\n"
+            f"{results['db_queries']} DB queries ({results['db_queries_per_message']:.2f}/message, "
+            f"up to {results['db_max_concurrent_queries']} at once), "
+            f"{results['memory_per_connection_bytes']} bytes/connection"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+
+    async def run_benchmark(self, options, counter):
+        from channels.db import database_sync_to_async
+        from channels.testing import WebsocketCommunicator
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        from chat.asgi import application
+        from chatbox import persistence, presence
+        from chatbox.redis_pool import close_redis
+
+        rng = random.Random(options['seed'])
+        n_users, n_rooms = options['users'], max(1, options['rooms'])
+        started_at = timezone.now().isoformat()
+
+        def create_users():
+            run_id = uuid.uuid4().hex[:8]
+            User.objects.bulk_create([User(username=f'bench_{run_id}_{i}') for i in range(n_users)])
+            users = list(User.objects.filter(username__startswith=f'bench_{run_id}_').order_by('id'))
+            return [(user, str(AccessToken.for_user(user))) for user in users]
+
+        users = await database_sync_to_async(create_users)()
+        room_of = [f'bench_room_{i % n_rooms}' for i in range(n_users)]
+        members = {room: room_of.count(room) for room in set(room_of)}
+
+        # --- connect, measuring what each open socket costs ---
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        communicators = []
+        for (user, token), room in zip(users, room_of):
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{room}/?token={token}')
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError(f"User {user.username} could not connect to {room}.")
+            communicators.append(communicator)
+        await asyncio.sleep(0.5)
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory_before) // n_users
+        tracemalloc.stop()
+
+        # --- traffic ---
+        sent_at = {}
+        latencies = []
+        frame_counts = {}
+        last_seen = [0] * n_users
+        expected = sum(members[room] for room in room_of) * options['messages']
+        delivered = 0
+        all_delivered = asyncio.Event()
+        queries_before = counter.count
+        counter.max_in_flight = 0
+
+        async def read_frames(index, communicator):
+            nonlocal delivered
+            while True:
+                frame = json.loads(await communicator.receive_from(timeout=3600))
+                frame_counts[frame['type']] = frame_counts.get(frame['type'], 0) + 1
+                if frame['type'] == 'chat_message' and frame.get('message') in sent_at:
+                    latencies.append(time.perf_counter() - sent_at[frame['message']])
+                    last_seen[index] = max(last_seen[index], frame['id'])
+                    delivered += 1
+                    if delivered >= expected:
+                        all_delivered.set()
+
+        async def send_frames(index, communicator):
+            for _ in range(options['messages']):
+                if rng.random() < options['typing_ratio']:
+                    await communicator.send_json_to({'type': 'start_typing'})
+                text = f'bench {uuid.uuid4().hex}'
+                sent_at[text] = time.perf_counter()
+                await communicator.send_json_to({'type': 'chat_message', 'message': text})
+                await asyncio.sleep(options['interval'])
+                if last_seen[index] and rng.random() < options['receipt_ratio']:
+                    await communicator.send_json_to({'type': 'mark_read', 'last_read_id': last_seen[index]})
+            await communicator.send_json_to({'type': 'stop_typing'})
+
+        readers = [asyncio.ensure_future(read_frames(i, c)) for i, c in enumerate(communicators)]
+        start = time.perf_counter()
+        await asyncio.gather(*(send_frames(i, c) for i, c in enumerate(communicators)))
+        try:
+            await asyncio.wait_for(all_delivered.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            self.stderr.write(f"Timed out with {delivered}/{expected} deliveries.")
+        duration = time.perf_counter() - start
+
+        buffer = persistence._buffers.get(asyncio.get_running_loop())
+        if buffer is not None:
+            await buffer.flush()
+        db_queries = counter.count - queries_before
+
+        for reader in readers:
+            reader.cancel()
+        for communicator in communicators:
+            await communicator.disconnect()
+        await presence.shutdown()
+        await close_redis()
+
+        latencies.sort()
+        messages_sent = len(sent_at)
+        return {
+            'started_at': started_at,
+            'connections': n_users,
+            'messages_sent': messages_sent,
+            'expected_deliveries': expected,
+            'deliveries': delivered,
+            'duration_s': round(duration, 3),
+            'messages_per_s': round(messages_sent / duration, 1),
+            'deliveries_per_s': round(delivered / duration, 1),
+            'broadcast_latency_ms': {
+                name: round(percentile(latencies, pct) * 1000, 2) if latencies else None
+                for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))
+            },
+            'db_queries': db_queries,
+            'db_queries_per_message': round(db_queries / messages_sent, 2) if messages_sent else 0,
+            'db_max_concurrent_queries': counter.max_in_flight,
+            'memory_per_connection_bytes': memory_per_connection,
+            'frames_received': frame_counts,
+        }
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from chatbox import blobs
+from chatbox.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = "Moves legacy base64 ChatMessage.image_content into the blob store and clears the column."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        moved = failed = 0
+        last_id = 0
+        while True:
+            batch = list(
+                ChatMessage.objects.filter(id__gt=last_id, image_content__isnull=False)
+                .exclude(image_content='')
+                .order_by('id')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            for message in batch:
+                last_id = message.id
+                try:
+                    message.image = blobs.store_image(
+                        blobs.decode_data_url(message.image_content), uploaded_by=message.sender
+                    )
+                except blobs.InvalidImage as e:
+                    failed += 1
+                    self.stderr.write(f"Message {message.id}: {e}")
+                    continue
+                message.image_content = None
+                message.save(update_fields=['image', 'image_content'])
+                moved += 1
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved} images ({failed} failed)."))
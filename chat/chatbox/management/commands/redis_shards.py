@@ -0,0 +1,80 @@
+import statistics
+import uuid
+
+from channels_redis.utils import _consistent_hash
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chatbox.management.commands.chat_benchmark import preload_lua_scripts, start_fake_redis
+
+
+class Command(BaseCommand):
+    help = (
+        "Places rooms on the Redis shards and reports how evenly they spread. Writes each room's "
+        "presence set and history cache version through the normal code paths, then counts the "
+        "keys on every node, checks that the channel layer puts each room's group on the same "
+        "node, and shows how many rooms would move if one more node were added."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10000)
+        parser.add_argument('--fake-redis', type=int, default=0, metavar='N',
+                            help="Start N in-process fakeredis servers instead of using REDIS_SHARD_URLS.")
+
+    def handle(self, *args, **options):
+        urls = list(getattr(settings, 'REDIS_SHARD_URLS', None) or [])
+        fake_servers = []
+        if options['fake_redis']:
+            urls = []
+            for _ in range(options['fake_redis']):
+                url, server = start_fake_redis()
+                urls.append(url)
+                fake_servers.append(server)
+        try:
+            if len(urls) < 2:
+                raise CommandError("Needs at least two nodes: set REDIS_SHARD_URLS or pass --fake-redis N.")
+            with override_settings(REDIS_URL=urls[0], REDIS_SHARD_URLS=urls):
+                preload_lua_scripts()
+                self.report(urls, options['rooms'])
+        finally:
+            for server in fake_servers:
+                server.shutdown()
+
+    def report(self, urls, room_count):
+        from chatbox import history_cache, presence
+        from chatbox.redis_pool import get_sync_redis, get_sync_shard_clients, shard_url
+        from chatbox.sharding import HashRing, ShardedRedisChannelLayer, get_ring
+
+        run = uuid.uuid4().hex[:8]
+        rooms = [f'shardtest_{run}_{i}' for i in range(room_count)]
+        for room in rooms:
+            get_sync_redis(room).zadd(presence.room_members_key(room), {'shard-demo': 1})
+            history_cache.push(room, {'id': 1, 'message': 'shard demo'})
+
+        clients = get_sync_shard_clients()
+        counts = [len(list(client.scan_iter(match=f'*shardtest_{run}_*', count=1000))) // 2 for client in clients]
+        mean = statistics.mean(counts)
+        self.stdout.write(f"{room_count} rooms on {len(urls)} nodes:")
+        for url, count in zip(urls, counts):
+            self.stdout.write(f"  {url}: {count} rooms ({count / room_count:.1%})")
+        self.stdout.write(f"  max/mean {max(counts) / mean:.3f}, stdev {statistics.pstdev(counts) / mean:.1%} of mean")
+
+        layer = ShardedRedisChannelLayer(hosts=urls)
+        misplaced = sum(1 for room in rooms if urls[layer.consistent_hash(f'chat_{room}')] != shard_url(room))
+        self.stdout.write(f"Channel layer groups on a different node than their room's keys: {misplaced}")
+
+        ring = get_ring(urls)
+        grown = HashRing([*urls, 'redis://new-node'], getattr(settings, 'REDIS_SHARD_VNODES', 160))
+        moved = sum(1 for room in rooms if ring.node_for(room) != grown.node_for(room))
+        crc_moved = sum(1 for group in (f'chat_{room}' for room in rooms)
+                        if _consistent_hash(group, len(urls)) != _consistent_hash(group, len(urls) + 1))
+        self.stdout.write(
+            f"Adding a node would move {moved / room_count:.1%} of the rooms "
+            f"(ideal {1 / (len(urls) + 1):.1%}; channels_redis crc32 buckets: {crc_moved / room_count:.1%})."
+        )
+
+        for client in clients:
+            keys = list(client.scan_iter(match=f'*shardtest_{run}_*', count=1000))
+            if keys:
+                client.delete(*keys)
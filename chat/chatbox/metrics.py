@@ -0,0 +1,245 @@
+# chatbox/metrics.py
+"""
+A small in-process metrics registry, rendered in the Prometheus text format
+at /api/metrics/.
+
+Recording is a dict lookup, a bisect and a few integer additions under a
+lock, so it stays on under full load. Every worker process keeps its own
+registry; scrape each worker, or sum across them in Prometheus.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.db import connection
+
+# Seconds; tuned for in-process work from sub-millisecond to a few seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        # Unlabelled metrics record on their single child directly.
+        return self.labels()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [('le', _format_value(float(bound)))])
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = _format_labels(self.labelnames, values)
+        yield f'{self.name}_sum{labels} {_format_value(total)}'
+        yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+WS_EVENT_SECONDS = REGISTRY.register(Histogram(
+    'chat_ws_event_seconds', 'Time spent handling one incoming WebSocket frame, by frame type.', ['event_type']))
+WS_ACTIVE_SOCKETS = REGISTRY.register(Gauge(
+    'chat_ws_active_sockets', 'Accepted WebSocket connections currently open, by consumer.', ['consumer']))
+WS_FRAMES_DROPPED = REGISTRY.register(Counter(
+    'chat_ws_frames_dropped_total', 'Frames dropped instead of handled or delivered, by reason.', ['reason']))
+WS_OUTBOUND_QUEUED_FRAMES = REGISTRY.register(Gauge(
+    'chat_ws_outbound_queued_frames', 'Frames waiting in socket outbound queues, by consumer.', ['consumer']))
+WS_OUTBOUND_QUEUE_DEPTH = REGISTRY.register(Histogram(
+    'chat_ws_outbound_queue_depth', 'Frames already waiting in a socket queue when another one is sent to it.',
+    ['consumer'], buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)))
+WS_SLOW_CONSUMER_DISCONNECTS = REGISTRY.register(Counter(
+    'chat_ws_slow_consumer_disconnects_total', 'Sockets closed for falling too far behind, by consumer.',
+    ['consumer']))
+CHANNEL_LAYER_SEND_SECONDS = REGISTRY.register(Histogram(
+    'chat_channel_layer_send_seconds', 'Latency of channel layer group_send calls, by event.', ['event']))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'chat_http_request_seconds', 'Time to handle an HTTP request, by URL name.', ['view']))
+HTTP_REQUEST_DB_SECONDS = REGISTRY.register(Histogram(
+    'chat_http_request_db_seconds', 'Database time spent within one HTTP request, by URL name.', ['view']))
+HISTORY_CACHE_REQUESTS = REGISTRY.register(Counter(
+    'chat_history_cache_requests_total', 'First-page history requests, by cache result (hit/miss).', ['result']))
+RESUME_REPLAYS = REGISTRY.register(Counter(
+    'chat_resume_replays_total', 'Socket resumes, by where the missed messages came from (log/database/truncated).',
+    ['source']))
+ARCHIVED_MESSAGES = REGISTRY.register(Counter(
+    'chat_archived_messages_total', 'Messages moved from the message table into archive segments.'))
+ARCHIVE_SEGMENT_READS = REGISTRY.register(Counter(
+    'chat_archive_segment_reads_total', 'Archive segments read for history, by whether they were already decoded.',
+    ['result']))
+SQLITE_WRITER_BATCH_SIZE = REGISTRY.register(Histogram(
+    'chat_sqlite_writer_batch_size', 'Writes committed together by the SQLite writer in one transaction.',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 200, 500)))
+
+
+@contextmanager
+def time_group_send(message):
+    """Times a group_send of `message`, labelled with its handler type."""
+    with CHANNEL_LAYER_SEND_SECONDS.labels(message['type']).time():
+        yield
+
+
+class _DBTimer:
+    def __init__(self):
+        self.total = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.total += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """Records each HTTP request's duration and the database time spent in it."""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        db_timer = _DBTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(db_timer):
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None and match.url_name else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(view).observe(time.perf_counter() - start)
+        HTTP_REQUEST_DB_SECONDS.labels(view).observe(db_timer.total)
+        return response
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:25
+
+from django.db import migrations, models
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Cast, Coalesce, Concat
+
+
+def backfill_conversation(apps, schema_editor):
+    """Fill ChatMessage.conversation for existing rows with two set-based UPDATEs."""
+    ChatMessage = apps.get_model('chatbox', 'ChatMessage')
+
+    sender_is_low = When(sender_id__lt=F('receiver_id'), then=F('sender_id'))
+    receiver_is_high = When(sender_id__lt=F('receiver_id'), then=F('receiver_id'))
+    low_id = Case(sender_is_low, default=F('receiver_id'))
+    high_id = Case(receiver_is_high, default=F('sender_id'))
+
+    ChatMessage.objects.filter(is_dm=True, receiver__isnull=False).update(
+        conversation=Concat(
+            Value('dm_'), Cast(low_id, models.CharField()),
+            Value('_'), Cast(high_id, models.CharField()),
+            output_field=models.CharField(),
+        )
+    )
+    ChatMessage.objects.filter(conversation='').exclude(is_dm=True, receiver__isnull=False).update(
+        conversation=Coalesce(F('room_name'), Value(''))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbox', '0003_chatmessage_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversation, migrations.RunPython.noop),
+    ]
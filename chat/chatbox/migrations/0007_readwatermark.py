@@ -0,0 +1,47 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_watermarks(apps, schema_editor):
+    """One watermark per (receiver, conversation) at the newest message already marked read."""
+    ChatMessage = apps.get_model('chatbox', 'ChatMessage')
+    ReadWatermark = apps.get_model('chatbox', 'ReadWatermark')
+
+    rows = (ChatMessage.objects.filter(is_read=True, receiver__isnull=False)
+            .values('receiver_id', 'conversation')
+            .annotate(last_read=Max('id')))
+    ReadWatermark.objects.bulk_create(
+        [ReadWatermark(user_id=row['receiver_id'], conversation=row['conversation'],
+                       last_read_message_id=row['last_read']) for row in rows.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbox', '0006_chatmessage_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation', models.CharField(max_length=255)),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation'], name='readwatermark_conv_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'conversation'), name='readwatermark_user_conv_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def _peer_id(key, user_id):
+    low, high = (int(part) for part in key.split('_')[1:3])
+    return high if user_id == low else low
+
+
+def backfill_summaries(apps, schema_editor):
+    """Builds Conversation and Participant rows for the existing history."""
+    ChatMessage = apps.get_model('chatbox', 'ChatMessage')
+    Conversation = apps.get_model('chatbox', 'Conversation')
+    Participant = apps.get_model('chatbox', 'Participant')
+    ReadWatermark = apps.get_model('chatbox', 'ReadWatermark')
+
+    last_ids = ChatMessage.objects.exclude(conversation='').values('conversation').annotate(last_id=Max('id')).values('last_id')
+    last_activity = {}
+    conversations = []
+    for message in ChatMessage.objects.filter(id__in=last_ids).iterator():
+        preview = (message.message or '')[:100] or ('[image]' if message.image_id or message.image_content else '')
+        last_activity[message.conversation] = message.timestamp
+        conversations.append(Conversation(
+            key=message.conversation, is_dm=message.conversation.startswith('dm_'),
+            last_message_id=message.id, last_message_preview=preview,
+            last_sender_id=message.sender_id, last_activity=message.timestamp,
+        ))
+    Conversation.objects.bulk_create(conversations, batch_size=1000)
+
+    members = set(ChatMessage.objects.exclude(conversation='').values_list('conversation', 'sender_id').distinct())
+    members |= set(ChatMessage.objects.filter(conversation__startswith='dm_', receiver__isnull=False)
+                   .values_list('conversation', 'receiver_id').distinct())
+    Participant.objects.bulk_create([
+        Participant(
+            conversation_id=key, user_id=user_id, last_activity=last_activity[key],
+            peer_id=_peer_id(key, user_id) if key.startswith('dm_') else None,
+        )
+        for key, user_id in members
+    ], batch_size=1000, ignore_conflicts=True)
+
+    watermark = ReadWatermark.objects.filter(
+        user_id=OuterRef(OuterRef('user_id')), conversation=OuterRef(OuterRef('conversation_id')),
+    ).values('last_read_message_id')[:1]
+    unread = (ChatMessage.objects
+              .filter(conversation=OuterRef('conversation_id'))
+              .exclude(sender_id=OuterRef('user_id'))
+              .filter(id__gt=Coalesce(Subquery(watermark), Value(0)))
+              .values('conversation')
+              .annotate(unread=Count('id'))
+              .values('unread'))
+    Participant.objects.update(unread_count=Coalesce(Subquery(unread), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbox', '0007_readwatermark'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('key', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('is_dm', models.BooleanField(default=False)),
+                ('last_message_id', models.BigIntegerField(default=0)),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=100)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Participant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='chatbox.conversation')),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity', '-id'], name='participant_user_recent_idx')],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'user'), name='participant_conv_user_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
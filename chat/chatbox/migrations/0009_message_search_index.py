@@ -0,0 +1,73 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:05
+
+from django.db import DatabaseError, migrations
+
+FTS_TABLE = 'chatbox_chatmessage_fts'
+INDEX_NAME = 'chatmsg_message_fts_idx'
+
+# Keep the external content FTS5 table in step with every write to the message
+# table, whichever code path (or raw SQL) makes it. An external content table
+# must be told exactly what it indexed when a row goes, so only triggers that
+# also did the indexing may send it 'delete'.
+FTS_TRIGGERS = {
+    'chatbox_chatmessage_fts_ai': f"""
+        CREATE TRIGGER chatbox_chatmessage_fts_ai AFTER INSERT ON chatbox_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, message) VALUES (new.id, new.message);
+        END""",
+    'chatbox_chatmessage_fts_ad': f"""
+        CREATE TRIGGER chatbox_chatmessage_fts_ad AFTER DELETE ON chatbox_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+        END""",
+    'chatbox_chatmessage_fts_au': f"""
+        CREATE TRIGGER chatbox_chatmessage_fts_au AFTER UPDATE OF message ON chatbox_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO {FTS_TABLE} (rowid, message) VALUES (new.id, new.message);
+        END""",
+}
+
+
+def create_search_index(apps, schema_editor):
+    """The backend's own text index over ChatMessage.message (see chatbox.search)."""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(message, content='chatbox_chatmessage', "
+                f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+            )
+        except DatabaseError:
+            # SQLite built without FTS5: search falls back to LIKE.
+            return
+        schema_editor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+        for trigger in FTS_TRIGGERS.values():
+            schema_editor.execute(trigger)
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE INDEX {INDEX_NAME} ON chatbox_chatmessage "
+            f"USING GIN (to_tsvector('simple', coalesce(message, '')))"
+        )
+    elif vendor == 'mysql':
+        schema_editor.execute(f'CREATE FULLTEXT INDEX {INDEX_NAME} ON chatbox_chatmessage (message)')
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for name in FTS_TRIGGERS:
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    elif vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {INDEX_NAME}')
+    elif vendor == 'mysql':
+        schema_editor.execute(f'DROP INDEX {INDEX_NAME} ON chatbox_chatmessage')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbox', '0008_conversation_participant'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.1.7 on 2026-10-18 22:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_counts(apps, schema_editor):
+    """Counts each conversation's messages, and how many of them each watermark covers."""
+    ChatMessage = apps.get_model('chatbox', 'ChatMessage')
+    Conversation = apps.get_model('chatbox', 'Conversation')
+    ReadWatermark = apps.get_model('chatbox', 'ReadWatermark')
+
+    total = (ChatMessage.objects
+             .filter(conversation=OuterRef('key'))
+             .values('conversation')
+             .annotate(total=Count('id'))
+             .values('total'))
+    Conversation.objects.update(message_count=Coalesce(Subquery(total), Value(0)))
+
+    read = (ChatMessage.objects
+            .filter(conversation=OuterRef('conversation'), id__lte=OuterRef('last_read_message_id'))
+            .values('conversation')
+            .annotate(read=Count('id'))
+            .values('read'))
+    ReadWatermark.objects.update(read_count=Coalesce(Subquery(read), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbox', '0010_archivesegment'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='participant',
+            name='participant_user_recent_idx',
+        ),
+        migrations.RemoveField(
+            model_name='participant',
+            name='last_activity',
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='readwatermark',
+            name='read_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
@@ -1,21 +1,160 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
+
+def dm_conversation_key(user_a_id, user_b_id):
+    """DM conversation key, 'dm_<low id>_<high id>' (ids compared numerically, as the frontend does)."""
+    low, high = sorted([int(user_a_id), int(user_b_id)])
+    return f'dm_{low}_{high}'
+
+
+class ImageBlob(models.Model):
+    """An image in the content-addressed store (see chatbox.blobs); the key is the SHA-256 of its bytes."""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    content_type = models.CharField(max_length=50)
+    size = models.PositiveIntegerField()
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    thumbnail_width = models.PositiveIntegerField()
+    thumbnail_height = models.PositiveIntegerField()
+    uploaded_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='uploaded_images', null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.sha256} ({self.width}x{self.height})'
+
+
 class ChatMessage(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     message = models.TextField(blank=True, null=True)
-    image_content = models.TextField(blank=True, null=True)  # Base64 encoded image
+    image_content = models.TextField(blank=True, null=True)  # Legacy inline base64 image; new images use `image`
+    image = models.ForeignKey(ImageBlob, on_delete=models.SET_NULL, related_name='messages', null=True, blank=True)
     message_type = models.CharField(max_length=10, default='text')  
     room_name = models.CharField(max_length=255, blank=True, null=True)
+    # Denormalized conversation key: the room name for public rooms, dm_<a>_<b> for DMs.
+    # Lets history for either kind be a single range scan on one index.
+    conversation = models.CharField(max_length=255, blank=True, default='')
     is_dm = models.BooleanField(default=False)
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages', null=True, blank=True)
-    is_read = models.BooleanField(default=False) 
-    timestamp = models.DateTimeField(auto_now_add=True)
+    is_read = models.BooleanField(default=False)  # Legacy; read state now lives in ReadWatermark
+    # A default rather than auto_now_add so write-behind inserts keep the time the message was broadcast with.
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['conversation', '-timestamp', '-id'], name='chatmsg_conv_ts_idx'),
+            models.Index(fields=['receiver', 'is_read'], name='chatmsg_receiver_read_idx'),
+        ]
+
+    def build_conversation_key(self):
+        if self.is_dm and self.receiver_id:
+            return dm_conversation_key(self.sender_id, self.receiver_id)
+        return self.room_name or ''
+
+    def save(self, *args, **kwargs):
+        if not self.conversation:
+            self.conversation = self.build_conversation_key()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f'{self.sender.username}: {self.message[:50] if self.message else "[image]"}'
+
+
+class ReadWatermark(models.Model):
+    """
+    How far a user has read a conversation: every message with an id up to
+    last_read_message_id counts as read. One row per user and conversation
+    replaces flipping is_read on individual messages.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_watermarks')
+    conversation = models.CharField(max_length=255)
+    last_read_message_id = models.BigIntegerField(default=0)
+    # The room's Conversation.message_count when the watermark last moved, so a
+    # public room's unread count is one subtraction (see read_state).
+    read_count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='readwatermark_user_conv_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation'], name='readwatermark_conv_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} read {self.conversation} up to {self.last_read_message_id}'
+
+
+def dm_peer_id(conversation, user_id):
+    """The other user's id in a dm_<low>_<high> key."""
+    low, high = (int(part) for part in conversation.split('_')[1:3])
+    return high if int(user_id) == low else low
+
+
+class Conversation(models.Model):
+    """
+    Summary of one conversation, kept current by every message save path (see
+    chatbox.conversations) so the chat list never has to scan messages.
+    """
+    key = models.CharField(max_length=255, primary_key=True)  # same as ChatMessage.conversation
+    is_dm = models.BooleanField(default=False)
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=100, blank=True, default='')
+    last_sender = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+    # Every message ever recorded here; public rooms derive unread counts from it.
+    message_count = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.key
+
+
+class Participant(models.Model):
+    """
+    A user's entry in their chat list: one per conversation they have sent or
+    received a message in. Recency lives on the Conversation, so a message in
+    a public room never touches its members' rows.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='participants')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_entries')
+    # The other user of a DM, so the chat list can show it without parsing keys.
+    peer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
+    # DMs only; a public room's is derived from Conversation.message_count.
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='participant_conv_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} in {self.conversation_id}'
+
+
+class ArchiveSegment(models.Model):
+    """
+    Index entry for one archive segment: a conversation's archived messages
+    from one month, in a gzipped NDJSON file under ARCHIVE_ROOT (see
+    chatbox.archive). Only the first `size` bytes of the file are committed.
+    """
+    conversation = models.CharField(max_length=255)
+    month = models.CharField(max_length=7)  # 'YYYY-MM', UTC
+    path = models.CharField(max_length=255)  # relative to ARCHIVE_ROOT
+    size = models.BigIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'month'], name='archivesegment_conv_month_uniq'),
+        ]
 
     def __str__(self):
-        return f'{self.sender.username}: {self.message[:50] if self.message else "[image]"}'
\ No newline at end of file
+        return f'{self.conversation} {self.month} ({self.message_count} messages)'
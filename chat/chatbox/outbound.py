@@ -0,0 +1,115 @@
+# chatbox/outbound.py
+"""
+Per-socket outbound queues.
+
+Channel layer handlers don't write to the socket themselves: they put the
+frame on the socket's OutboundQueue and return, and a writer task drains the
+queue in order. A client on a slow link therefore only backs up its own
+queue, never the consumer's channel (whose messages channels_redis would drop
+without a trace once it is full) or anyone else's delivery.
+
+Each frame is queued with a policy:
+
+- KEEP: always queued. Chat messages, replies and read receipts.
+- COALESCE: replaces the frame with the same key that is still waiting, so a
+  slow client only gets the newest typing list.
+- DROP: dropped once OUTBOUND_QUEUE_SOFT_LIMIT frames are waiting. Presence
+  deltas are numbered, so a client that misses one asks for a snapshot.
+
+A client with more than OUTBOUND_QUEUE_HIGH_WATER frames waiting is
+disconnected (close code 4008) rather than buffered without bound; it
+reconnects and resumes like after any other drop.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+KEEP, COALESCE, DROP = 'keep', 'coalesce', 'drop'
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+def soft_limit():
+    return getattr(settings, 'OUTBOUND_QUEUE_SOFT_LIMIT', 64)
+
+
+def high_water():
+    return getattr(settings, 'OUTBOUND_QUEUE_HIGH_WATER', 1000)
+
+
+class OutboundQueue:
+    def __init__(self, consumer, label):
+        self.consumer = consumer
+        self.label = label  # metrics label: 'chat' or 'presence'
+        self.closed = False
+        self._frames = deque()  # [key, frame] slots, oldest first
+        self._coalescing = {}  # key -> its waiting slot
+        self._writer = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, policy=KEEP, key=None):
+        """Queues an encoded frame for sending. Returns False if it was dropped."""
+        if self.closed:
+            return False
+        depth = len(self._frames)
+        metrics.WS_OUTBOUND_QUEUE_DEPTH.labels(self.label).observe(depth)
+
+        if policy == COALESCE and key in self._coalescing:
+            self._coalescing[key][1] = frame
+            metrics.WS_FRAMES_DROPPED.labels('coalesced').inc()
+            return True
+        if policy != KEEP and depth >= soft_limit():
+            metrics.WS_FRAMES_DROPPED.labels('slow_consumer').inc()
+            return False
+        if depth >= high_water():
+            self._disconnect_slow_consumer()
+            return False
+
+        slot = [key, frame]
+        self._frames.append(slot)
+        if policy == COALESCE:
+            self._coalescing[key] = slot
+        metrics.WS_OUTBOUND_QUEUED_FRAMES.labels(self.label).inc()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._drain())
+        return True
+
+    async def _drain(self):
+        while self._frames:
+            slot = self._frames.popleft()
+            key, frame = slot
+            if self._coalescing.get(key) is slot:
+                del self._coalescing[key]
+            metrics.WS_OUTBOUND_QUEUED_FRAMES.labels(self.label).dec()
+            try:
+                await self.consumer.send(text_data=frame)
+            except Exception as e:
+                metrics.WS_FRAMES_DROPPED.labels('send_failed').inc()
+                logger.error(f"Error sending queued frame on {self.label} socket: {e}")
+
+    def _disconnect_slow_consumer(self):
+        user = getattr(self.consumer, 'user', None)
+        logger.warning(f"Disconnecting slow {self.label} client {getattr(user, 'username', '?')}: "
+                       f"{len(self._frames)} frames waiting.")
+        metrics.WS_SLOW_CONSUMER_DISCONNECTS.labels(self.label).inc()
+        metrics.WS_FRAMES_DROPPED.labels('slow_consumer').inc(len(self._frames) + 1)
+        self.close()
+        asyncio.ensure_future(self.consumer.close(code=SLOW_CONSUMER_CLOSE_CODE))
+
+    def close(self):
+        """Discards whatever is still waiting and stops the writer. Called on disconnect."""
+        if self.closed:
+            return
+        self.closed = True
+        metrics.WS_OUTBOUND_QUEUED_FRAMES.labels(self.label).dec(len(self._frames))
+        self._frames.clear()
+        self._coalescing.clear()
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
@@ -0,0 +1,146 @@
+# chatbox/pagination.py
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp, id), newest first.
+
+    - no cursor:       the newest page
+    - ?before=<cursor>: the page of messages older than the cursor ('next' link)
+    - ?after=<cursor>:  the page of messages newer than the cursor ('previous' link)
+
+    No COUNT(*) and no OFFSET is issued, so every page costs the same index range
+    scan however deep the client scrolls, and pages don't shift when new messages
+    arrive.
+    """
+    page_size = api_settings.PAGE_SIZE or 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+    # (time field, tie-breaker) the pages are ordered and cursors built by
+    ordering_fields = ('timestamp', 'id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        time_field, id_field = self.ordering_fields
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if after is not None:
+            timestamp, pk = after
+            queryset = queryset.filter(
+                Q(**{f'{time_field}__gt': timestamp}) | Q(**{time_field: timestamp, f'{id_field}__gt': pk})
+            ).order_by(time_field, id_field)
+        else:
+            if before is not None:
+                timestamp, pk = before
+                queryset = queryset.filter(
+                    Q(**{f'{time_field}__lt': timestamp}) | Q(**{time_field: timestamp, f'{id_field}__lt': pk})
+                )
+            queryset = queryset.order_by(f'-{time_field}', f'-{id_field}')
+
+        # Fetch one extra row to learn whether another page exists.
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        if after is not None:
+            rows.reverse()
+            self.has_newer, self.has_older = has_more, True
+        else:
+            self.has_newer, self.has_older = before is not None, has_more
+
+        self.page = rows
+        return rows
+
+    def paginate_cached(self, messages, request, has_older, has_newer=False):
+        """Uses an already-fetched page (e.g. from the history cache) as this page."""
+        self.base_url = request.build_absolute_uri()
+        self.has_newer, self.has_older = has_newer, has_older
+        self.page = messages
+        return messages
+
+    def is_first_page_request(self, request):
+        params = request.query_params
+        return self.before_query_param not in params and self.after_query_param not in params
+
+    def get_page_size(self, request):
+        try:
+            requested = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(requested, 1), self.max_page_size)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.page or not self.has_older:
+            return None
+        url = remove_query_param(self.base_url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.page or not self.has_newer:
+            return None
+        url = remove_query_param(self.base_url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[0]))
+
+    def encode_cursor(self, item):
+        time_field, id_field = self.ordering_fields
+        if isinstance(item, dict):
+            timestamp, pk = item[time_field], item[id_field]
+        else:
+            timestamp, pk = getattr(item, time_field), getattr(item, id_field)
+        if not isinstance(timestamp, str):
+            timestamp = timestamp.isoformat()
+        raw = f'{timestamp}|{pk}'
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode()).decode()
+            timestamp, pk = raw.rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (TypeError, ValueError, binascii.Error, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+
+class ConversationKeysetPagination(MessageKeysetPagination):
+    """The chat list: a user's conversations by last activity (annotated from the Conversation), most recent first."""
+    page_size = 50
+    ordering_fields = ('last_activity', 'id')
@@ -0,0 +1,329 @@
+# chatbox/persistence.py
+"""
+Write-behind persistence for WebSocket chat messages (CHAT_PERSISTENCE_MODE = 'write_behind').
+
+A message gets its id from a Redis sequence, is journaled to Redis and is
+broadcast straight away; the worker's buffer then writes it with bulk_create
+once WRITE_BEHIND_MAX_BATCH messages are waiting or WRITE_BEHIND_MAX_DELAY
+seconds have passed, whichever comes first.
+
+Crash safety: each worker journals pending messages in its own Redis hash
+(`chat_persist:journal:{worker}`) and keeps a short-lived heartbeat key alive.
+A journal whose heartbeat has expired belongs to a dead worker and is claimed
+and inserted by whichever worker notices it first; every worker looks for
+them every HEARTBEAT_TTL seconds. A claim expires with the worker holding it,
+so a journal is never inserted by two workers at once, nor left behind.
+Inserts use explicit ids and skip the rows a journal replay already wrote.
+
+The id sequence is raised to the table's highest id on startup, so ids handed
+out while another mode inserted with the table's own autoincrement can't be
+handed out again. A message whose id is taken by a different row anyway is
+logged and stored under a fresh id rather than dropped.
+
+The history cache gets each message when it is journaled, and is told again
+once its insert has committed (history_cache.asettle), so a refill can't
+install a window that misses a message still waiting here.
+"""
+import asyncio
+import json
+import logging
+import uuid
+import weakref
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+
+from . import history_cache
+from .async_db import db_sync_to_async
+from .conversations import record_messages
+from .models import ChatMessage
+from .redis_pool import get_redis, get_sync_redis
+from .sqlite_writer import db_write
+
+logger = logging.getLogger(__name__)
+
+ID_SEQUENCE_KEY = 'chat_message:id_seq'
+JOURNAL_PREFIX = 'chat_persist:journal:'
+HEARTBEAT_PREFIX = 'chat_persist:worker:'
+HEARTBEAT_TTL = 30
+# A journal being recovered is renamed to {journal}:recovering:{token} and
+# stays claimed while chat_persist:claim:{token} lives; the recovering worker
+# keeps that alive, so the claims of a worker that died recovering expire.
+CLAIMED_MARKER = ':recovering:'
+CLAIM_PREFIX = 'chat_persist:claim:'
+
+# Returns nil (instead of silently starting from 1) when the sequence is missing,
+# so the caller can seed it from the database first.
+NEXT_ID_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+return redis.call('INCR', KEYS[1])
+"""
+
+# KEYS: sequence  ARGV: highest id in the table
+# Moves the sequence up to the table, never back.
+SEED_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current or tonumber(current) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_PERSISTENCE_MODE', 'sync') == 'write_behind'
+
+
+def _max_message_id():
+    return ChatMessage.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+
+
+def seed_id_sequence():
+    """Moves the shared sequence up to the highest stored id, if it is behind."""
+    script = get_sync_redis().register_script(SEED_SCRIPT)
+    script(keys=[ID_SEQUENCE_KEY], args=[_max_message_id()])
+
+
+async def aseed_id_sequence():
+    script = get_redis().register_script(SEED_SCRIPT)
+    await script(keys=[ID_SEQUENCE_KEY], args=[await db_sync_to_async(_max_message_id)()])
+
+
+def allocate_message_id():
+    """Next message id from the shared sequence (blocking; for the REST view)."""
+    script = get_sync_redis().register_script(NEXT_ID_SCRIPT)
+    next_id = script(keys=[ID_SEQUENCE_KEY])
+    if next_id is None:
+        seed_id_sequence()
+        next_id = script(keys=[ID_SEQUENCE_KEY])
+    return int(next_id)
+
+
+async def aallocate_message_id():
+    script = get_redis().register_script(NEXT_ID_SCRIPT)
+    next_id = await script(keys=[ID_SEQUENCE_KEY])
+    if next_id is None:
+        await aseed_id_sequence()
+        next_id = await script(keys=[ID_SEQUENCE_KEY])
+    return int(next_id)
+
+
+def message_fields(message):
+    """The columns of a message row, as JSON-ready values."""
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'message': message.message,
+        'image_id': message.image_id,
+        'message_type': message.message_type,
+        'room_name': message.room_name,
+        'conversation': message.conversation,
+        'is_dm': message.is_dm,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def message_to_record(message):
+    return json.dumps(message_fields(message))
+
+
+def record_to_message(record):
+    fields = json.loads(record)
+    fields['timestamp'] = parse_datetime(fields['timestamp'])
+    return ChatMessage(**fields)
+
+
+def insert_records(records):
+    """
+    Inserts journaled messages and folds them into the conversation summaries.
+    Rows already written by an earlier replay of the same journal are skipped,
+    so they aren't counted twice. A message whose id belongs to a different
+    row is stored under a new id.
+    """
+    messages = [record_to_message(record) for record in records]
+    with transaction.atomic():
+        existing = {
+            row['id']: row for row in
+            ChatMessage.objects.filter(id__in=[m.id for m in messages]).values('id', 'sender_id', 'timestamp')
+        }
+        new_messages, collided = [], []
+        for message in messages:
+            row = existing.get(message.id)
+            if row is None:
+                new_messages.append(message)
+            elif (row['sender_id'], row['timestamp']) != (message.sender_id, message.timestamp):
+                collided.append(message)
+        if collided:
+            logger.error(f"Message ids {[m.id for m in collided]} already belong to other messages: the id "
+                         f"sequence was behind the table. Re-seeding it and storing them under new ids.")
+            seed_id_sequence()
+            for message in collided:
+                message.id = allocate_message_id()
+            new_messages.extend(collided)
+        ChatMessage.objects.bulk_create(new_messages)
+        record_messages(new_messages)
+    return messages
+
+
+def _conversation_counts(messages):
+    counts = {}
+    for message in messages:
+        counts[message.conversation] = counts.get(message.conversation, 0) + 1
+    return counts
+
+
+class WriteBehindBuffer:
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.journal_key = f'{JOURNAL_PREFIX}{self.worker_id}'
+        self.heartbeat_key = f'{HEARTBEAT_PREFIX}{self.worker_id}'
+        self._pending = {}  # id -> journal record
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._recovery_task = None
+
+    def start_recovery(self):
+        if self._recovery_task is None or self._recovery_task.done():
+            self._recovery_task = asyncio.ensure_future(self._recover_periodically())
+
+    async def _recover_periodically(self):
+        # Journals of workers that died within the last HEARTBEAT_TTL still look
+        # alive on startup (a rolling deploy), so keep looking.
+        while True:
+            await recover_orphaned_journals()
+            await asyncio.sleep(HEARTBEAT_TTL)
+
+    def stop_recovery(self):
+        if self._recovery_task is not None:
+            self._recovery_task.cancel()
+            self._recovery_task = None
+
+    async def add(self, message):
+        """Journals an unsaved message (id already allocated) and schedules its insert."""
+        record = message_to_record(message)
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hset(self.journal_key, message.id, record)
+        pipe.set(self.heartbeat_key, 1, ex=HEARTBEAT_TTL)
+        await pipe.execute()
+
+        self._pending[message.id] = record
+        if len(self._pending) >= getattr(settings, 'WRITE_BEHIND_MAX_BATCH', 200):
+            asyncio.ensure_future(self.flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_after_delay())
+
+    async def _flush_after_delay(self):
+        await asyncio.sleep(getattr(settings, 'WRITE_BEHIND_MAX_DELAY', 0.5))
+        await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = dict(self._pending)
+            try:
+                messages = await db_write(insert_records)(list(batch.values()))
+            except Exception as e:
+                # Still journaled; retried on the next flush (or by another worker if we die).
+                logger.error(f"Write-behind flush of {len(batch)} messages failed: {e}")
+                await get_redis().set(self.heartbeat_key, 1, ex=HEARTBEAT_TTL)
+                if self._flush_task is None or self._flush_task.done():
+                    self._flush_task = asyncio.ensure_future(self._flush_after_delay())
+                return
+
+            for message_id in batch:
+                self._pending.pop(message_id, None)
+            try:
+                await get_redis().hdel(self.journal_key, *batch.keys())
+            except Exception as e:
+                logger.error(f"Error trimming write-behind journal: {e}")
+            try:
+                await history_cache.asettle(_conversation_counts(messages))
+            except Exception as e:
+                logger.error(f"Error settling history cache after write-behind flush: {e}")
+            logger.debug(f"Write-behind flushed {len(batch)} messages.")
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_buffer():
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = _buffers[loop] = WriteBehindBuffer()
+        # Servers without lifespan support never call start(); recover from here instead.
+        buffer.start_recovery()
+    return buffer
+
+
+async def recover_orphaned_journals():
+    """
+    Inserts the journals of workers whose heartbeat has expired, and those
+    left half-recovered by a worker whose claim has expired.
+    """
+    redis_conn = get_redis()
+    try:
+        async for journal_key in redis_conn.scan_iter(match=f'{JOURNAL_PREFIX}*'):
+            if CLAIMED_MARKER in journal_key:
+                token = journal_key.rsplit(CLAIMED_MARKER, 1)[1]
+                if await redis_conn.exists(f'{CLAIM_PREFIX}{token}'):
+                    continue  # being recovered right now
+            elif await redis_conn.exists(f'{HEARTBEAT_PREFIX}{journal_key[len(JOURNAL_PREFIX):]}'):
+                continue
+            await _recover_journal(redis_conn, journal_key)
+    except Exception as e:
+        logger.error(f"Error recovering write-behind journals: {e}")
+
+
+async def _recover_journal(redis_conn, journal_key):
+    worker_id = journal_key[len(JOURNAL_PREFIX):].split(CLAIMED_MARKER, 1)[0]
+    token = uuid.uuid4().hex
+    claim_key = f'{CLAIM_PREFIX}{token}'
+    claimed_key = f'{JOURNAL_PREFIX}{worker_id}{CLAIMED_MARKER}{token}'
+    await redis_conn.set(claim_key, 1, px=int(HEARTBEAT_TTL * 1000))
+    try:
+        await redis_conn.rename(journal_key, claimed_key)
+    except Exception:
+        await redis_conn.delete(claim_key)
+        return  # another worker claimed it first
+    keep_claim = asyncio.ensure_future(_keep_claim(redis_conn, claim_key))
+    try:
+        records = list((await redis_conn.hgetall(claimed_key)).values())
+        if records:
+            messages = await db_write(insert_records)(records)
+            await history_cache.asettle(_conversation_counts(messages))
+        await redis_conn.delete(claimed_key)
+    finally:
+        # On failure the claimed journal stays, and is picked up again once unclaimed.
+        keep_claim.cancel()
+        await redis_conn.delete(claim_key)
+    logger.warning(f"Recovered {len(records)} unsaved messages from worker {worker_id}.")
+
+
+async def _keep_claim(redis_conn, claim_key):
+    while True:
+        await asyncio.sleep(HEARTBEAT_TTL / 3)
+        await redis_conn.set(claim_key, 1, px=int(HEARTBEAT_TTL * 1000))
+
+
+async def start():
+    """ASGI lifespan startup hook."""
+    if write_behind_enabled():
+        try:
+            await aseed_id_sequence()
+        except Exception as e:
+            logger.error(f"Error seeding the message id sequence: {e}")
+        get_buffer()
+
+
+async def shutdown():
+    """ASGI lifespan shutdown hook: flushes whatever this worker still holds."""
+    buffer = _buffers.get(asyncio.get_running_loop())
+    if buffer is not None:
+        buffer.stop_recovery()
+        await buffer.flush()
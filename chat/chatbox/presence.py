@@ -0,0 +1,319 @@
+# chatbox/presence.py
+"""
+Online users and public room occupancy, kept per connection.
+
+Every open socket is an entry `{connection}|{username}|{room}` in the
+`presence:conns` sorted set, scored by its last heartbeat (ms since epoch);
+the room is empty for the presence socket itself. Next to it,
+`presence:users` and `room:{room}:members` map each username to the number of
+that user's live connections, and `presence:rooms` maps each occupied public
+room to its member count. A user is online while any of their tabs is, and a
+room drops out of `presence:rooms` when its last member leaves, so none of
+these grow past what is actually connected. Counts and lists are plain
+ZCARD/ZRANGE reads.
+
+Clients send a 'heartbeat' frame every PRESENCE_HEARTBEAT_INTERVAL seconds.
+Connections closed normally leave on disconnect; the ones left behind by a
+crashed worker stop heartbeating and are removed by the PresenceSweeper once
+they are PRESENCE_TTL old, which publishes the same leave events. Every
+worker runs a sweeper; the leave script only acts on an entry that is still
+there, so a connection is never counted out twice.
+
+With several Redis shards, presence is split rather than kept on one node:
+room keys sit on the room's shard and each user's keys on the shard their
+username hashes to, each with that node's `presence:conns`. A snapshot reads
+every shard and keeps only the entries each shard owns under the current
+ring, so leftovers on a node that no longer owns a key (after a shard was
+added) are ignored.
+"""
+import asyncio
+import logging
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .encoding import frame_event
+from .redis_pool import get_redis, get_shard_clients, get_shard_urls, shard_url
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_GROUP = "presence_group"
+CONNECTIONS_KEY = 'presence:conns'  # zset per shard: connection entry -> last heartbeat (ms)
+ONLINE_USERS_KEY = 'presence:users'  # zset per shard: username -> open presence sockets
+ROOMS_KEY = 'presence:rooms'  # zset per shard: public room name -> member count
+SEQ_KEY = 'presence:seq'  # on the primary node
+
+# KEYS: connections, members, rooms  ARGV: entry, now (ms), username, room ('' for none)
+# Adds the connection or refreshes its heartbeat. Returns {joined, member count}:
+# joined is 1 when this is the user's first live connection in the scope.
+JOIN_SCRIPT = """
+if redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1]) == 0 then
+    return {0, redis.call('ZCARD', KEYS[2])}
+end
+local joined = 0
+if tonumber(redis.call('ZINCRBY', KEYS[2], 1, ARGV[3])) == 1 then
+    joined = 1
+end
+local count = redis.call('ZCARD', KEYS[2])
+if ARGV[4] ~= '' then
+    redis.call('ZADD', KEYS[3], count, ARGV[4])
+end
+return {joined, count}
+"""
+
+# KEYS: connections, members, rooms  ARGV: entry, username, room ('' for none)
+# Returns {left, member count, removed}: left is 1 when that was the user's last
+# connection in the scope, removed is 0 if the entry was already gone.
+LEAVE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return {0, redis.call('ZCARD', KEYS[2]), 0}
+end
+local left = 0
+if tonumber(redis.call('ZINCRBY', KEYS[2], -1, ARGV[2])) <= 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    left = 1
+end
+local count = redis.call('ZCARD', KEYS[2])
+if ARGV[3] ~= '' then
+    if count > 0 then
+        redis.call('ZADD', KEYS[3], count, ARGV[3])
+    else
+        redis.call('ZREM', KEYS[3], ARGV[3])
+    end
+end
+return {left, count, 1}
+"""
+
+
+def presence_ttl_ms():
+    return int(getattr(settings, 'PRESENCE_TTL', 90) * 1000)
+
+
+def room_members_key(room_name):
+    return f'room:{room_name}:members'
+
+
+def user_shard_key(username):
+    return f'user:{username}'
+
+
+def connection_entry(connection_id, username, room_name=''):
+    return f'{connection_id}|{username}|{room_name}'
+
+
+def _scope_keys(room_name):
+    members_key = room_members_key(room_name) if room_name else ONLINE_USERS_KEY
+    return [CONNECTIONS_KEY, members_key, ROOMS_KEY]
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class PresenceBroadcaster:
+    """
+    Collects the presence changes made by this worker and publishes them to
+    the presence group as a single numbered delta per tick. Later changes to
+    the same user or room replace earlier ones within a tick, so a burst of
+    joins/leaves costs one group_send instead of one per change.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._flush_task = None
+
+    def publish(self, key, event):
+        self._pending[key] = event
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_after_tick())
+
+    async def _flush_after_tick(self):
+        await asyncio.sleep(getattr(settings, 'PRESENCE_TICK', 0.25))
+        events = list(self._pending.values())
+        self._pending.clear()
+        if not events:
+            return
+        try:
+            seq = await get_redis().incr(SEQ_KEY)
+            event = frame_event('presence.delta', {
+                'type': 'presence_delta',
+                'seq': seq,
+                'events': events,
+            })
+            with metrics.time_group_send(event):
+                await get_channel_layer().group_send(PRESENCE_GROUP, event)
+        except Exception as e:
+            logger.error(f"Error publishing presence delta: {e}")
+
+
+_broadcasters = weakref.WeakKeyDictionary()
+
+
+def get_broadcaster():
+    loop = asyncio.get_running_loop()
+    broadcaster = _broadcasters.get(loop)
+    if broadcaster is None:
+        broadcaster = _broadcasters[loop] = PresenceBroadcaster()
+    return broadcaster
+
+
+def _publish_left(username, room_name, count):
+    """Publishes a user's last connection leaving the presence socket or a room."""
+    if room_name:
+        get_broadcaster().publish(('room', room_name), {
+            'type': 'room_count_changed',
+            'name': room_name,
+            'online_count': int(count),
+        })
+    else:
+        get_broadcaster().publish(('user', username), {
+            'type': 'user_left',
+            'username': username,
+        })
+
+
+async def user_online(user, connection_id):
+    """Registers a presence socket, or refreshes it on a heartbeat."""
+    get_sweeper()
+    script = get_redis(user_shard_key(user.username)).register_script(JOIN_SCRIPT)
+    joined, _ = await script(keys=_scope_keys(''),
+                             args=[connection_entry(connection_id, user.username), _now_ms(), user.username, ''])
+    if int(joined):
+        get_broadcaster().publish(('user', user.username), {
+            'type': 'user_joined',
+            'user': {'id': user.id, 'username': user.username},
+        })
+
+
+async def user_offline(user, connection_id):
+    script = get_redis(user_shard_key(user.username)).register_script(LEAVE_SCRIPT)
+    left, count, _ = await script(keys=_scope_keys(''),
+                                  args=[connection_entry(connection_id, user.username), user.username, ''])
+    if int(left):
+        _publish_left(user.username, '', count)
+
+
+async def room_activity_update(room_name, username, action, connection_id):
+    """
+    Records a connection joining, heartbeating in ('heartbeat') or leaving a
+    public room, and publishes the new count when the room's membership changed.
+    """
+    get_sweeper()
+    entry = connection_entry(connection_id, username, room_name)
+    if action == 'left':
+        script = get_redis(room_name).register_script(LEAVE_SCRIPT)
+        left, count, _ = await script(keys=_scope_keys(room_name), args=[entry, username, room_name])
+        if int(left):
+            _publish_left(username, room_name, count)
+        return
+
+    script = get_redis(room_name).register_script(JOIN_SCRIPT)
+    joined, count = await script(keys=_scope_keys(room_name), args=[entry, _now_ms(), username, room_name])
+    if int(joined):
+        get_broadcaster().publish(('room', room_name), {
+            'type': 'room_count_changed',
+            'name': room_name,
+            'online_count': int(count),
+        })
+
+
+async def read_snapshot_state():
+    """
+    Returns (seq, online usernames, [(room, count), ...]). The sequence number is
+    read first: every change numbered up to it is already reflected in the sets.
+    """
+    seq = int(await get_redis().get(SEQ_KEY) or 0)
+
+    async def read_shard(redis_conn):
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.zrange(ONLINE_USERS_KEY, 0, -1)
+        pipe.zrange(ROOMS_KEY, 0, -1, withscores=True)
+        return await pipe.execute()
+
+    urls = get_shard_urls()
+    shards = await asyncio.gather(*(read_shard(redis_conn) for redis_conn in get_shard_clients()))
+    online_usernames, rooms = set(), []
+    for url, (usernames, room_counts) in zip(urls, shards):
+        online_usernames.update(name for name in usernames if shard_url(user_shard_key(name)) == url)
+        rooms.extend((name, int(count)) for name, count in room_counts if shard_url(name) == url)
+    return seq, online_usernames, sorted(rooms)
+
+
+class PresenceSweeper:
+    """Removes connections that stopped heartbeating, on every shard, every PRESENCE_SWEEP_INTERVAL."""
+
+    def __init__(self):
+        self._task = None
+        self._running = False
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._running = True
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        self._running = False
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        while self._running:
+            await asyncio.sleep(getattr(settings, 'PRESENCE_SWEEP_INTERVAL', 15))
+            try:
+                for redis_conn in get_shard_clients():
+                    await self.sweep(redis_conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._running:
+                    logger.error(f"Presence sweep error: {e}")
+
+    async def sweep(self, redis_conn, batch=500):
+        """Counts out every stale connection on one node. Returns how many this worker removed."""
+        cutoff = _now_ms() - presence_ttl_ms()
+        script = redis_conn.register_script(LEAVE_SCRIPT)
+        removed = 0
+        while True:
+            entries = await redis_conn.zrangebyscore(CONNECTIONS_KEY, '-inf', cutoff, start=0, num=batch)
+            for entry in entries:
+                _, username, room_name = entry.split('|', 2)
+                left, count, was_there = await script(keys=_scope_keys(room_name), args=[entry, username, room_name])
+                if int(was_there):
+                    removed += 1
+                    if int(left):
+                        _publish_left(username, room_name, count)
+            if len(entries) < batch:
+                break
+        if removed:
+            logger.info(f"Presence sweep removed {removed} stale connections.")
+        return removed
+
+
+_sweepers = weakref.WeakKeyDictionary()
+
+
+def get_sweeper():
+    loop = asyncio.get_running_loop()
+    sweeper = _sweepers.get(loop)
+    if sweeper is None:
+        sweeper = _sweepers[loop] = PresenceSweeper()
+        sweeper.start()
+    return sweeper
+
+
+async def start():
+    """ASGI lifespan startup hook."""
+    get_sweeper()
+
+
+async def shutdown():
+    sweeper = _sweepers.get(asyncio.get_running_loop())
+    if sweeper is not None:
+        await sweeper.stop()
@@ -0,0 +1,117 @@
+# chatbox/read_state.py
+"""
+Read state as per-conversation watermarks (see ReadWatermark).
+
+A receipt moves the reader's watermark forward with a single UPDATE, or one
+INSERT the first time. In a DM it then recounts the reader's unread messages
+in their chat list entry; in a public room the watermark keeps a snapshot of
+the room's message count instead, so the room's unread count is a
+subtraction. The chat consumer throttles receipts per connection before they
+get here. Whether a message is read is then derived, not stored: a DM
+message counts as read once its receiver's watermark has reached its id.
+Cached history pages never change on a receipt; the watermark is applied when
+a page is served.
+"""
+import logging
+
+from django.db import IntegrityError
+from django.db.models import Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .conversations import refresh_unread_count
+from .models import Conversation, ReadWatermark, dm_conversation_key
+
+logger = logging.getLogger(__name__)
+
+
+def can_read(user, conversation):
+    """Public rooms are open to everyone; a DM only to the two users in its key."""
+    if not conversation.startswith('dm_'):
+        return True
+    return str(user.id) in conversation.split('_')[1:]
+
+
+def advance_watermark(user, conversation, message_id):
+    """
+    Moves the user's watermark for `conversation` up to `message_id` and, in a
+    DM, recounts their unread messages. Never moves it backwards. Returns True
+    if it moved; a watermark already past `message_id` costs no recount.
+    """
+    moved = _move_watermark(user, conversation, message_id)
+    if moved and conversation.startswith('dm_'):
+        refresh_unread_count(user, conversation, message_id)
+    return moved
+
+
+def _move_watermark(user, conversation, message_id):
+    moved = {'last_read_message_id': message_id}
+    if not conversation.startswith('dm_'):
+        # Receipts name the newest message the client has shown, so the room's
+        # count right now is how many messages the reader has seen.
+        moved['read_count'] = Coalesce(
+            Subquery(Conversation.objects.filter(key=conversation).values('message_count')), Value(0),
+        )
+    updated = ReadWatermark.objects.filter(
+        user=user, conversation=conversation, last_read_message_id__lt=message_id,
+    ).update(**moved)
+    if updated:
+        return True
+    try:
+        _, created = ReadWatermark.objects.get_or_create(
+            user=user, conversation=conversation, defaults=moved,
+        )
+    except IntegrityError:
+        # A concurrent receipt created the row first; retry the forward-only update.
+        return _move_watermark(user, conversation, message_id)
+    return created
+
+
+def watermarks(conversation):
+    """{user_id: last_read_message_id} for everyone who has read `conversation`."""
+    return dict(ReadWatermark.objects.filter(conversation=conversation)
+                .values_list('user_id', 'last_read_message_id'))
+
+
+def apply_read_state(conversation, messages):
+    """Sets is_read on serialized DM messages from the receivers' watermarks."""
+    if not messages or not conversation.startswith('dm_'):
+        return messages
+    marks = watermarks(conversation)
+    for message in messages:
+        receiver = message.get('receiver')
+        if receiver:
+            message['is_read'] = message['id'] <= marks.get(receiver['id'], 0)
+    return messages
+
+
+def apply_read_state_across(messages):
+    """apply_read_state for messages from many conversations, with one watermark query."""
+    keys = {dm_conversation_key(m['sender']['id'], m['receiver']['id']) for m in messages if m.get('receiver')}
+    if not keys:
+        return messages
+    marks = {(conversation, user_id): last_read_id for conversation, user_id, last_read_id in
+             ReadWatermark.objects.filter(conversation__in=keys)
+             .values_list('conversation', 'user_id', 'last_read_message_id')}
+    for message in messages:
+        receiver = message.get('receiver')
+        if receiver:
+            key = dm_conversation_key(message['sender']['id'], receiver['id'])
+            message['is_read'] = message['id'] <= marks.get((key, receiver['id']), 0)
+    return messages
+
+
+def apply_room_unread_counts(user, entries):
+    """
+    Sets unread_count on the public-room entries of a chat list page: the
+    room's message count minus the count the user's watermark last saw. One
+    lookup of the user's watermarks for the page; no messages are counted.
+    """
+    rooms = {entry.conversation_id: entry for entry in entries if not entry.conversation.is_dm}
+    if not rooms:
+        return entries
+    seen = dict(ReadWatermark.objects
+                .filter(user=user, conversation__in=list(rooms))
+                .values_list('conversation', 'read_count'))
+    for key, entry in rooms.items():
+        entry.unread_count = max(entry.conversation.message_count - seen.get(key, 0), 0)
+    return entries
@@ -0,0 +1,135 @@
+# chatbox/redis_pool.py
+"""
+Pooled Redis clients.
+
+get_redis() / get_sync_redis() without a key return the primary node
+(REDIS_URL), which holds the global keys: the message id sequence, write-behind
+journals, the room log feed, counters. Passing a room or conversation name
+returns the node that room is placed on among REDIS_SHARD_URLS (see
+chatbox.sharding). With no shards configured every key lives on REDIS_URL.
+"""
+import asyncio
+import logging
+import threading
+import weakref
+
+import redis
+import redis.asyncio as async_redis
+from django.conf import settings
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+
+from .sharding import get_ring
+
+logger = logging.getLogger(__name__)
+
+# One client (and one connection pool) per node per event loop. A worker process
+# normally runs a single loop, so in practice this is one pool per node shared
+# by every consumer.
+_clients = weakref.WeakKeyDictionary()  # loop -> {url: client}
+# Blocking clients for the REST views; redis-py's sync pool is thread-safe.
+_sync_clients = {}  # url -> client
+_sync_client_lock = threading.Lock()
+
+
+def get_redis_url():
+    return getattr(settings, 'REDIS_URL', None) or settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
+
+
+def get_shard_urls():
+    return list(getattr(settings, 'REDIS_SHARD_URLS', None) or [get_redis_url()])
+
+
+def shard_url(shard_key=None):
+    """The node holding `shard_key` (a room or conversation), or the primary node for None."""
+    if shard_key is None:
+        return get_redis_url()
+    urls = get_shard_urls()
+    if len(urls) == 1:
+        return urls[0]
+    return get_ring(urls).node_for(shard_key)
+
+
+def _pool_kwargs():
+    return dict(
+        max_connections=getattr(settings, 'REDIS_POOL_MAX_CONNECTIONS', 50),
+        timeout=getattr(settings, 'REDIS_POOL_TIMEOUT', 5),
+        decode_responses=True,
+        socket_connect_timeout=5,
+        socket_keepalive=True,
+        # Only idle connections are PINGed, and only once per interval.
+        health_check_interval=getattr(settings, 'REDIS_HEALTH_CHECK_INTERVAL', 30),
+    )
+
+
+def _build_client(url):
+    """Create a pooled client. Connections are opened lazily by the pool."""
+    pool = async_redis.BlockingConnectionPool.from_url(url, **_pool_kwargs())
+    logger.info(f"Created shared Redis pool for {pool.connection_kwargs.get('host')}:"
+                f"{pool.connection_kwargs.get('port')} (max_connections={pool.max_connections}).")
+    return async_redis.Redis(
+        connection_pool=pool,
+        retry=AsyncRetry(ExponentialBackoff(cap=1), 3),
+        retry_on_error=[ConnectionError, TimeoutError],
+    )
+
+
+def _client_for_url(url):
+    loop = asyncio.get_running_loop()
+    clients = _clients.get(loop)
+    if clients is None:
+        clients = _clients[loop] = {}
+    client = clients.get(url)
+    if client is None:
+        client = clients[url] = _build_client(url)
+    return client
+
+
+def get_redis(shard_key=None):
+    """
+    Returns the process-wide async Redis client for the running event loop, on
+    the node holding `shard_key` (see shard_url()).
+    Broken connections are dropped and replaced by the pool on the next command,
+    so callers never need to PING before using it.
+    """
+    return _client_for_url(shard_url(shard_key))
+
+
+def get_shard_clients():
+    """Async clients for every shard node, in REDIS_SHARD_URLS order (for aggregating per-shard keys)."""
+    return [_client_for_url(url) for url in get_shard_urls()]
+
+
+def _sync_client_for_url(url):
+    with _sync_client_lock:
+        client = _sync_clients.get(url)
+        if client is None:
+            pool = redis.BlockingConnectionPool.from_url(url, **_pool_kwargs())
+            client = _sync_clients[url] = redis.Redis(
+                connection_pool=pool,
+                retry=Retry(ExponentialBackoff(cap=1), 3),
+                retry_on_error=[ConnectionError, TimeoutError],
+            )
+        return client
+
+
+def get_sync_redis(shard_key=None):
+    """Returns the process-wide blocking Redis client used outside the event loop."""
+    return _sync_client_for_url(shard_url(shard_key))
+
+
+def get_sync_shard_clients():
+    return [_sync_client_for_url(url) for url in get_shard_urls()]
+
+
+async def close_redis():
+    """Closes the pools owned by the running loop. Called on ASGI lifespan shutdown."""
+    clients = _clients.pop(asyncio.get_running_loop(), None) or {}
+    for client in clients.values():
+        try:
+            await client.aclose(close_connection_pool=True)
+            logger.info("Shared Redis pool closed.")
+        except Exception as e:
+            logger.error(f"Error closing shared Redis pool: {e}")
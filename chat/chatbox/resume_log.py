@@ -0,0 +1,125 @@
+# chatbox/resume_log.py
+"""
+Per-conversation replay log for resuming a dropped chat socket.
+
+`chat_log:{conversation}` is a Redis sorted set of encoded chat_message frames
+scored by message id, capped at RESUME_LOG_SIZE entries. Next to it,
+`chat_log:{conversation}:floor` records the id below which the log is
+incomplete: it starts just under the first id logged, and rises as old entries
+are trimmed. Every message with an id above the floor is in the log, so a
+client that last saw an id at or above the floor can be caught up from Redis
+alone. Otherwise the missed messages are read with one range scan on the
+(conversation, timestamp, id) index.
+
+Messages are logged before they are broadcast, and a resuming socket joins its
+group before it reads the log. A message is therefore either in what the
+socket replays or still on its way live; the consumer drops live frames it
+has already replayed.
+"""
+import logging
+
+from django.conf import settings
+from django.db.models import Q
+
+from .encoding import encode_frame
+from .models import ChatMessage
+from .redis_pool import get_redis, get_sync_redis
+from .serializers import message_rows, serialize_message_row
+
+logger = logging.getLogger(__name__)
+
+# KEYS: log, floor  ARGV: message id, frame, size, ttl
+APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('SET', KEYS[2], tonumber(ARGV[1]) - 1)
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+if excess > 0 then
+    local last = redis.call('ZRANGE', KEYS[1], excess - 1, excess - 1, 'WITHSCORES')
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    if tonumber(last[2]) > tonumber(redis.call('GET', KEYS[2])) then
+        redis.call('SET', KEYS[2], last[2])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+"""
+
+# KEYS: log, floor  ARGV: after id, limit
+# Returns {covered, id, frame, id, frame, ...}, oldest first.
+READ_SCRIPT = """
+local floor = redis.call('GET', KEYS[2])
+local covered = 0
+if floor and tonumber(floor) <= tonumber(ARGV[1]) then
+    covered = 1
+end
+local result = {covered}
+local entries = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf', 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #entries, 2 do
+    table.insert(result, entries[i + 1])
+    table.insert(result, entries[i])
+end
+return result
+"""
+
+
+def log_size():
+    return getattr(settings, 'RESUME_LOG_SIZE', 500)
+
+
+def log_ttl():
+    return getattr(settings, 'RESUME_LOG_TTL', 60 * 60 * 24)
+
+
+def max_replay():
+    return getattr(settings, 'RESUME_MAX_REPLAY', 500)
+
+
+def log_key(conversation):
+    return f'chat_log:{conversation}'
+
+
+def floor_key(conversation):
+    return f'chat_log:{conversation}:floor'
+
+
+def message_frame(message):
+    """The chat_message frame for a serialized message, exactly as it is broadcast."""
+    return encode_frame({'type': 'chat_message', **message})
+
+
+def append(conversation, message_id, frame):
+    script = get_sync_redis(conversation).register_script(APPEND_SCRIPT)
+    script(keys=[log_key(conversation), floor_key(conversation)], args=[message_id, frame, log_size(), log_ttl()])
+
+
+async def aappend(conversation, message_id, frame):
+    script = get_redis(conversation).register_script(APPEND_SCRIPT)
+    await script(keys=[log_key(conversation), floor_key(conversation)],
+                 args=[message_id, frame, log_size(), log_ttl()])
+
+
+async def aread_after(conversation, after_id, limit):
+    """(covered, [(id, frame), ...]) for logged messages newer than after_id, oldest first."""
+    script = get_redis(conversation).register_script(READ_SCRIPT)
+    result = await script(keys=[log_key(conversation), floor_key(conversation)], args=[after_id, limit])
+    entries = [(int(float(result[i])), result[i + 1]) for i in range(1, len(result), 2)]
+    return bool(int(result[0])), entries
+
+
+def missed_from_db(conversation, after_id, limit):
+    """
+    [(id, frame), ...] for stored messages newer than after_id, oldest first:
+    the after-cursor range scan of the history pages, starting from after_id's
+    own (timestamp, id).
+    """
+    anchor = ChatMessage.objects.filter(id=after_id, conversation=conversation).values_list('timestamp', flat=True).first()
+    queryset = ChatMessage.objects.filter(conversation=conversation)
+    if anchor is not None:
+        queryset = queryset.filter(Q(timestamp__gt=anchor) | Q(timestamp=anchor, id__gt=after_id))
+    else:
+        queryset = queryset.filter(id__gt=after_id)
+    rows = message_rows(queryset.order_by('timestamp', 'id'))[:limit]
+    return [(row['id'], message_frame(serialize_message_row(row))) for row in rows]
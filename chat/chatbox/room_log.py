@@ -0,0 +1,265 @@
+# chatbox/room_log.py
+"""
+Redis Streams room log (CHAT_PERSISTENCE_MODE = 'stream').
+
+Every chat message, from the WebSocket and the REST API alike, is appended to
+`chat_stream:{conversation}` with its message id as the entry id (`<id>-0`)
+and its encoded chat_message frame as the only field. The stream is capped at
+about ROOM_LOG_SIZE entries (XADD MAXLEN ~) and serves:
+
+- the newest history pages (XREVRANGE), topped up from the database where the
+  stream doesn't reach back far enough;
+- reconnect catch-up (XRANGE from the client's last seen id, see
+  ChatConsumer.resume).
+
+The append script also allocates the id from the shared message sequence
+(chatbox.persistence) in the same step, so ids always grow within a stream,
+and writes the row to insert to the `chat_stream:persist` feed. A consumer
+group on that feed (one StreamPersister per worker) batches the rows into the
+database, acknowledges them, and reclaims entries left pending by a worker
+that died mid-batch. The stream is therefore the source of truth; the
+database catches up within WRITE_BEHIND_MAX_DELAY.
+
+`chat_stream:{conversation}:floor` is set just below the first id a new stream
+receives. Every message of the conversation newer than the floor, or than the
+stream's oldest entry once it has been trimmed, is in the stream.
+
+The room streams stay on the primary Redis node rather than the room's shard:
+the append script touches the global id sequence and feed in the same step.
+"""
+import asyncio
+import json
+import logging
+import uuid
+import weakref
+
+from django.conf import settings
+
+from .encoding import encode_frame
+from .persistence import ID_SEQUENCE_KEY, aseed_id_sequence, insert_records, message_fields, seed_id_sequence
+from .redis_pool import get_redis, get_sync_redis
+from .serializers import ChatMessageSerializer
+from .sqlite_writer import db_write
+
+logger = logging.getLogger(__name__)
+
+FEED_KEY = 'chat_stream:persist'
+PERSIST_GROUP = 'chat_persist'
+
+# KEYS: room stream, floor, feed, id sequence  ARGV: frame body, record body, max length, ttl
+# The bodies are JSON objects without an id; the allocated id is spliced in
+# front. Returns {id, frame}, or nil if the sequence hasn't been seeded yet.
+APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[4]) == 0 then
+    return false
+end
+local id = redis.call('INCR', KEYS[4])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[2], id - 1)
+end
+local frame = '{"id":' .. id .. ',' .. string.sub(ARGV[1], 2)
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], id .. '-0', 'frame', frame)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('XADD', KEYS[3], '*', 'record', '{"id":' .. id .. ',' .. string.sub(ARGV[2], 2))
+return {id, frame}
+"""
+
+# KEYS: room stream, floor  ARGV: after id, count
+# Returns {covered, id, frame, id, frame, ...}, oldest first.
+READ_AFTER_SCRIPT = """
+local floor = redis.call('GET', KEYS[2])
+local covered = 0
+if floor then
+    floor = tonumber(floor)
+    local oldest = redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', 1)
+    if #oldest > 0 then
+        floor = math.max(floor, tonumber(string.match(oldest[1][1], '^%d+')) - 1)
+    end
+    if floor <= tonumber(ARGV[1]) then
+        covered = 1
+    end
+end
+local result = {covered}
+for _, entry in ipairs(redis.call('XRANGE', KEYS[1], ARGV[1] .. '-1', '+', 'COUNT', ARGV[2])) do
+    table.insert(result, string.match(entry[1], '^%d+'))
+    table.insert(result, entry[2][2])
+end
+return result
+"""
+
+
+def enabled():
+    return getattr(settings, 'CHAT_PERSISTENCE_MODE', 'sync') == 'stream'
+
+
+def log_size():
+    return getattr(settings, 'ROOM_LOG_SIZE', 1000)
+
+
+def log_ttl():
+    return getattr(settings, 'ROOM_LOG_TTL', 60 * 60 * 24)
+
+
+def stream_key(conversation):
+    return f'chat_stream:{conversation}'
+
+
+def floor_key(conversation):
+    return f'chat_stream:{conversation}:floor'
+
+
+def _append_args(message):
+    """Frame and insert record for an unsaved message, both without an id (see APPEND_SCRIPT)."""
+    payload = dict(ChatMessageSerializer(message).data)
+    del payload['id']
+    record = message_fields(message)
+    del record['id']
+    return [encode_frame({'type': 'chat_message', **payload}), json.dumps(record), log_size(), log_ttl()]
+
+
+def _decode_message(frame):
+    message = json.loads(frame)
+    del message['type']
+    return message
+
+
+def append(message):
+    """
+    Appends an unsaved ChatMessage (blocking; for the REST view), setting its
+    id. Returns the encoded frame.
+    """
+    script = get_sync_redis().register_script(APPEND_SCRIPT)
+    keys = [stream_key(message.conversation), floor_key(message.conversation), FEED_KEY, ID_SEQUENCE_KEY]
+    args = _append_args(message)
+    result = script(keys=keys, args=args)
+    if result is None:
+        seed_id_sequence()
+        result = script(keys=keys, args=args)
+    message.id = int(result[0])
+    return result[1]
+
+
+async def aappend(message):
+    script = get_redis().register_script(APPEND_SCRIPT)
+    keys = [stream_key(message.conversation), floor_key(message.conversation), FEED_KEY, ID_SEQUENCE_KEY]
+    args = _append_args(message)
+    result = await script(keys=keys, args=args)
+    if result is None:
+        await aseed_id_sequence()
+        result = await script(keys=keys, args=args)
+    get_persister()
+    message.id = int(result[0])
+    return result[1]
+
+
+def read_before(conversation, before_id, count):
+    """
+    Up to `count` logged messages of the conversation older than before_id
+    (the newest ones if None), newest first, as serialized messages. A result
+    shorter than `count` means the stream doesn't reach further back.
+    """
+    end = f'({before_id}-0' if before_id is not None else '+'
+    entries = get_sync_redis().xrevrange(stream_key(conversation), max=end, min='-', count=count)
+    return [_decode_message(fields['frame']) for _, fields in entries]
+
+
+async def aread_after(conversation, after_id, limit):
+    """(covered, [(id, frame), ...]) for logged messages newer than after_id, oldest first."""
+    script = get_redis().register_script(READ_AFTER_SCRIPT)
+    result = await script(keys=[stream_key(conversation), floor_key(conversation)], args=[after_id, limit])
+    entries = [(int(result[i]), result[i + 1]) for i in range(1, len(result), 2)]
+    return bool(int(result[0])), entries
+
+
+class StreamPersister:
+    """This worker's consumer in the persist group: feed entries -> insert_records()."""
+
+    def __init__(self):
+        self.consumer = uuid.uuid4().hex
+        self._task = None
+        self._running = False
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._running = True
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        self._running = False
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        redis_conn = get_redis()
+        while self._running:
+            try:
+                try:
+                    await redis_conn.xgroup_create(FEED_KEY, PERSIST_GROUP, id='0', mkstream=True)
+                except Exception as e:
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+                while self._running:
+                    batch = getattr(settings, 'WRITE_BEHIND_MAX_BATCH', 200)
+                    block_ms = int(getattr(settings, 'WRITE_BEHIND_MAX_DELAY', 0.5) * 1000)
+                    claim_idle_ms = int(getattr(settings, 'ROOM_LOG_CLAIM_IDLE', 30) * 1000)
+                    # Entries another worker read but never acknowledged first, then new ones.
+                    claimed = await redis_conn.xautoclaim(
+                        FEED_KEY, PERSIST_GROUP, self.consumer, claim_idle_ms, start_id='0-0', count=batch)
+                    entries = claimed[1]
+                    if not entries:
+                        result = await redis_conn.xreadgroup(
+                            PERSIST_GROUP, self.consumer, {FEED_KEY: '>'}, count=batch, block=block_ms)
+                        entries = [entry for _, stream_entries in result for entry in stream_entries]
+                    if entries:
+                        await self.persist(entries)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A cancelled blocking read can surface as a connection error.
+                if self._running:
+                    logger.error(f"Room log persister error: {e}")
+                    await asyncio.sleep(1)
+
+    async def persist(self, entries):
+        entry_ids = [entry_id for entry_id, _ in entries]
+        records = [fields['record'] for _, fields in entries if fields]
+        if records:
+            await db_write(insert_records)(records)
+        redis_conn = get_redis()
+        await redis_conn.xack(FEED_KEY, PERSIST_GROUP, *entry_ids)
+        await redis_conn.xdel(FEED_KEY, *entry_ids)
+        logger.debug(f"Room log persisted {len(records)} messages.")
+
+
+_persisters = weakref.WeakKeyDictionary()
+
+
+def get_persister():
+    loop = asyncio.get_running_loop()
+    persister = _persisters.get(loop)
+    if persister is None:
+        persister = _persisters[loop] = StreamPersister()
+        persister.start()
+    return persister
+
+
+async def start():
+    """ASGI lifespan startup hook."""
+    if enabled():
+        try:
+            await aseed_id_sequence()
+        except Exception as e:
+            logger.error(f"Error seeding the message id sequence: {e}")
+        get_persister()
+
+
+async def shutdown():
+    persister = _persisters.get(asyncio.get_running_loop())
+    if persister is not None:
+        await persister.stop()
@@ -0,0 +1,130 @@
+# chatbox/search.py
+"""
+Full-text message search on the database's own text index.
+
+- SQLite: an FTS5 table over chatbox_chatmessage.message (external content, so
+  the text isn't stored twice), kept current by triggers on the message table
+  that run in the transaction of every insert, update and delete.
+- PostgreSQL: a GIN index on to_tsvector('simple', message).
+- MySQL: a FULLTEXT index on message.
+
+All three follow the message table by themselves, so the save paths never
+index anything. Any other backend, or an SQLite build without FTS5, falls
+back to LIKE matching. The indexes and triggers are created by migration
+0009; rebuild_index() re-reads the messages into the FTS5 table if it ever
+drifts.
+
+Queries are split into words, all of which must match; the last one also
+matches as a prefix, so results follow the user as they type.
+"""
+import html
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import ChatMessage
+
+FTS_TABLE = 'chatbox_chatmessage_fts'
+
+# Highlight markers: the engines wrap matches in these, and they become <mark>
+# tags only after the rest of the snippet has been HTML-escaped.
+_START, _STOP = '\x02', '\x03'
+SNIPPET_WORDS = 12
+_WORD_RE = re.compile(r'\w+')
+
+_fts_available = {}  # database name -> whether the FTS5 table exists
+
+
+def query_terms(text):
+    """The words of a search query, lowercased; empty if there's nothing to search for."""
+    return [term.lower() for term in _WORD_RE.findall(text or '')][:16]
+
+
+def _fts5_query(terms):
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+
+def _tsquery(terms):
+    return ' & '.join(terms) + ':*'
+
+
+def _boolean_query(terms):
+    return ' '.join(f'+{term}' for term in terms) + '*'
+
+
+def fts_enabled():
+    if connection.vendor != 'sqlite':
+        return False
+    name = connection.settings_dict['NAME']
+    if name not in _fts_available:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _fts_available[name] = cursor.fetchone() is not None
+    return _fts_available[name]
+
+
+def filter_matches(queryset, terms):
+    """Narrows a ChatMessage queryset to messages containing every term."""
+    table = ChatMessage._meta.db_table
+    if fts_enabled():
+        sql, params = f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [_fts5_query(terms)]
+    elif connection.vendor == 'postgresql':
+        sql = f"SELECT id FROM {table} WHERE to_tsvector('simple', coalesce(message, '')) @@ to_tsquery('simple', %s)"
+        params = [_tsquery(terms)]
+    elif connection.vendor == 'mysql':
+        sql, params = f'SELECT id FROM {table} WHERE MATCH (message) AGAINST (%s IN BOOLEAN MODE)', [_boolean_query(terms)]
+    else:
+        condition = Q()
+        for term in terms:
+            condition &= Q(message__icontains=term)
+        return queryset.filter(condition)
+    return queryset.filter(id__in=RawSQL(sql, params))
+
+
+def snippets(terms, message_ids):
+    """{message id: HTML snippet with the matched words in <mark>} for the given messages."""
+    if not message_ids:
+        return {}
+    placeholders = ', '.join(['%s'] * len(message_ids))
+    if fts_enabled():
+        sql = (f"SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', {SNIPPET_WORDS}) FROM {FTS_TABLE} "
+               f"WHERE {FTS_TABLE} MATCH %s AND rowid IN ({placeholders})")
+        params = [_START, _STOP, _fts5_query(terms), *message_ids]
+    elif connection.vendor == 'postgresql':
+        options = f'StartSel={_START}, StopSel={_STOP}, MaxWords={SNIPPET_WORDS * 2}, MinWords={SNIPPET_WORDS}'
+        sql = (f"SELECT id, ts_headline('simple', coalesce(message, ''), to_tsquery('simple', %s), %s) "
+               f"FROM {ChatMessage._meta.db_table} WHERE id IN ({placeholders})")
+        params = [_tsquery(terms), options, *message_ids]
+    else:
+        rows = ChatMessage.objects.filter(id__in=message_ids).values_list('id', 'message')
+        return {pk: _highlight(text or '', terms) for pk, text in rows}
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {pk: _escape_snippet(raw) for pk, raw in cursor.fetchall()}
+
+
+def _escape_snippet(raw):
+    return html.escape(raw or '').replace(_START, '<mark>').replace(_STOP, '</mark>')
+
+
+def _highlight(text, terms):
+    """Snippet built in Python for backends without a native one."""
+    lowered = text.lower()
+    first = min((i for i in (lowered.find(term) for term in terms) if i >= 0), default=0)
+    start = max(0, first - 40)
+    window = text[start:start + 160]
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    marked = pattern.sub(lambda m: f'{_START}{m.group(0)}{_STOP}', window)
+    prefix = '…' if start else ''
+    suffix = '…' if start + 160 < len(text) else ''
+    return prefix + _escape_snippet(marked) + suffix
+
+
+def rebuild_index():
+    """Re-reads every message into the FTS5 table (SQLite only)."""
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
@@ -7,7 +7,8 @@ from django.contrib.auth import get_user_model
 from djoser.serializers import UserCreateSerializer as DjoserUserCreateSerializer
 from djoser.serializers import UserSerializer as DjoserUserSerializer
 
-from .models import ChatMessage
+from .models import ChatMessage, Participant
+from .blobs import image_reference, image_reference_from_fields
 
 User = get_user_model()
 
@@ -66,6 +67,8 @@ class ChatMessageSerializer(serializers.ModelSerializer):
     """
     sender = NestedUserSerializer(read_only=True)
     receiver = NestedUserSerializer(read_only=True, allow_null=True)
+    # Images are referenced (id, urls, dimensions), never inlined.
+    image = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatMessage
@@ -75,10 +78,84 @@ class ChatMessageSerializer(serializers.ModelSerializer):
             'receiver',      
             'message', 
             'image_content',
+            'image',
             'message_type', 
             'room_name', 
             'is_dm', 
             'timestamp', 
             'is_read'
         ]
-        read_only_fields = ('id', 'sender', 'receiver', 'timestamp')
\ No newline at end of file
+        read_only_fields = ('id', 'sender', 'receiver', 'timestamp')
+
+    def get_image(self, obj):
+        return image_reference(obj.image)
+
+
+# --- Lean read path for message history ---
+# ChatMessageSerializer costs a query per sender/receiver/image and walks every
+# field; history pages are instead read as plain rows with the users and the
+# image joined in, and turned into the exact same JSON shape below.
+
+MESSAGE_ROW_FIELDS = (
+    'id', 'sender_id', 'sender__username', 'receiver_id', 'receiver__username',
+    'message', 'image_content', 'image_id', 'image__width', 'image__height',
+    'message_type', 'room_name', 'is_dm', 'timestamp', 'is_read',
+)
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def message_rows(queryset):
+    """The messages of `queryset` as dicts, joined with their sender, receiver and image in one query."""
+    return queryset.values(*MESSAGE_ROW_FIELDS)
+
+
+def serialize_message_row(row):
+    """Same output as ChatMessageSerializer, from a message_rows() row."""
+    receiver_id = row['receiver_id']
+    image_id = row['image_id']
+    return {
+        'id': row['id'],
+        'sender': {'id': row['sender_id'], 'username': row['sender__username']},
+        'receiver': {'id': receiver_id, 'username': row['receiver__username']} if receiver_id is not None else None,
+        'message': row['message'],
+        'image_content': row['image_content'],
+        'image': image_reference_from_fields(image_id, row['image__width'], row['image__height']) if image_id else None,
+        'message_type': row['message_type'],
+        'room_name': row['room_name'],
+        'is_dm': row['is_dm'],
+        'timestamp': _timestamp_field.to_representation(row['timestamp']),
+        'is_read': row['is_read'],
+    }
+
+
+def serialize_message_rows(rows):
+    return [serialize_message_row(row) for row in rows]
+
+
+class ConversationSummarySerializer(serializers.ModelSerializer):
+    """
+    One chat list entry, read from the Participant / Conversation summary rows.
+    'key' is the conversation key (room name or dm_<low>_<high>); 'peer' is the
+    other user of a DM.
+    """
+    key = serializers.CharField(source='conversation_id')
+    is_dm = serializers.BooleanField(source='conversation.is_dm')
+    peer = NestedUserSerializer(read_only=True, allow_null=True)
+    last_message = serializers.SerializerMethodField()
+    last_activity = serializers.DateTimeField(source='conversation.last_activity', read_only=True)
+
+    class Meta:
+        model = Participant
+        fields = ['key', 'is_dm', 'peer', 'last_message', 'last_activity', 'unread_count']
+
+    def get_last_message(self, obj):
+        conversation = obj.conversation
+        if not conversation.last_message_id:
+            return None
+        sender = conversation.last_sender
+        return {
+            'id': conversation.last_message_id,
+            'sender': {'id': sender.id, 'username': sender.username} if sender else None,
+            'preview': conversation.last_message_preview,
+        }
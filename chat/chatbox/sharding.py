@@ -0,0 +1,77 @@
+# chatbox/sharding.py
+"""
+Consistent hashing of rooms onto the Redis nodes in REDIS_SHARD_URLS.
+
+Each node is hashed onto a ring at REDIS_SHARD_VNODES points; a key belongs to
+the first node point at or after its own hash. Adding or removing a node
+therefore only moves the keys between that node's points and their
+predecessors (about 1/N of them) instead of reshuffling everything the way
+`hash % N` does.
+
+Everything scoped to one room or conversation is placed by its name, so all of
+a room's keys land on the same node and the Lua scripts that touch several of
+them keep working: history cache, resume log, typing state and the room's
+presence set. The channel layer places `chat_{room}` groups with the same ring
+(ShardedRedisChannelLayer). Global keys stay on REDIS_URL, see
+chatbox.redis_pool.
+"""
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+
+
+def _point(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Maps keys to the index of one of `nodes` (labels, e.g. their URLs)."""
+
+    def __init__(self, nodes, vnodes=160):
+        self.nodes = list(nodes)
+        points = sorted((_point(f'{node}#{i}'), index) for index, node in enumerate(self.nodes) for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def index_for(self, key):
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self._hashes, _point(key)) % len(self._hashes)
+        return self._indexes[position]
+
+    def node_for(self, key):
+        return self.nodes[self.index_for(key)]
+
+
+_rings = {}  # (nodes, vnodes) -> HashRing
+
+
+def get_ring(nodes):
+    vnodes = getattr(settings, 'REDIS_SHARD_VNODES', 160)
+    cache_key = (tuple(nodes), vnodes)
+    ring = _rings.get(cache_key)
+    if ring is None:
+        ring = _rings[cache_key] = HashRing(nodes, vnodes)
+    return ring
+
+
+def room_group_key(group):
+    """The room a channel layer group belongs to, so `chat_{room}` sits with the room's keys."""
+    return group[len('chat_'):] if group.startswith('chat_') else group
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    channels_redis layer that places groups and channels on its hosts with
+    the HashRing instead of crc32 buckets, so adding a host only moves a
+    share of the groups.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = get_ring([host['address'] if 'address' in host else repr(host) for host in self.hosts])
+
+    def consistent_hash(self, value):
+        return self.ring.index_for(room_group_key(value))
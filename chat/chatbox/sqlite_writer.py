@@ -0,0 +1,125 @@
+# chatbox/sqlite_writer.py
+"""
+Single writer for the SQLite deployment mode (SQLITE_SINGLE_WRITER = True).
+
+SQLite lets one connection write at a time, so consumers and REST requests
+inserting on their own connections queue up on the write lock and, in a burst,
+fail with "database is locked". In this mode message writes are handed to one
+writer thread per process instead. It takes whatever writes are waiting (up to
+SQLITE_WRITER_MAX_BATCH) and runs them in one transaction, each in its own
+savepoint so a failing write doesn't undo the others, then commits once. A
+caller gets its result when its batch has committed.
+
+Reads don't go through the writer: the connection options in settings put the
+database in WAL mode, where queries on other connections read the last commit
+without waiting for the writer.
+
+With the mode off, on another database, or on an in-memory SQLite database
+(the test database), writes run where they are called, as before.
+"""
+import asyncio
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from . import metrics
+from .async_db import db_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    if not getattr(settings, 'SQLITE_SINGLE_WRITER', False):
+        return False
+    return connection.vendor == 'sqlite' and not connection.is_in_memory_db()
+
+
+class SQLiteWriter:
+    def __init__(self):
+        self._jobs = queue.SimpleQueue()  # (future, func, args, kwargs)
+        self._thread = threading.Thread(target=self._run, name='chat-sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._jobs.put((future, func, args, kwargs))
+        return future
+
+    def in_writer(self):
+        return threading.current_thread() is self._thread
+
+    def _run(self):
+        while True:
+            batch = [self._jobs.get()]
+            max_batch = getattr(settings, 'SQLITE_WRITER_MAX_BATCH', 200)
+            while len(batch) < max_batch:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            self._write(batch)
+
+    def _write(self, batch):
+        metrics.SQLITE_WRITER_BATCH_SIZE.observe(len(batch))
+        done = []
+        try:
+            with transaction.atomic():
+                for future, func, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with transaction.atomic():
+                            done.append((future, func(*args, **kwargs)))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:
+            # Nothing in the batch committed, including writes that never got to run.
+            logger.error(f"SQLite writer batch of {len(batch)} writes failed: {e}")
+            for future, *_ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in done:
+            future.set_result(result)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = SQLiteWriter()
+        return _writer
+
+
+def run(func, *args, **kwargs):
+    """
+    Runs a write on the writer and waits for its batch to commit, or runs it
+    right here when the mode is off. Call it outside any transaction: one
+    holding the write lock would keep the writer waiting.
+    """
+    if not enabled() or get_writer().in_writer():
+        return func(*args, **kwargs)
+    return get_writer().submit(func, *args, **kwargs).result()
+
+
+def db_write(func):
+    """
+    db_sync_to_async for writes: queued on the writer when the mode is on.
+    Works as a decorator and as db_write(func)(*args).
+    """
+    @functools.wraps(func)
+    async def call(*args, **kwargs):
+        if not enabled():
+            return await db_sync_to_async(func)(*args, **kwargs)
+        return await asyncio.wrap_future(get_writer().submit(func, *args, **kwargs))
+    return call
@@ -1,3 +1,935 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import (
+    archive, conversations, history_cache, outbound, persistence, presence, read_state, resume_log, room_log,
+    search, sqlite_writer,
+)
+from .consumers import ChatConsumer
+from .management.commands.chat_benchmark import preload_lua_scripts, start_fake_redis
+from .models import (
+    ArchiveSegment, ChatMessage, Conversation, ImageBlob, Participant, ReadWatermark, dm_conversation_key,
+)
+from .pagination import MessageKeysetPagination
+from .redis_pool import close_redis, get_redis, get_sync_redis, shard_url
+from .serializers import ChatMessageSerializer, message_rows
+from .sharding import HashRing, ShardedRedisChannelLayer
+
+User = get_user_model()
+
+
+def run_async(func, *args):
+    """Runs a coroutine function to completion, closing the Redis pools of its loop afterwards."""
+    async def call():
+        try:
+            return await func(*args)
+        finally:
+            await close_redis()
+    return async_to_sync(call)()
+
+
+class FakeRedisTestCase(TestCase):
+    """A TestCase against its own in-process fakeredis server, flushed before every test."""
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import fakeredis  # noqa: F401
+        except ImportError:
+            raise unittest.SkipTest("needs the fakeredis package")
+        url, server = start_fake_redis()
+        cls.addClassCleanup(server.shutdown)
+        redis_settings = override_settings(REDIS_URL=url, REDIS_SHARD_URLS=[])
+        redis_settings.enable()
+        # A cleanup rather than tearDownClass, so it runs after a subclass' own
+        # settings overrides are undone and restores the original settings last.
+        cls.addClassCleanup(redis_settings.disable)
+        # fakeredis drops the connection on NOSCRIPT, so EVALSHA must always hit.
+        preload_lua_scripts()
+        super().setUpClass()
+
+    def setUp(self):
+        get_sync_redis().flushdb()
+
+
+# The newest page is normally answered by the Redis history cache; an empty
+# cache window sends every page to the database, which is what's measured here.
+@override_settings(HISTORY_CACHE_SIZE=0)
+class MessageHistoryQueryCountTests(TestCase):
+    """History pages must cost the same number of queries whatever their size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        cls.bob = User.objects.create_user('bob', password='pw')
+        blob = ImageBlob.objects.create(
+            sha256='a' * 64, content_type='image/png', size=10,
+            width=40, height=30, thumbnail_width=40, thumbnail_height=30,
+        )
+        for i in range(30):
+            sender, receiver = (cls.alice, cls.bob) if i % 2 else (cls.bob, cls.alice)
+            image = blob if i % 3 == 0 else None
+            ChatMessage.objects.create(sender=sender, message=f'room {i}', image=image, room_name='general')
+            ChatMessage.objects.create(sender=sender, receiver=receiver, is_dm=True, message=f'dm {i}', image=image,
+                                       room_name=dm_conversation_key(cls.alice.id, cls.bob.id))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+        # The archive marker lives in Redis; nothing here is archived.
+        patcher = mock.patch('chatbox.archive.has_archived', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_room_page_is_one_query_for_any_page_size(self):
+        for page_size in (1, 10, 30):
+            with self.assertNumQueries(1):
+                response = self.client.get(f'/api/messages/?room_name=general&page_size={page_size}')
+            self.assertEqual(len(response.json()['results']), page_size)
+
+    def test_dm_page_query_count_is_constant(self):
+        # One for the rows, one for the read watermarks.
+        for page_size in (1, 10, 30):
+            with self.assertNumQueries(2):
+                response = self.client.get(f'/api/messages/?receiver_id={self.alice.id}&page_size={page_size}')
+            self.assertEqual(len(response.json()['results']), page_size)
+
+    def test_older_page_is_one_query(self):
+        first = self.client.get('/api/messages/?room_name=general&page_size=10').json()
+        with self.assertNumQueries(1):
+            older = self.client.get(first['next']).json()
+        self.assertEqual(older['results'][0]['message'], 'room 19')
+
+    def test_rows_match_model_serializer(self):
+        messages = ChatMessage.objects.filter(conversation='general').order_by('-timestamp', '-id')[:10]
+        expected = [dict(item) for item in ChatMessageSerializer(messages, many=True).data]
+        response = self.client.get('/api/messages/?room_name=general&page_size=10')
+        self.assertEqual(response.json()['results'], expected)
+
+
+@override_settings(HISTORY_CACHE_SIZE=0)
+class MessageKeysetPaginationTests(TestCase):
+    """Cursor pages see every message exactly once, in (-timestamp, -id) order, even on timestamp ties."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='pw')
+        now = timezone.now()
+        # Three messages per timestamp, so most page boundaries fall inside a tie.
+        for i in range(12):
+            ChatMessage.objects.create(sender=cls.alice, message=f'm{i}', room_name='general',
+                                       timestamp=now - timedelta(seconds=10 - i // 3))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        patcher = mock.patch('chatbox.archive.has_archived', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expected(self):
+        return list(ChatMessage.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+
+    def walk(self, url, link):
+        pages = []
+        while url:
+            page = self.client.get(url).json()
+            pages.append([message['id'] for message in page['results']])
+            url = page[link]
+        return pages
+
+    def test_older_pages_cover_every_message_once(self):
+        pages = self.walk('/api/messages/?room_name=general&page_size=2', 'next')
+        self.assertEqual([message_id for page in pages for message_id in page], self.expected())
+        self.assertTrue(all(len(page) == 2 for page in pages))
+
+    def test_newer_pages_walk_back_to_the_newest(self):
+        expected = self.expected()
+        cursor = MessageKeysetPagination().encode_cursor(ChatMessage.objects.get(id=expected[-1]))
+        pages = self.walk(f'/api/messages/?room_name=general&page_size=5&after={cursor}', 'previous')
+        self.assertEqual([message_id for page in reversed(pages) for message_id in page], expected[:-1])
+
+    def test_new_messages_dont_shift_older_pages(self):
+        first = self.client.get('/api/messages/?room_name=general&page_size=4').json()
+        ChatMessage.objects.create(sender=self.alice, message='new', room_name='general')
+        older = self.client.get(first['next']).json()
+        self.assertEqual([message['id'] for message in older['results']], self.expected()[5:9])
+
+    def test_malformed_cursor_is_not_found(self):
+        response = self.client.get('/api/messages/?room_name=general&before=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageCreateValidationTests(TestCase):
+    """Bad REST posts are the client's fault: 400, never 500."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_unknown_image_id_is_rejected(self):
+        response = self.client.post('/api/messages/', {'room_name': 'general', 'image_id': 'nope'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_image_content_is_rejected(self):
+        response = self.client.post('/api/messages/', {'room_name': 'general', 'image_content': 'data:image/png;base64,@@@'},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_room_is_rejected(self):
+        response = self.client.post('/api/messages/', {'message': 'hi'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ChatMessage.objects.exists())
+
+
+@override_settings(CHAT_PERSISTENCE_MODE='write_behind')
+class WriteBehindTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+
+    def make_message(self, message_id, sender=None, text='hi'):
+        message = ChatMessage(id=message_id, sender=sender or self.alice, message=text, room_name='general')
+        message.conversation = message.build_conversation_key()
+        return message
+
+    def test_flush_inserts_and_trims_journal(self):
+        buffer = persistence.WriteBehindBuffer()
+
+        async def add_and_flush():
+            await buffer.add(self.make_message(await persistence.aallocate_message_id()))
+            await buffer.flush()
+        run_async(add_and_flush)
+
+        self.assertEqual(ChatMessage.objects.count(), 1)
+        self.assertEqual(Conversation.objects.get(key='general').last_message_id, ChatMessage.objects.get().id)
+        self.assertFalse(get_sync_redis().exists(buffer.journal_key))
+
+    def test_replaying_a_journal_is_harmless(self):
+        records = [persistence.message_to_record(self.make_message(i)) for i in (1, 2)]
+        persistence.insert_records(records)
+        persistence.insert_records(records)
+        self.assertEqual(sorted(ChatMessage.objects.values_list('id', flat=True)), [1, 2])
+
+    def test_taken_id_is_stored_under_a_new_one(self):
+        taken = ChatMessage.objects.create(sender=self.bob, message='older', room_name='general')
+        get_sync_redis().set(persistence.ID_SEQUENCE_KEY, 0)
+        with self.assertLogs('chatbox.persistence', 'ERROR'):
+            persistence.insert_records([persistence.message_to_record(self.make_message(taken.id, text='newer'))])
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        self.assertGreater(ChatMessage.objects.get(message='newer').id, taken.id)
+
+    def test_seeding_only_moves_the_sequence_up(self):
+        top = ChatMessage.objects.create(sender=self.alice, message='x', room_name='general').id
+        redis_conn = get_sync_redis()
+        redis_conn.set(persistence.ID_SEQUENCE_KEY, 0)
+        persistence.seed_id_sequence()
+        self.assertEqual(int(redis_conn.get(persistence.ID_SEQUENCE_KEY)), top)
+        redis_conn.set(persistence.ID_SEQUENCE_KEY, top + 100)
+        persistence.seed_id_sequence()
+        self.assertEqual(int(redis_conn.get(persistence.ID_SEQUENCE_KEY)), top + 100)
+
+    def test_dead_workers_journal_is_recovered_once_its_heartbeat_expires(self):
+        redis_conn = get_sync_redis()
+        journal_key = f'{persistence.JOURNAL_PREFIX}gone'
+        heartbeat_key = f'{persistence.HEARTBEAT_PREFIX}gone'
+        redis_conn.hset(journal_key, 7, persistence.message_to_record(self.make_message(7)))
+        redis_conn.set(heartbeat_key, 1)
+
+        async def recover():
+            await persistence.recover_orphaned_journals()
+            self.assertFalse(await database_count())
+            # A restarted worker keeps looking until the predecessor's heartbeat is gone.
+            buffer = persistence.WriteBehindBuffer()
+            original_ttl, persistence.HEARTBEAT_TTL = persistence.HEARTBEAT_TTL, 0.05
+            try:
+                buffer.start_recovery()
+                await asyncio.sleep(0.1)
+                await get_redis().delete(heartbeat_key)
+                for _ in range(40):
+                    await asyncio.sleep(0.05)
+                    if await database_count():
+                        break
+            finally:
+                buffer.stop_recovery()
+                persistence.HEARTBEAT_TTL = original_ttl
+
+        async def database_count():
+            return await database_sync_to_async(ChatMessage.objects.count)()
+
+        run_async(recover)
+        self.assertEqual(list(ChatMessage.objects.values_list('id', flat=True)), [7])
+        self.assertFalse(redis_conn.keys(f'{persistence.JOURNAL_PREFIX}*'))
+
+    def journal_of_a_dead_worker(self, key, message_id):
+        get_sync_redis().hset(key, message_id, persistence.message_to_record(self.make_message(message_id)))
+
+    def test_journal_being_recovered_is_left_to_its_claimer(self):
+        token = 'live'
+        self.journal_of_a_dead_worker(f'{persistence.JOURNAL_PREFIX}gone{persistence.CLAIMED_MARKER}{token}', 7)
+        get_sync_redis().set(f'{persistence.CLAIM_PREFIX}{token}', 1)
+        run_async(persistence.recover_orphaned_journals)
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_claim_of_a_worker_that_died_recovering_is_taken_over(self):
+        self.journal_of_a_dead_worker(f'{persistence.JOURNAL_PREFIX}gone{persistence.CLAIMED_MARKER}expired', 7)
+        run_async(persistence.recover_orphaned_journals)
+        self.assertEqual(list(ChatMessage.objects.values_list('id', flat=True)), [7])
+        self.assertFalse(get_sync_redis().keys('chat_persist:*'))
+
+    def test_concurrent_recoveries_insert_a_journal_once(self):
+        self.journal_of_a_dead_worker(f'{persistence.JOURNAL_PREFIX}gone', 7)
+        inserted = []
+
+        def insert_records(records):
+            inserted.append(records)
+            return persistence_insert_records(records)
+        persistence_insert_records = persistence.insert_records
+
+        async def recover_twice():
+            await asyncio.gather(persistence.recover_orphaned_journals(), persistence.recover_orphaned_journals())
+        with mock.patch('chatbox.persistence.insert_records', insert_records):
+            run_async(recover_twice)
+        self.assertEqual(len(inserted), 1)
+        self.assertEqual(ChatMessage.objects.count(), 1)
+
+    def test_cache_refill_waits_for_pending_messages(self):
+        message = {'id': 1, 'message': 'hi'}
+        run_async(history_cache.apush, 'general', message, True)
+        version, _, _ = history_cache.read('general', 10)
+        self.assertFalse(history_cache.fill('general', version, [{'id': 0, 'message': 'older'}]))
+
+        run_async(history_cache.asettle, {'general': 1})
+        version, _, _ = history_cache.read('general', 10)
+        self.assertTrue(history_cache.fill('general', version, [message]))
+        self.assertEqual(history_cache.read('general', 10)[2], [message])
+
+    def test_settling_after_the_pending_count_expired_drops_the_window(self):
+        run_async(history_cache.apush, 'general', {'id': 1}, True)
+        redis_conn = get_sync_redis()
+        redis_conn.delete(history_cache.pending_key('general'))
+        version, _, _ = history_cache.read('general', 10)
+        history_cache.fill('general', version, [{'id': 0}])
+        run_async(history_cache.asettle, {'general': 1})
+        self.assertFalse(redis_conn.exists(history_cache.cache_key('general')))
+
+
+@override_settings(CHAT_PERSISTENCE_MODE='stream', WRITE_BEHIND_MAX_DELAY=0.05)
+class RoomLogTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def make_message(self, text):
+        message = ChatMessage(sender=self.alice, message=text, room_name='general')
+        message.conversation = message.build_conversation_key()
+        return message
+
+    def texts(self, url):
+        page = self.client.get(url).json()
+        return [message['message'] for message in page['results']], page['next']
+
+    def test_appended_messages_reach_the_database_through_the_persist_feed(self):
+        async def append_and_persist():
+            messages = [self.make_message(text) for text in ('one', 'two')]
+            for message in messages:
+                await room_log.aappend(message)
+            redis_conn = get_redis()
+            for _ in range(100):
+                if not await redis_conn.xlen(room_log.FEED_KEY):
+                    break
+                await asyncio.sleep(0.02)
+            await room_log.shutdown()
+            return [message.id for message in messages]
+        ids = run_async(append_and_persist)
+
+        self.assertEqual(list(ChatMessage.objects.order_by('id').values_list('id', 'message')),
+                         [(ids[0], 'one'), (ids[1], 'two')])
+        self.assertEqual(Conversation.objects.get(key='general').last_message_id, ids[1])
+        self.assertEqual(get_sync_redis().xlen(room_log.FEED_KEY), 0)
+
+    def test_history_is_read_back_from_the_stream(self):
+        for text in ('one', 'two', 'three'):
+            room_log.append(self.make_message(text))
+        self.assertFalse(ChatMessage.objects.exists())
+        newest, next_url = self.texts('/api/messages/?room_name=general&page_size=2')
+        self.assertEqual(newest, ['three', 'two'])
+        self.assertEqual(self.texts(next_url), (['one'], None))
+
+    def test_history_merges_logged_messages_with_persisted_ones(self):
+        ChatMessage.objects.create(sender=self.alice, message='persisted', room_name='general')
+        room_log.append(self.make_message('logged'))
+        self.assertEqual(self.texts('/api/messages/?room_name=general')[0], ['logged', 'persisted'])
+
+
+class HistoryCacheTests(FakeRedisTestCase):
+    def test_push_after_a_refill_that_has_the_message_is_skipped(self):
+        older, message = {'id': 1, 'message': 'older'}, {'id': 2, 'message': 'hi'}
+        version, _, _ = history_cache.read('general', 10)
+        # The refill read the database after the insert, and lands before the push.
+        self.assertTrue(history_cache.fill('general', version, [message, older]))
+        history_cache.push('general', message)
+        self.assertEqual(history_cache.read('general', 10)[2], [message, older])
+
+    def test_late_push_goes_in_by_id(self):
+        version, _, _ = history_cache.read('general', 10)
+        history_cache.fill('general', version, [{'id': 3}, {'id': 1}])
+        history_cache.push('general', {'id': 2})
+        history_cache.push('general', {'id': 4})
+        self.assertEqual([message['id'] for message in history_cache.read('general', 10)[2]], [4, 3, 2, 1])
+
+
+@override_settings(RESUME_LOG_SIZE=3, RESUME_MAX_REPLAY=10)
+class ResumeTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.consumer = ChatConsumer()
+        self.consumer.user = self.alice
+        self.consumer.actual_room_name = 'general'
+        self.consumer.outbound = mock.Mock()
+
+    def send(self, count, logged=True, stored=True):
+        """Saves and/or logs `count` messages the way the consumer does; returns their ids."""
+        ids = []
+        for _ in range(count):
+            message = ChatMessage.objects.create(sender=self.alice, message='hi', room_name='general')
+            frame = resume_log.message_frame(ChatMessageSerializer(message).data)
+            if logged:
+                resume_log.append('general', message.id, frame)
+            ids.append(message.id)
+            if not stored:
+                message.delete()
+        return ids
+
+    def resume(self, last_id):
+        """Resumes after last_id; returns the replayed ids and the closing 'resumed' frame."""
+        self.consumer.outbound.reset_mock()
+        run_async(self.consumer.resume, last_id)
+        frames = [json.loads(call.args[0]) for call in self.consumer.outbound.put.call_args_list]
+        return [frame['id'] for frame in frames[:-1]], frames[-1]
+
+    def test_resumes_from_the_log(self):
+        first, *missed = self.send(3)
+        with mock.patch.object(resume_log, 'missed_from_db', wraps=resume_log.missed_from_db) as from_db:
+            replayed, resumed = self.resume(first)
+        self.assertEqual(replayed, missed)
+        self.assertEqual((resumed['type'], resumed['replayed'], resumed['complete']), ('resumed', 2, True))
+        from_db.assert_not_called()
+
+    def test_falls_back_to_the_database_once_the_log_is_trimmed(self):
+        first, *missed = self.send(5)
+        with mock.patch.object(resume_log, 'missed_from_db', wraps=resume_log.missed_from_db) as from_db:
+            replayed, resumed = self.resume(first)
+        self.assertEqual(replayed, missed)
+        self.assertTrue(resumed['complete'])
+        from_db.assert_called_once()
+
+    def test_log_and_database_are_merged_without_duplicates(self):
+        # The log only covers the last three; the newest two are logged but
+        # not inserted yet, as in write-behind mode.
+        first, *stored = self.send(3)
+        pending = self.send(2, stored=False)
+        replayed, _ = self.resume(first)
+        self.assertEqual(replayed, stored + pending)
+
+    def test_live_copies_of_replayed_messages_are_skipped(self):
+        first, *missed = self.send(3)
+        self.resume(first)
+        self.consumer.outbound.reset_mock()
+        for message_id in [*missed, missed[-1] + 1]:
+            run_async(self.consumer.chat_message_broadcast, {'id': message_id, 'frame': str(message_id)})
+        self.assertEqual([call.args[0] for call in self.consumer.outbound.put.call_args_list],
+                         [str(missed[-1] + 1)])
+
+
+class ArchiveTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_root.cleanup)
+        root_settings = override_settings(ARCHIVE_ROOT=archive_root.name)
+        root_settings.enable()
+        self.addCleanup(root_settings.disable)
+        archive._archived.clear()
+        archive._segments.clear()
+
+        self.alice = User.objects.create_user('alice', password='pw')
+        Conversation.objects.create(key='general')
+        now = timezone.now()
+        # 15 messages from two months back (spanning segments), then 10 recent ones.
+        for i in range(25):
+            age = timedelta(days=60 - i * 2) if i < 15 else timedelta(minutes=25 - i)
+            ChatMessage.objects.create(sender=self.alice, message=f'm{i}', room_name='general', timestamp=now - age)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def newest_first(self):
+        return [f'm{i}' for i in reversed(range(25))]
+
+    def walk(self, url, link='next'):
+        seen = []
+        while url:
+            page = self.client.get(url).json()
+            messages = [message['message'] for message in page['results']]
+            # Every page is newest first, whichever way we walk.
+            seen.extend(messages if link == 'next' else reversed(messages))
+            url = page[link]
+        return seen
+
+    def test_archived_rows_read_back_unchanged(self):
+        before = list(message_rows(ChatMessage.objects.filter(timestamp__lt=timezone.now() - timedelta(days=30))
+                                   .order_by('-timestamp', '-id')))
+        self.assertEqual(archive.archive_old_messages(days=30), len(before))
+        self.assertEqual(ChatMessage.objects.count(), 25 - len(before))
+        self.assertGreater(ArchiveSegment.objects.count(), 1)
+        self.assertEqual(archive.read_before('general', None, 100), before)
+
+    def test_pages_continue_into_the_archive_and_back(self):
+        archive.archive_old_messages(days=30)
+        older = self.walk('/api/messages/?room_name=general&page_size=4')
+        self.assertEqual(older, self.newest_first())
+
+        oldest = ChatMessage(timestamp=timezone.now() - timedelta(days=61), id=0)
+        cursor = MessageKeysetPagination().encode_cursor(oldest)
+        newer = self.walk(f'/api/messages/?room_name=general&page_size=4&after={cursor}', link='previous')
+        self.assertEqual(newer, list(reversed(self.newest_first())))
+
+    def test_newest_page_of_a_fully_archived_conversation(self):
+        archive.archive_old_messages(days=0)
+        self.assertFalse(ChatMessage.objects.exists())
+        for _ in range(2):  # a cache miss, then whatever the cache holds
+            page = self.client.get('/api/messages/?room_name=general&page_size=4').json()
+            self.assertEqual([message['message'] for message in page['results']], self.newest_first()[:4])
+            self.assertIsNotNone(page['next'])
+        self.assertEqual(self.walk('/api/messages/?room_name=general&page_size=4'), self.newest_first())
+
+    def test_newest_page_is_topped_up_from_the_archive(self):
+        archive.archive_old_messages(days=30)
+        page = self.client.get('/api/messages/?room_name=general&page_size=14').json()
+        self.assertEqual([message['message'] for message in page['results']], self.newest_first()[:14])
+        self.assertIsNotNone(page['next'])
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+
+    def send(self, sender, room_name, receiver=None):
+        message = ChatMessage.objects.create(sender=sender, receiver=receiver, is_dm=receiver is not None,
+                                             message='hi', room_name=room_name)
+        conversations.record_messages([message])
+        return message
+
+    def entry(self, user, conversation):
+        return Participant.objects.get(user=user, conversation_id=conversation)
+
+    def test_dm_messages_count_as_unread_for_the_receiver_only(self):
+        key = dm_conversation_key(self.alice.id, self.bob.id)
+        for _ in range(3):
+            self.send(self.alice, key, receiver=self.bob)
+        self.assertEqual(self.entry(self.bob, key).unread_count, 3)
+        self.assertEqual(self.entry(self.alice, key).unread_count, 0)
+
+    def test_public_room_messages_write_no_member_rows(self):
+        self.send(self.bob, 'general')
+        with CaptureQueriesContext(connection) as queries:
+            last = self.send(self.alice, 'general')
+        writes = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "chatbox_participant"')]
+        self.assertEqual(writes, [])
+        self.assertEqual(self.entry(self.bob, 'general').unread_count, 0)
+        room = Conversation.objects.get(key='general')
+        self.assertEqual((room.last_message_id, room.last_activity, room.message_count), (last.id, last.timestamp, 2))
+
+    def test_chat_list_counts_public_room_unread_from_the_watermark(self):
+        self.send(self.alice, 'general')
+        self.send(self.bob, 'general')
+        self.send(self.alice, 'general')
+        last = self.send(self.alice, 'general')
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        # Bob's own message moved his watermark past everything before it.
+        self.assertEqual(client.get('/api/user-chats/').json()['results'][0]['unread_count'], 2)
+        read_state.advance_watermark(self.bob, 'general', last.id)
+        self.assertEqual(client.get('/api/user-chats/').json()['results'][0]['unread_count'], 0)
+
+    def test_chat_list_is_ordered_by_conversation_activity(self):
+        self.send(self.bob, 'general')
+        self.send(self.alice, dm_conversation_key(self.alice.id, self.bob.id), receiver=self.bob)
+        self.send(self.alice, 'general')
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        page = client.get('/api/user-chats/?page_size=1').json()
+        self.assertEqual([entry['key'] for entry in page['results']], ['general'])
+        older = client.get(page['next']).json()
+        self.assertEqual([entry['key'] for entry in older['results']], [dm_conversation_key(self.alice.id, self.bob.id)])
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.dm = dm_conversation_key(self.alice.id, self.bob.id)
+        self.messages = []
+        for _ in range(3):
+            message = ChatMessage.objects.create(sender=self.alice, receiver=self.bob, is_dm=True, message='hi',
+                                                 room_name=self.dm)
+            conversations.record_messages([message])
+            self.messages.append(message)
+
+    def watermark(self):
+        return ReadWatermark.objects.get(user=self.bob, conversation=self.dm).last_read_message_id
+
+    def unread(self):
+        return Participant.objects.get(user=self.bob, conversation_id=self.dm).unread_count
+
+    def test_watermark_only_moves_forward(self):
+        first, second, third = (message.id for message in self.messages)
+        self.assertTrue(read_state.advance_watermark(self.bob, self.dm, second))
+        self.assertEqual((self.watermark(), self.unread()), (second, 1))
+        self.assertFalse(read_state.advance_watermark(self.bob, self.dm, first))
+        self.assertEqual((self.watermark(), self.unread()), (second, 1))
+        self.assertTrue(read_state.advance_watermark(self.bob, self.dm, third))
+        self.assertEqual((self.watermark(), self.unread()), (third, 0))
+
+    def test_stale_receipt_costs_no_recount(self):
+        read_state.advance_watermark(self.bob, self.dm, self.messages[-1].id)
+        with self.assertNumQueries(2):  # the forward-only UPDATE and the row lookup
+            self.assertFalse(read_state.advance_watermark(self.bob, self.dm, self.messages[0].id))
+
+    def test_public_room_receipt_is_not_recounted(self):
+        read_state.advance_watermark(self.bob, 'general', 1)
+        with self.assertNumQueries(1):  # just the UPDATE
+            self.assertTrue(read_state.advance_watermark(self.bob, 'general', 5))
+
+    def test_is_read_follows_the_receivers_watermark(self):
+        read_state.advance_watermark(self.bob, self.dm, self.messages[1].id)
+        page = read_state.apply_read_state(self.dm, ChatMessageSerializer(self.messages, many=True).data)
+        self.assertEqual([message['is_read'] for message in page], [True, True, False])
+
+
+@override_settings(READ_RECEIPT_INTERVAL=0.05)
+class ReadReceiptThrottleTests(TestCase):
+    def receipts(self, *ids):
+        consumer = ChatConsumer()
+        consumer.actual_room_name = 'general'
+        written = []
+
+        async def advance(last_read_id):
+            written.append(last_read_id)
+            return True
+        consumer._advance_read_watermark = advance
+
+        async def send():
+            for last_read_id in ids:
+                await consumer.mark_messages_as_read(last_read_id)
+            await asyncio.sleep(0.1)
+        async_to_sync(send)()
+        return written
+
+    def test_burst_writes_the_first_and_the_newest(self):
+        self.assertEqual(self.receipts(5, 6, 8, 7), [5, 8])
+
+    def test_receipts_behind_the_connection_are_dropped(self):
+        self.assertEqual(self.receipts(5, 3, 5), [5])
+
+
+class MetricsViewTests(TestCase):
+    def test_closed_without_a_configured_token(self):
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_needs_the_token(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'chat_ws_frames_dropped_total', response.content)
+
+
+class PresenceSweeperTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice', password='pw')
+        patcher = mock.patch('chatbox.presence.get_broadcaster')
+        self.published = patcher.start().return_value.publish
+        self.addCleanup(patcher.stop)
+
+    async def go_stale(self, *entries):
+        stale = presence._now_ms() - presence.presence_ttl_ms() - 1000
+        await get_redis().zadd(presence.CONNECTIONS_KEY, {entry: stale for entry in entries})
+
+    async def sweep(self):
+        return await presence.PresenceSweeper().sweep(get_redis())
+
+    def test_stale_connections_are_counted_out(self):
+        async def scenario():
+            try:
+                await presence.user_online(self.alice, 'tab1')
+                await presence.user_online(self.alice, 'tab2')
+                await presence.room_activity_update('general', 'alice', 'joined', 'tab1')
+
+                # tab1 died with its worker; tab2 keeps the user online.
+                await self.go_stale(presence.connection_entry('tab1', 'alice'),
+                                    presence.connection_entry('tab1', 'alice', 'general'))
+                self.published.reset_mock()
+                self.assertEqual(await self.sweep(), 2)
+                _, online, rooms = await presence.read_snapshot_state()
+                self.assertEqual((online, rooms), ({'alice'}, []))
+                self.published.assert_called_once_with(
+                    ('room', 'general'), {'type': 'room_count_changed', 'name': 'general', 'online_count': 0})
+
+                await self.go_stale(presence.connection_entry('tab2', 'alice'))
+                self.published.reset_mock()
+                self.assertEqual(await self.sweep(), 1)
+                self.assertEqual((await presence.read_snapshot_state())[1], set())
+                self.published.assert_called_once_with(('user', 'alice'), {'type': 'user_left', 'username': 'alice'})
+
+                # Swept entries are gone; nobody is counted out twice.
+                self.assertEqual(await self.sweep(), 0)
+            finally:
+                await presence.shutdown()
+        run_async(scenario)
+
+    def test_heartbeat_keeps_a_connection(self):
+        async def scenario():
+            try:
+                await presence.room_activity_update('general', 'alice', 'joined', 'tab1')
+                await self.go_stale(presence.connection_entry('tab1', 'alice', 'general'))
+                await presence.room_activity_update('general', 'alice', 'heartbeat', 'tab1')
+                self.assertEqual(await self.sweep(), 0)
+                self.assertEqual((await presence.read_snapshot_state())[2], [('general', 1)])
+            finally:
+                await presence.shutdown()
+        run_async(scenario)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_codes = []
+
+    async def send(self, text_data):
+        self.sent.append(text_data)
+
+    async def close(self, code=None):
+        self.close_codes.append(code)
+
+
+@override_settings(OUTBOUND_QUEUE_SOFT_LIMIT=3, OUTBOUND_QUEUE_HIGH_WATER=5)
+class OutboundQueueTests(TestCase):
+    def deliver(self, puts):
+        """Queues (frame, policy, key) triples while the socket is busy, then lets it drain."""
+        socket = FakeSocket()
+
+        async def scenario():
+            queue = outbound.OutboundQueue(socket, 'chat')
+            # Nothing is sent until the writer task gets to run, as with a slow client.
+            accepted = [queue.put(frame, policy, key) for frame, policy, key in puts]
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            return accepted, queue.closed
+        accepted, closed = async_to_sync(scenario)()
+        return accepted, closed, socket
+
+    def test_droppable_frames_are_dropped_past_the_soft_limit(self):
+        accepted, closed, socket = self.deliver([
+            ('m1', outbound.KEEP, None), ('m2', outbound.KEEP, None), ('m3', outbound.KEEP, None),
+            ('p1', outbound.DROP, None), ('m4', outbound.KEEP, None),
+        ])
+        self.assertEqual(accepted, [True, True, True, False, True])
+        self.assertEqual((closed, socket.sent), (False, ['m1', 'm2', 'm3', 'm4']))
+
+    def test_coalesced_frames_keep_only_the_newest(self):
+        accepted, _, socket = self.deliver([
+            ('t1', outbound.COALESCE, 'typing'), ('m1', outbound.KEEP, None), ('t2', outbound.COALESCE, 'typing'),
+            ('t3', outbound.COALESCE, 'typing'),
+        ])
+        self.assertEqual(accepted, [True, True, True, True])
+        self.assertEqual(socket.sent, ['t3', 'm1'])
+
+    def test_client_past_the_high_water_mark_is_disconnected(self):
+        accepted, closed, socket = self.deliver([(f'm{i}', outbound.KEEP, None) for i in range(7)])
+        self.assertEqual(accepted, [True] * 5 + [False] * 2)
+        self.assertTrue(closed)
+        self.assertEqual(socket.sent, [])
+        self.assertEqual(socket.close_codes, [outbound.SLOW_CONSUMER_CLOSE_CODE])
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, text, sender=None, receiver=None, room_name='general'):
+        return ChatMessage.objects.create(sender=sender or self.alice, receiver=receiver, is_dm=receiver is not None,
+                                          message=text, room_name=room_name)
+
+    def found(self, query):
+        response = self.client.get('/api/messages/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [message['message'] for message in response.json()['results']]
+
+    def assertIndexIntact(self):
+        if search.fts_enabled():
+            with connection.cursor() as cursor:
+                # Compares the index with the message table; raises if they drifted apart.
+                cursor.execute(f"INSERT INTO {search.FTS_TABLE} ({search.FTS_TABLE}, rank) "
+                               f"VALUES ('integrity-check', 1)")
+
+    def test_every_word_must_match_and_the_last_as_a_prefix(self):
+        self.send('deploy the blue build')
+        self.send('deploy the green build')
+        self.assertEqual(self.found('deploy blu'), ['deploy the blue build'])
+        self.assertEqual(sorted(self.found('build')), ['deploy the blue build', 'deploy the green build'])
+
+    def test_snippet_marks_the_matches_and_escapes_the_rest(self):
+        self.send('<b>release</b> notes are out')
+        response = self.client.get('/api/messages/search/', {'q': 'release'}).json()
+        self.assertIn('<mark>release</mark>', response['results'][0]['snippet'])
+        self.assertIn('&lt;b&gt;', response['results'][0]['snippet'])
+
+    def test_other_peoples_dms_are_not_searched(self):
+        self.send('secret plan', sender=self.bob, receiver=self.carol,
+                  room_name=dm_conversation_key(self.bob.id, self.carol.id))
+        self.send('secret party', sender=self.bob, receiver=self.alice,
+                  room_name=dm_conversation_key(self.alice.id, self.bob.id))
+        self.assertEqual(self.found('secret'), ['secret party'])
+
+    def test_index_follows_edits_and_deletes(self):
+        edited = self.send('typo heer')
+        deleted = self.send('heer too')
+        ChatMessage.objects.filter(id=edited.id).update(message='typo here')
+        deleted.delete()
+        self.assertEqual(self.found('heer'), [])
+        self.assertEqual(self.found('here'), ['typo here'])
+        self.assertIndexIntact()
+
+    def test_bulk_inserts_and_archiving_keep_the_index_intact(self):
+        messages = [ChatMessage(sender=self.alice, message=f'batch {i}', room_name='general') for i in range(5)]
+        for message in messages:
+            message.conversation = message.build_conversation_key()
+        ChatMessage.objects.bulk_create(messages)
+        self.assertEqual(len(self.found('batch')), 5)
+        ChatMessage.objects.filter(message__startswith='batch').delete()
+        self.assertEqual(self.found('batch'), [])
+        self.assertIndexIntact()
+
+
+class ShardingTests(TestCase):
+    urls = [f'redis://shard-{i}:6379/0' for i in range(4)]
+    rooms = [f'room-{i}' for i in range(20000)]
+
+    def test_rooms_spread_evenly_over_the_nodes(self):
+        ring = HashRing(self.urls)
+        counts = Counter(ring.node_for(room) for room in self.rooms)
+        mean = len(self.rooms) / len(self.urls)
+        self.assertEqual(set(counts), set(self.urls))
+        for url in self.urls:
+            self.assertAlmostEqual(counts[url] / mean, 1, delta=0.1, msg=url)
+
+    def test_adding_a_node_only_moves_its_share_of_the_rooms(self):
+        ring, grown = HashRing(self.urls), HashRing([*self.urls, 'redis://shard-new:6379/0'])
+        moved = [room for room in self.rooms if ring.node_for(room) != grown.node_for(room)]
+        self.assertAlmostEqual(len(moved) / len(self.rooms), 1 / (len(self.urls) + 1), delta=0.03)
+        self.assertEqual({grown.node_for(room) for room in moved}, {'redis://shard-new:6379/0'})
+
+    def test_channel_layer_groups_sit_with_their_rooms_keys(self):
+        with override_settings(REDIS_URL=self.urls[0], REDIS_SHARD_URLS=self.urls):
+            layer = ShardedRedisChannelLayer(hosts=self.urls)
+            for room in self.rooms[:1000]:
+                self.assertEqual(self.urls[layer.consistent_hash(f'chat_{room}')], shard_url(room), room)
+
+
+class SQLiteWriterTests(TransactionTestCase):
+    def setUp(self):
+        # The writer is off for the in-memory test database; run one directly
+        # and record the batches it commits.
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.batches = []
+        write = sqlite_writer.SQLiteWriter._write
+
+        def record(writer, batch):
+            self.batches.append(len(batch))
+            write(writer, batch)
+        record_patch = mock.patch.object(sqlite_writer.SQLiteWriter, '_write', record)
+        record_patch.start()
+        self.addCleanup(record_patch.stop)
+        self.writer = sqlite_writer.SQLiteWriter()
+        for patch in (mock.patch.object(sqlite_writer, '_writer', self.writer),
+                      mock.patch.object(sqlite_writer, 'enabled', return_value=True)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def save(self, text):
+        """A write as the consumer does it: the message plus its summaries."""
+        def write():
+            message = ChatMessage.objects.create(sender=self.alice, message=text, room_name='general')
+            conversations.record_messages([message])
+            if text == 'bad':
+                raise ValueError('bad write')
+            return threading.current_thread().name
+        return write
+
+    def write_concurrently(self, writes):
+        """Runs each write through db_write from its own coroutine while the writer is busy; returns their outcomes."""
+        busy = threading.Event()
+        held = self.writer.submit(busy.wait)
+
+        async def scenario():
+            calls = [asyncio.ensure_future(sqlite_writer.db_write(write)()) for write in writes]
+            await asyncio.sleep(0.05)  # every call is queued behind the held batch
+            busy.set()
+            return await asyncio.gather(*calls, return_exceptions=True)
+        outcomes = async_to_sync(scenario)()
+        held.exception()  # waits for the held batch, whichever way it ended
+        return outcomes
+
+    def test_writes_from_many_coroutines_are_batched_on_the_writer(self):
+        texts = [f'm{i}' for i in range(5)]
+        outcomes = self.write_concurrently([self.save(text) for text in texts])
+        self.assertEqual(outcomes, ['chat-sqlite-writer'] * 5)
+        self.assertEqual(self.batches, [1, 5])
+        self.assertEqual(list(ChatMessage.objects.order_by('id').values_list('message', flat=True)), texts)
+        self.assertEqual(Conversation.objects.get(key='general').message_count, 5)
+
+    def test_a_failing_write_only_fails_its_own_caller(self):
+        outcomes = self.write_concurrently([self.save('first'), self.save('bad'), self.save('last')])
+        self.assertEqual(outcomes[0], 'chat-sqlite-writer')
+        self.assertIsInstance(outcomes[1], ValueError)
+        self.assertEqual(outcomes[2], 'chat-sqlite-writer')
+        self.assertEqual(self.batches, [1, 3])
+        # The failed write's savepoint was rolled back; the others committed.
+        self.assertEqual(sorted(ChatMessage.objects.values_list('message', flat=True)), ['first', 'last'])
+        self.assertEqual(Conversation.objects.get(key='general').message_count, 2)
+
+    def test_a_failed_batch_fails_every_caller(self):
+        with mock.patch.object(transaction, 'atomic', side_effect=OperationalError('database is locked')):
+            outcomes = self.write_concurrently([self.save('first'), self.save('last')])
+        self.assertTrue(all(isinstance(outcome, OperationalError) for outcome in outcomes))
+        self.assertFalse(ChatMessage.objects.exists())
\ No newline at end of file
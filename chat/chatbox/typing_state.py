@@ -0,0 +1,146 @@
+# chatbox/typing_state.py
+"""
+Server-side typing state, one sorted set per room.
+
+`room:{room}:typing` maps username -> expiry (ms since epoch), so a client that
+vanishes without a stop_typing drops out after TYPING_TTL on its own. Changes
+are not broadcast one by one: each worker coalesces the rooms it touched and,
+once per TYPING_TICK, publishes the room's whole typist list as a single
+'typing_users' event. The last published list is kept next to the set and the
+publish only happens if it differs, so refreshes, duplicate frames and two
+workers flushing the same change don't cost a fanout.
+"""
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .encoding import frame_event
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS: typing zset  ARGV: now (ms), username, 'start'|'stop', ttl (ms)
+# Returns 1 if the user was added or removed, 0 for a refresh or a no-op.
+UPDATE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if ARGV[3] == 'start' then
+    local added = redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[4]), ARGV[2])
+    redis.call('PEXPIRE', KEYS[1], ARGV[4])
+    return added
+end
+return redis.call('ZREM', KEYS[1], ARGV[2])
+"""
+
+# KEYS: typing zset, last published list  ARGV: now (ms), ttl (ms)
+# Returns {changed (0/1), earliest expiry or '', usernames json}.
+SNAPSHOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local members = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local names = {}
+for i = 1, #members, 2 do table.insert(names, members[i]) end
+-- ZRANGE is ordered by expiry, so the first score is the earliest one
+local earliest = members[2] or ''
+table.sort(names)
+local encoded = #names > 0 and cjson.encode(names) or '[]'
+if (redis.call('GET', KEYS[2]) or '[]') == encoded then
+    return {0, earliest, encoded}
+end
+redis.call('SET', KEYS[2], encoded, 'PX', tonumber(ARGV[2]) * 2)
+return {1, earliest, encoded}
+"""
+
+
+def typing_ttl_ms():
+    return int(getattr(settings, 'TYPING_TTL', 6) * 1000)
+
+
+def typing_key(room_name):
+    return f'room:{room_name}:typing'
+
+
+def published_key(room_name):
+    return f'room:{room_name}:typing:published'
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class TypingAggregator:
+    """
+    Collects the rooms whose typing state this worker changed and publishes
+    each of them at most once per tick. A room that still has typists is
+    checked again when the earliest of them expires.
+    """
+    def __init__(self):
+        self._dirty = set()
+        self._flush_task = None
+        self._expiry_timers = {}
+
+    def mark_dirty(self, room_name):
+        self._dirty.add(room_name)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_after_tick())
+
+    async def _flush_after_tick(self):
+        await asyncio.sleep(getattr(settings, 'TYPING_TICK', 0.3))
+        rooms = list(self._dirty)
+        self._dirty.clear()
+        for room_name in rooms:
+            await self.publish_room(room_name)
+
+    async def publish_room(self, room_name):
+        try:
+            script = get_redis(room_name).register_script(SNAPSHOT_SCRIPT)
+            changed, earliest, encoded = await script(
+                keys=[typing_key(room_name), published_key(room_name)],
+                args=[_now_ms(), typing_ttl_ms()],
+            )
+            if int(changed):
+                event = frame_event('typing.users.broadcast', {
+                    'type': 'typing_users',
+                    'room_name': room_name,
+                    'usernames': json.loads(encoded),
+                })
+                with metrics.time_group_send(event):
+                    await get_channel_layer().group_send(f'chat_{room_name}', event)
+        except Exception as e:
+            logger.error(f"Error publishing typing state for room {room_name}: {e}")
+            return
+
+        timer = self._expiry_timers.pop(room_name, None)
+        if timer is not None:
+            timer.cancel()
+        if earliest:
+            delay = max(int(float(earliest)) - _now_ms(), 0) / 1000
+            self._expiry_timers[room_name] = asyncio.get_running_loop().call_later(
+                delay + 0.05, self.mark_dirty, room_name)
+
+
+_aggregators = weakref.WeakKeyDictionary()
+
+
+def get_aggregator():
+    loop = asyncio.get_running_loop()
+    aggregator = _aggregators.get(loop)
+    if aggregator is None:
+        aggregator = _aggregators[loop] = TypingAggregator()
+    return aggregator
+
+
+async def set_typing(room_name, username, is_typing):
+    """
+    Records a start/stop (or refresh) of `username` typing in `room_name`. Only
+    an actual change schedules a publish; a refresh just pushes the expiry out.
+    """
+    script = get_redis(room_name).register_script(UPDATE_SCRIPT)
+    changed = await script(keys=[typing_key(room_name)],
+                           args=[_now_ms(), username, 'start' if is_typing else 'stop', typing_ttl_ms()])
+    if int(changed):
+        get_aggregator().mark_dirty(room_name)
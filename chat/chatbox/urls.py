@@ -1,8 +1,16 @@
 # chatbox/urls.py
-from django.urls import path
-from .views import ChatMessageListCreateView # Only need this view now
+from django.urls import path, re_path
+from .views import (
+    ChatMessageListCreateView, ImageUploadView, ImageDownloadView, MessageSearchView, MetricsView, UserChatListView,
+)
 
 urlpatterns = [
     path('messages/', ChatMessageListCreateView.as_view(), name='chat-message-list-create'),
+    path('messages/search/', MessageSearchView.as_view(), name='chat-message-search'),
+    path('user-chats/', UserChatListView.as_view(), name='user-chat-list'),
+    path('images/', ImageUploadView.as_view(), name='image-upload'),
+    re_path(r'^images/(?P<sha256>[0-9a-f]{64})/$', ImageDownloadView.as_view(), name='image-download'),
+    re_path(r'^images/(?P<sha256>[0-9a-f]{64})/thumbnail/$', ImageDownloadView.as_view(thumbnail=True), name='image-thumbnail'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 
 ]
@@ -1,18 +1,23 @@
 # chatbox/views.py
-import json
-import redis
-from django.conf import settings
-from django_redis import get_redis_connection
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.pagination import PageNumberPagination
-from .models import ChatMessage, User
-from .serializers import ChatMessageSerializer
-from django.db.models import Q
+from .models import ChatMessage, ImageBlob, Participant, User, dm_conversation_key
+from .serializers import ChatMessageSerializer, ConversationSummarySerializer, message_rows, serialize_message_rows
+from .pagination import ConversationKeysetPagination, MessageKeysetPagination
+from . import (
+    archive, blobs, conversations, history_cache, metrics, persistence, read_state, resume_log, room_log, search,
+    sqlite_writer,
+)
+from django.db import transaction
+from django.db.models import F, Q
 from rest_framework.views import APIView
+from rest_framework.parsers import MultiPartParser
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils.dateparse import parse_datetime
+import hmac
 import logging
 
 logger = logging.getLogger(__name__)
@@ -20,11 +25,29 @@ logger = logging.getLogger(__name__)
 class ChatMessageListCreateView(generics.ListCreateAPIView):
     serializer_class = ChatMessageSerializer
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = PageNumberPagination
+    pagination_class = MessageKeysetPagination
+
+    @property
+    def paginator(self):
+        """
+        Keyset (before=/after=) paging by default; requests that still pass
+        ?page= get the legacy page-number paginator.
+        """
+        if not hasattr(self, '_paginator'):
+            if 'page' in self.request.query_params:
+                self._paginator = PageNumberPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
-    def generate_cache_key(self, room_name):
-        """Generate consistent cache key."""
-        return f'chat_history:{room_name}'
+    def get_conversation_key(self, user, room_name=None, receiver_id=None):
+        """Same key the consumers use: the room name, or dm_<low>_<high> for DMs."""
+        if receiver_id is not None:
+            try:
+                return dm_conversation_key(user.id, receiver_id)
+            except (ValueError, TypeError):
+                return None
+        return room_name or None
 
     def _get_messages_from_db(self, user, room_name=None, receiver_id=None):
         """
@@ -39,128 +62,176 @@ class ChatMessageListCreateView(generics.ListCreateAPIView):
                 logger.error(f"Invalid receiver_id: {receiver_id}")
                 return ChatMessage.objects.none()
             
+        # Both branches are a range scan on the (conversation, -timestamp, -id) index.
         if room_name and not is_dm:
-            return ChatMessage.objects.filter(room_name=room_name).order_by('-timestamp')
+            return ChatMessage.objects.filter(conversation=room_name, is_dm=False).order_by('-timestamp')
         elif is_dm and receiver_id:
             return ChatMessage.objects.filter(
-                Q(sender=user, receiver_id=receiver_id, is_dm=True) |
-                Q(sender_id=receiver_id, receiver=user, is_dm=True)
+                conversation=dm_conversation_key(user.id, receiver_id), is_dm=True
             ).order_by('-timestamp')
         return ChatMessage.objects.none()
 
-    def get_redis_connection_safe(self):
-        """Get Redis connection with error handling."""
+    def _list_first_page_cached(self, request, conversation, queryset):
+        """
+        HOT PATH: serves the newest page from the history cache, refilling the
+        cache from one database query on a miss. Returns None when the cache
+        can't answer (Redis down, page larger than the cached window).
+        """
+        paginator = self.paginator
+        page_size = paginator.get_page_size(request)
+        window = history_cache.cache_size()
+        if page_size > window:
+            return None
+
         try:
-            redis_url = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
-            return redis.from_url(redis_url, decode_responses=True)
+            version, cached_count, messages = history_cache.read(conversation, page_size)
         except Exception as e:
-            logger.error(f"Failed to connect to Redis: {e}")
+            logger.error(f"Error reading from history cache: {e}")
             return None
 
-    def list(self, request, *args, **kwargs):
-        user = request.user
-        room_name = request.query_params.get('room_name')
-        receiver_id = request.query_params.get('receiver_id')
-
-        # --- This view no longer handles sync_receipts for simplicity ---
-        # The primary function is fetching message history.
+        if messages:
+            metrics.HISTORY_CACHE_REQUESTS.labels('hit').inc()
+            logger.debug(f"API CACHE HIT for {conversation}")
+            # The cache holds the newest `window` messages, so a short list is the whole table.
+            if cached_count > page_size or cached_count >= window:
+                has_older = True
+            else:
+                messages, has_older = self._top_up_from_archive(conversation, messages, page_size)
+            read_state.apply_read_state(conversation, messages)
+            page = paginator.paginate_cached(messages, request, has_older=has_older)
+            return paginator.get_paginated_response(page)
 
-        # Directly fetch from the database (the "cold path" is now the only path)
-        logger.info(f"Bypassing cache, fetching history directly from DB for user {user.id}")
-        
+        metrics.HISTORY_CACHE_REQUESTS.labels('miss').inc()
+        logger.debug(f"API CACHE MISS for {conversation}. Fetching from DB.")
+        data = serialize_message_rows(queryset.order_by('-timestamp', '-id')[:window])
         try:
-            # Get the base queryset
-            queryset = self._get_messages_from_db(user, room_name, receiver_id)
-            
-            # Paginate the queryset
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
+            history_cache.fill(conversation, version, data)
+        except Exception as e:
+            logger.error(f"Error refilling history cache: {e}")
 
-            # This fallback should ideally not be reached if pagination is configured
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
-            
+        if len(data) > page_size or len(data) == window:
+            page, has_older = data[:page_size], True
+        else:
+            page, has_older = self._top_up_from_archive(conversation, data, page_size)
+        page = read_state.apply_read_state(conversation, page)
+        page = paginator.paginate_cached(page, request, has_older=has_older)
+        return paginator.get_paginated_response(page)
+
+    def _top_up_from_archive(self, conversation, messages, page_size):
+        """
+        The newest page when the table holds no more than a page: fills it up
+        with the newest archived messages. Returns the page and whether older
+        messages remain.
+        """
+        if not archive.has_archived(conversation):
+            return messages, False
+        missing = page_size - len(messages)
+        if not missing:
+            return messages, True
+        start = (parse_datetime(messages[-1]['timestamp']), messages[-1]['id']) if messages else None
+        archived = archive.read_before(conversation, start, missing + 1)
+        return messages + serialize_message_rows(archived[:missing]), len(archived) > missing
+
+    def _list_from_room_log(self, request, conversation, queryset):
+        """
+        Stream mode: serves a newest-first page (the first, or one before a
+        cursor) from the room's stream. Where the stream doesn't reach back a
+        whole page, the database page is used instead, with any messages that
+        are logged but not persisted yet merged in.
+        """
+        paginator = self.paginator
+        page_size = paginator.get_page_size(request)
+        before = paginator.decode_cursor(request.query_params.get(paginator.before_query_param))
+        try:
+            logged = room_log.read_before(conversation, before[1] if before else None, page_size + 1)
         except Exception as e:
-            logger.error(f"Error fetching messages from database: {e}")
-            return Response(
-                {"detail": "Error fetching messages."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            logger.error(f"Error reading room log: {e}")
+            return None
+
+        if len(logged) > page_size:
+            page = read_state.apply_read_state(conversation, logged[:page_size])
+            page = paginator.paginate_cached(page, request, has_older=True, has_newer=before is not None)
+            return paginator.get_paginated_response(page)
+
+        rows = self._extend_from_archive(request, conversation, paginator.paginate_queryset(queryset, request))
+        stored = {row['id']: row for row in serialize_message_rows(rows)}
+        stored.update((message['id'], message) for message in logged)
+        data = sorted(stored.values(), key=lambda message: message['id'], reverse=True)
+        has_older = paginator.has_older or len(data) > page_size
+        page = read_state.apply_read_state(conversation, data[:page_size])
+        page = paginator.paginate_cached(page, request, has_older=has_older, has_newer=before is not None)
+        return paginator.get_paginated_response(page)
+
+    def _extend_from_archive(self, request, conversation, rows):
+        """
+        Keyset pages reach past the oldest message left in the table into the
+        archive (chatbox.archive): an older page the table can't fill, or a
+        newer page from a cursor inside the archive, takes archived rows first.
+        """
+        paginator = self.paginator
+        after = paginator.decode_cursor(request.query_params.get(paginator.after_query_param))
+        if (after is None and paginator.has_older) or not archive.has_archived(conversation):
+            return rows
+        page_size = paginator.get_page_size(request)
+        if after is not None:
+            archived = archive.read_after(conversation, after, page_size + 1)
+            if not archived:
+                return rows
+            archived_ids = {row['id'] for row in archived}
+            newer = archived + [row for row in reversed(rows) if row['id'] not in archived_ids]
+            paginator.has_newer = paginator.has_newer or len(newer) > page_size
+            paginator.page = newer[:page_size][::-1]
+            return paginator.page
+
+        missing = page_size - len(rows)
+        if rows:
+            start = (rows[-1]['timestamp'], rows[-1]['id'])
+        else:
+            start = paginator.decode_cursor(request.query_params.get(paginator.before_query_param))
+        archived = archive.read_before(conversation, start, missing + 1)
+        if not archived:
+            return rows
+        paginator.has_older = len(archived) > missing
+        paginator.page = list(rows) + archived[:missing]
+        return paginator.page
 
-        # --- Handle normal message history fetching ---
+    def list(self, request, *args, **kwargs):
         user = request.user
         room_name = request.query_params.get('room_name')
         receiver_id = request.query_params.get('receiver_id')
 
-        # Determine cache key
-        if room_name:
-            cache_key = self.generate_cache_key(room_name)
-        elif receiver_id:
-            try:
-                int(receiver_id)
-                user_ids = sorted([str(user.id), str(receiver_id)])
-                dm_room_name = f'dm_{"_".join(user_ids)}'
-                cache_key = self.generate_cache_key(dm_room_name)
-            except (ValueError, TypeError):
-                return Response(
-                    {"detail": "Invalid receiver_id."}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        else:
-            return Response({"results": []})
+        try:
+            # Plain rows with sender/receiver/image joined in: one query per page, whatever its size.
+            queryset = message_rows(self._get_messages_from_db(user, room_name, receiver_id))
+            conversation = self.get_conversation_key(user, room_name, receiver_id)
 
-        # Try to get Redis connection
-        redis_conn = self.get_redis_connection_safe()
-        
-        if redis_conn:
-            try:
-                # --- HOT PATH: Try cache first ---
-                cached_messages = redis_conn.lrange(cache_key, 0, -1)
-                if cached_messages:
-                    logger.info(f"API CACHE HIT for {cache_key}")
-                    # Reverse because we store newest first in cache
-                    data = [json.loads(msg) for msg in reversed(cached_messages)]
-                    
-                    page = self.paginate_queryset(data)
-                    if page is not None:
-                        return self.get_paginated_response(page)
-                    
-                    return Response(data)
-            except Exception as e:
-                logger.error(f"Error reading from cache: {e}")
-                # Fall through to database query
+            keyset = isinstance(self.paginator, MessageKeysetPagination)
+            if (conversation and keyset and room_log.enabled()
+                    and self.paginator.after_query_param not in request.query_params):
+                response = self._list_from_room_log(request, conversation, queryset)
+                if response is not None:
+                    return response
+
+            # Only the newest page is cached; deeper pages go to the database.
+            elif conversation and keyset and self.paginator.is_first_page_request(request):
+                response = self._list_first_page_cached(request, conversation, queryset)
+                if response is not None:
+                    return response
 
-        # --- COLD PATH: Cache miss or Redis unavailable ---
-        logger.info(f"API CACHE MISS for {cache_key}. Fetching from DB.")
-        
-        try:
-            queryset = self._get_messages_from_db(user, room_name, receiver_id)
-            
             page = self.paginate_queryset(queryset)
             if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                
-                # Update cache if Redis is available and we have data
-                if redis_conn and serializer.data:
-                    try:
-                        pipeline = redis_conn.pipeline()
-                        pipeline.delete(cache_key)
-                        # Store messages in reverse order (newest first)
-                        for message in reversed(serializer.data):
-                            pipeline.lpush(cache_key, json.dumps(message))
-                        pipeline.ltrim(cache_key, 0, 49)  # Keep last 50 messages
-                        pipeline.execute()
-                        logger.info(f"Cache updated for {cache_key}")
-                    except Exception as e:
-                        logger.error(f"Error updating cache: {e}")
-                        
-                return self.get_paginated_response(serializer.data)
-
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+                if conversation and keyset:
+                    page = self._extend_from_archive(request, conversation, page)
+                data = serialize_message_rows(page)
+                if conversation:
+                    read_state.apply_read_state(conversation, data)
+                return self.get_paginated_response(data)
+
+            # This fallback should ideally not be reached if pagination is configured
+            return Response(serialize_message_rows(queryset))
             
+        except APIException:
+            raise
         except Exception as e:
             logger.error(f"Error fetching messages from database: {e}")
             return Response(
@@ -182,83 +253,207 @@ class ChatMessageListCreateView(generics.ListCreateAPIView):
             if is_dm and receiver_id:
                 try:
                     receiver_instance = User.objects.get(id=receiver_id)
-                    user_ids = sorted([str(sender.id), str(receiver_id)])
-                    room_name = f'dm_{"_".join(user_ids)}'
+                    room_name = dm_conversation_key(sender.id, receiver_id)
                 except User.DoesNotExist:
-                    raise generics.ValidationError("Receiver user not found.")
+                    raise ValidationError("Receiver user not found.")
             
             if not room_name:
-                raise generics.ValidationError("Room name or receiver is required.")
-
-            # Save the message
-            instance = serializer.save(
-                sender=sender, 
-                room_name=room_name, 
-                receiver=receiver_instance, 
-                is_dm=is_dm
-            )
+                raise ValidationError("Room name or receiver is required.")
 
-            # Update the cache
-            message_data = ChatMessageSerializer(instance).data
-            cache_key = self.generate_cache_key(room_name)
-            
-            redis_conn = self.get_redis_connection_safe()
-            if redis_conn:
-                try:
-                    # Add to front of cache (newest first)
-                    redis_conn.lpush(cache_key, json.dumps(message_data))
-                    redis_conn.ltrim(cache_key, 0, 49)  # Keep last 50 messages
-                    logger.info(f"Cache updated for {cache_key} (API)")
-                except Exception as e:
-                    logger.error(f"Error updating cache in perform_create: {e}")
+            try:
+                image = blobs.image_from_payload(self.request.data, sender)
+            except blobs.InvalidImage as e:
+                raise ValidationError(str(e))
+
+            if room_log.enabled():
+                # The room stream allocates the id and hands the row to the persist group.
+                instance = ChatMessage(**{
+                    **serializer.validated_data,
+                    'sender': sender,
+                    'room_name': room_name,
+                    'receiver': receiver_instance,
+                    'is_dm': is_dm,
+                    'image': image,
+                    'image_content': None,
+                })
+                instance.conversation = instance.build_conversation_key()
+                room_log.append(instance)
+                serializer.instance = instance
+                return
+
+            # In write-behind mode every message id comes from the shared sequence.
+            extra = {'id': persistence.allocate_message_id()} if persistence.write_behind_enabled() else {}
+
+            # Save the message and fold it into the chat list summaries in one transaction
+            def save():
+                with transaction.atomic():
+                    instance = serializer.save(
+                        **extra,
+                        sender=sender, 
+                        room_name=room_name, 
+                        receiver=receiver_instance, 
+                        is_dm=is_dm,
+                        image=image,
+                        image_content=None,
+                    )
+                    conversations.record_messages([instance])
+                return instance
+
+            # On SQLite this goes through the single writer, see chatbox.sqlite_writer
+            instance = sqlite_writer.run(save)
+
+            # Write through to the history cache and the resume log
+            data = ChatMessageSerializer(instance).data
+            try:
+                history_cache.push(instance.conversation, data)
+                logger.debug(f"Cache updated for {instance.conversation} (API)")
+            except Exception as e:
+                logger.error(f"Error updating cache in perform_create: {e}")
+            try:
+                resume_log.append(instance.conversation, instance.id, resume_log.message_frame(data))
+            except Exception as e:
+                logger.error(f"Error appending to resume log in perform_create: {e}")
             
+        except APIException:
+            raise
         except Exception as e:
             logger.error(f"Error in perform_create: {e}")
             raise
 
 
-class UserChatListView(APIView):
+class MessageSearchView(generics.GenericAPIView):
     """
-    This view fetches the initial list of a user's conversations.
-    - DMs: A list of unique users they have messaged.
-    - Rooms: A list of unique public rooms they have joined.
+    Full-text search over the messages the user can read: every public room
+    and their own DMs, or one conversation with ?room_name= / ?receiver_id=.
+    ?q= is matched word by word against the database's text index (see
+    chatbox.search); results come newest first with an HTML 'snippet' whose
+    matches are wrapped in <mark>, paged with ?before=/?after= cursors like
+    the history.
     """
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageKeysetPagination
 
     def get(self, request, *args, **kwargs):
+        user = request.user
+        terms = search.query_terms(request.query_params.get('q'))
+        if not terms:
+            return Response({"detail": "Query parameter 'q' is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        room_name = request.query_params.get('room_name')
+        receiver_id = request.query_params.get('receiver_id')
+        if receiver_id is not None:
+            try:
+                conversation = dm_conversation_key(user.id, receiver_id)
+            except (ValueError, TypeError):
+                return Response({"detail": "Invalid receiver_id."}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = ChatMessage.objects.filter(conversation=conversation, is_dm=True)
+        elif room_name:
+            queryset = ChatMessage.objects.filter(conversation=room_name, is_dm=False)
+        else:
+            queryset = ChatMessage.objects.filter(Q(is_dm=False) | Q(sender=user) | Q(receiver=user))
+
         try:
-            user = request.user
-            
-            # Find all unique users the current user has had a DM with
-            sent_to_users = User.objects.filter(
-                received_messages__sender=user, 
-                received_messages__is_dm=True
-            )
-            received_from_users = User.objects.filter(
-                sent_messages__receiver=user, 
-                sent_messages__is_dm=True
-            )
-            # Combine and get unique users
-            dm_partners = (sent_to_users | received_from_users).distinct()
-
-            # Find all unique public room names the user has participated in
-            rooms = ChatMessage.objects.filter(
-                sender=user, 
-                is_dm=False
-            ).values_list('room_name', flat=True).distinct()
-
-            # Use the UserSerializer to format the DM partner data correctly
-            from .serializers import UserSerializer 
-            dm_serializer = UserSerializer(dm_partners, many=True)
-            
-            return Response({
-                'dms': dm_serializer.data, 
-                'rooms': list(rooms)
-            })
-            
+            page = self.paginate_queryset(message_rows(search.filter_matches(queryset, terms)))
+            data = serialize_message_rows(page)
+            marked = search.snippets(terms, [message['id'] for message in data])
+            for message in data:
+                message['snippet'] = marked.get(message['id'], '')
+            read_state.apply_read_state_across(data)
+            return self.get_paginated_response(data)
+        except APIException:
+            raise
         except Exception as e:
-            logger.error(f"Error in UserChatListView: {e}")
-            return Response(
-                {"detail": "Error fetching chat list."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            logger.error(f"Error searching messages: {e}")
+            return Response({"detail": "Error searching messages."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class UserChatListView(generics.ListAPIView):
+    """
+    The user's conversations (DMs and public rooms they've written in), most
+    recently active first, with last message and unread count. Reads only the
+    summary rows maintained by chatbox.conversations: the user's Participant
+    rows joined to their Conversations, however long the history is, plus
+    one lookup of the watermarks for the page's public rooms.
+    Paged with ?before=/?after= cursors like the message history.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = ConversationSummarySerializer
+    pagination_class = ConversationKeysetPagination
+
+    def get_queryset(self):
+        return (Participant.objects
+                .filter(user=self.request.user)
+                .annotate(last_activity=F('conversation__last_activity'))
+                .select_related('conversation', 'conversation__last_sender', 'peer'))
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            read_state.apply_room_unread_counts(self.request.user, page)
+        return page
+
+
+class ImageUploadView(APIView):
+    """
+    Stores an uploaded image (multipart field 'file') in the blob store and
+    returns its reference. Clients then send the returned 'id' as 'image_id'
+    in a chat message instead of inlining the image.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"detail": "No file uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            blob = blobs.store_image(upload, uploaded_by=request.user)
+        except blobs.InvalidImage as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(blobs.image_reference(blob), status=status.HTTP_201_CREATED)
+
+
+class ImageDownloadView(APIView):
+    """
+    Streams an image or its thumbnail from the blob store. Blobs are immutable
+    and addressed by their SHA-256, so responses are cacheable forever and the
+    hash itself is the access token (plain <img> tags can't send a JWT).
+    """
+    permission_classes = [permissions.AllowAny]
+    authentication_classes = []
+    thumbnail = False
+
+    def get(self, request, sha256, *args, **kwargs):
+        etag = f'"{sha256}{"-thumb" if self.thumbnail else ""}"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponseNotModified()
+        else:
+            try:
+                blob = ImageBlob.objects.get(sha256=sha256)
+                path = blobs.blob_path(sha256, thumbnail=self.thumbnail)
+                content_type = blobs.THUMBNAIL_CONTENT_TYPE if self.thumbnail else blob.content_type
+                response = FileResponse(open(path, 'rb'), content_type=content_type)
+            except (ImageBlob.DoesNotExist, FileNotFoundError):
+                return Response({"detail": "Image not found."}, status=status.HTTP_404_NOT_FOUND)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+class MetricsView(APIView):
+    """
+    Prometheus scrape endpoint for this worker's metrics (see chatbox.metrics).
+    The scraper must send METRICS_TOKEN as a bearer token; without a token
+    configured the endpoint is closed.
+    """
+    permission_classes = [permissions.AllowAny]
+    authentication_classes = []
+
+    def get(self, request, *args, **kwargs):
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        if not token:
+            return Response({"detail": "Metrics are disabled: METRICS_TOKEN is not set."},
+                            status=status.HTTP_403_FORBIDDEN)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return Response({"detail": "Invalid metrics token."}, status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -19,7 +19,10 @@ import { jwtDecode } from "jwt-decode";
 
 // --- Configuration ---
 const API_BASE_URL = "http://192.168.0.56:8000/api";
+const API_ORIGIN = API_BASE_URL.replace(/\/api$/, "");
 const WEBSOCKET_HOST = "192.168.0.56:8000";
+// Must stay well under the server's PRESENCE_TTL.
+const HEARTBEAT_INTERVAL_MS = 20000;
 
 export default function ChatComponent() {
   // --- State Management ---
@@ -54,11 +57,16 @@ export default function ChatComponent() {
   const [typingUsers, setTypingUsers] = useState({});
 
   const globalWs = useRef(null);
+  const presenceSeq = useRef(0);
   const chatWs = useRef({});
   const chatContainerRef = useRef(null);
   const onMessageHandlerRef = useRef(null);
   const typingTimer = useRef(null);
+  const lastTypingSignalAt = useRef(0);
   const isTypingSignalSent = useRef(false);
+  // Newest message id seen per chat, sent as a 'resume' when its socket reconnects.
+  const lastSeenIds = useRef({});
+  const resumeFallbacks = useRef({});
 
   // --- Logic Functions ---
 
@@ -126,8 +134,9 @@ export default function ChatComponent() {
       messageIds &&
       messageIds.length > 0
     ) {
+      // The server keeps one read watermark per chat, so only the newest id is needed.
       targetSocket.send(
-        JSON.stringify({ type: "mark_read_batch", message_ids: messageIds })
+        JSON.stringify({ type: "mark_read", last_read_id: Math.max(...messageIds) })
       );
     }
   }, []);
@@ -152,6 +161,10 @@ export default function ChatComponent() {
         } else {
           messageOriginChatId = messageData.room_name;
         }
+        lastSeenIds.current[messageOriginChatId] = Math.max(
+          lastSeenIds.current[messageOriginChatId] || 0,
+          messageData.id
+        );
 
         setMessages((prev) => {
           const existingMsgs = prev[messageOriginChatId] || [];
@@ -181,7 +194,11 @@ export default function ChatComponent() {
           }
         }
       } else if (data.type === "messages_marked_as_read") {
-        const { room_name: receiptChatId, message_ids: readMessageIds } = data;
+        const {
+          room_name: receiptChatId,
+          last_read_id: lastReadId,
+          reader_username: readerUsername,
+        } = data;
 
         setMessages((prevMessages) => {
           const currentChatMessages = prevMessages[receiptChatId] || [];
@@ -189,7 +206,10 @@ export default function ChatComponent() {
             return prevMessages;
           }
           const updatedMessagesForChat = currentChatMessages.map((msg) => {
-            if (readMessageIds.includes(msg.id)) {
+            if (
+              msg.id <= lastReadId &&
+              msg.sender.username !== readerUsername
+            ) {
               return { ...msg, is_read: true };
             }
             return msg;
@@ -199,17 +219,19 @@ export default function ChatComponent() {
             [receiptChatId]: updatedMessagesForChat,
           };
         });
-      } else if (data.type === "typing_status") {
-        setTypingUsers((prev) => {
-          const newTypingUsers = { ...prev };
-          if (data.is_typing) {
-            newTypingUsers[data.username] = true;
-          } else {
-            delete newTypingUsers[data.username];
+      } else if (data.type === "resumed") {
+        // Missed more than the server replays: start over from the first page.
+        if (!data.complete) {
+          resumeFallbacks.current[data.room_name]?.();
+        }
+      } else if (data.type === "typing_users") {
+        const nextTypingUsers = {};
+        data.usernames.forEach((name) => {
+          if (name !== username) {
+            nextTypingUsers[name] = true;
           }
-
-          return newTypingUsers;
         });
+        setTypingUsers(nextTypingUsers);
       }
     },
     [username, getCurrentChatIdentifier, markMessagesAsReadOnServer]
@@ -228,6 +250,7 @@ export default function ChatComponent() {
       }
     });
     chatWs.current = {};
+    lastSeenIds.current = {};
 
     setMessages({});
     setMessageHistory({});
@@ -292,9 +315,15 @@ export default function ChatComponent() {
       const response = await axios.get(`${API_BASE_URL}/user-chats/`, {
         headers: { Authorization: `Bearer ${tokens.access}` },
       });
-      const { dms = [], rooms = [] } = response.data;
-      setActiveConversations(dms);
-      setUserJoinedRooms(rooms);
+      // Conversations come back most recently active first.
+      const { results = [] } = response.data;
+      setActiveConversations(
+        results.filter((c) => c.is_dm && c.peer).map((c) => c.peer)
+      );
+      setUserJoinedRooms(results.filter((c) => !c.is_dm).map((c) => c.key));
+      setUnreadCounts(
+        Object.fromEntries(results.map((c) => [c.key, c.unread_count]))
+      );
     } catch (error) {
       console.error("Failed to fetch user's initial chats:", error);
     }
@@ -322,6 +351,10 @@ export default function ChatComponent() {
 
         const { results, next } = response.data;
         const chronologicallyOrderedResults = results.slice().reverse();
+        lastSeenIds.current[chatId] = Math.max(
+          0,
+          ...results.map((msg) => msg.id)
+        );
 
         // Key Change: This REPLACES the messages for the chat, ensuring a clean slate.
         setMessages((prev) => ({
@@ -433,10 +466,13 @@ export default function ChatComponent() {
       setActiveChat(target);
       setActiveChatType(type);
 
-      // --- THE FINAL FIX ---
-      // Use our new, dedicated function to reliably load the initial chat history.
-      loadInitialMessages(chatIdentifier, type, receiverId);
-      // --- END OF FIX ---
+      // Load history the first time a chat is opened; after that, reconnects
+      // catch up with a 'resume' frame instead of refetching the first page.
+      resumeFallbacks.current[chatIdentifier] = () =>
+        loadInitialMessages(chatIdentifier, type, receiverId);
+      if (!lastSeenIds.current[chatIdentifier]) {
+        loadInitialMessages(chatIdentifier, type, receiverId);
+      }
 
       if (
         !chatWs.current[chatIdentifier] ||
@@ -451,6 +487,10 @@ export default function ChatComponent() {
             `[Frontend] WS Connected: ${type} chat ${chatIdentifier}`
           );
           setChatConnecting((prev) => ({ ...prev, [chatIdentifier]: false }));
+          const lastSeenId = lastSeenIds.current[chatIdentifier];
+          if (lastSeenId) {
+            socket.send(JSON.stringify({ type: "resume", last_id: lastSeenId }));
+          }
         };
         socket.onclose = (event) => {
           console.log(
@@ -514,17 +554,27 @@ export default function ChatComponent() {
         alert("Image file size exceeds 5MB.");
         return;
       }
-      const reader = new FileReader();
-      reader.onloadend = () =>
-        sendMessage({
-          message: null,
-          image_content: reader.result,
-          msg_type: "image",
+      // Upload once over HTTP; the chat message only carries the image id.
+      const formData = new FormData();
+      formData.append("file", file);
+      axios
+        .post(`${API_BASE_URL}/images/`, formData, {
+          headers: { Authorization: `Bearer ${authTokens.access}` },
+        })
+        .then((response) =>
+          sendMessage({
+            message: null,
+            image_id: response.data.id,
+            msg_type: "image",
+          })
+        )
+        .catch((error) => {
+          console.error("Image upload failed:", error);
+          alert("Image upload failed.");
         });
-      reader.readAsDataURL(file);
       if (e.target) e.target.value = null;
     },
-    [sendMessage]
+    [sendMessage, authTokens]
   );
 
   const leaveRoom = useCallback(async (roomToLeave) => {
@@ -550,9 +600,12 @@ export default function ChatComponent() {
     const socket = chatWs.current[currentChatId];
 
     if (socket?.readyState === WebSocket.OPEN) {
-      if (!isTypingSignalSent.current) {
+      // The server forgets a typist after a few seconds, so keep refreshing while typing.
+      const now = Date.now();
+      if (!isTypingSignalSent.current || now - lastTypingSignalAt.current > 3000) {
         socket.send(JSON.stringify({ type: "start_typing" }));
         isTypingSignalSent.current = true;
+        lastTypingSignalAt.current = now;
       }
 
       if (typingTimer.current) {
@@ -627,14 +680,61 @@ export default function ChatComponent() {
     ws.onerror = (e) => console.error(`Global WS error for '${username}':`, e);
     ws.onmessage = (e) => {
       const data = JSON.parse(e.data);
-      if (data.type === "user_list") setOnlineUsers(data.users);
-      if (data.type === "detailed_room_list") setAvailableRooms(data.rooms);
+      if (data.type === "presence_snapshot") {
+        presenceSeq.current = data.seq;
+        setOnlineUsers(data.users);
+        setAvailableRooms(data.rooms);
+      } else if (data.type === "presence_delta") {
+        if (data.seq <= presenceSeq.current) return;
+        if (data.seq !== presenceSeq.current + 1) {
+          // Missed at least one delta: ask for a fresh snapshot.
+          ws.send(JSON.stringify({ type: "presence_sync" }));
+          return;
+        }
+        presenceSeq.current = data.seq;
+        data.events.forEach((event) => {
+          if (event.type === "user_joined") {
+            setOnlineUsers((prev) =>
+              prev.some((u) => u.username === event.user.username)
+                ? prev
+                : [...prev, event.user].sort((a, b) =>
+                    a.username.localeCompare(b.username)
+                  )
+            );
+          } else if (event.type === "user_left") {
+            setOnlineUsers((prev) =>
+              prev.filter((u) => u.username !== event.username)
+            );
+          } else if (event.type === "room_count_changed") {
+            setAvailableRooms((prev) => {
+              const others = prev.filter((r) => r.name !== event.name);
+              if (event.online_count === 0) return others;
+              return [
+                ...others,
+                { name: event.name, online_count: event.online_count },
+              ].sort((a, b) => a.name.localeCompare(b.name));
+            });
+          }
+        });
+      }
     };
     return () => {
       ws.close();
     };
   }, [view, authTokens, username]);
 
+  // Keeps this tab's presence and room connections counted as online.
+  useEffect(() => {
+    if (view !== "chat") return;
+    const timer = setInterval(() => {
+      const frame = JSON.stringify({ type: "heartbeat" });
+      [globalWs.current, ...Object.values(chatWs.current)].forEach((s) => {
+        if (s?.readyState === WebSocket.OPEN) s.send(frame);
+      });
+    }, HEARTBEAT_INTERVAL_MS);
+    return () => clearInterval(timer);
+  }, [view]);
+
   useEffect(() => {
     const currentChatId = getCurrentChatIdentifier();
     if (view === "chat" && currentChatId && username) {
@@ -1130,7 +1230,18 @@ export default function ChatComponent() {
                             </span>
                           )}
                       </div>
-                      {msg.message_type === "image" && msg.image_content ? (
+                      {msg.message_type === "image" && msg.image ? (
+                        <img
+                          src={`${API_ORIGIN}${msg.image.thumbnail_url}`}
+                          width={msg.image.width}
+                          height={msg.image.height}
+                          alt="uploaded"
+                          className="max-w-xs sm:max-w-sm md:max-w-md max-h-72 w-auto h-auto rounded mt-1 cursor-pointer"
+                          onClick={() =>
+                            window.open(`${API_ORIGIN}${msg.image.url}`, "_blank")
+                          }
+                        />
+                      ) : msg.message_type === "image" && msg.image_content ? (
                         <img
                           src={msg.image_content}
                           alt="uploaded"